@@ -0,0 +1,12 @@
+-- One-off: the per-run metrics the jobs log through instrumentation.py.
+-- Query them with UNNEST, e.g.
+--   SELECT task, time_started, s.stage, s.seconds
+--   FROM `car-buying-272019.car_buying.log`, UNNEST(stage_seconds) AS s
+ALTER TABLE `car-buying-272019.car_buying.log`
+  ADD COLUMN IF NOT EXISTS hostname STRING,
+  ADD COLUMN IF NOT EXISTS duration_seconds FLOAT64,
+  ADD COLUMN IF NOT EXISTS stage_seconds ARRAY<STRUCT<stage STRING, seconds FLOAT64>>,
+  ADD COLUMN IF NOT EXISTS counters ARRAY<STRUCT<name STRING, value INT64>>,
+  ADD COLUMN IF NOT EXISTS latencies ARRAY<STRUCT<name STRING, count INT64, total_seconds FLOAT64,
+                                                  max_seconds FLOAT64, p50_seconds FLOAT64,
+                                                  p90_seconds FLOAT64, p99_seconds FLOAT64>>;
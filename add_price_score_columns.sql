@@ -0,0 +1,5 @@
+-- One-off: columns process_listing_pages fills in with price_scoring.py.
+-- Same formula as hot_deals_dashboard_vw, applied as listings are parsed.
+ALTER TABLE `car-buying-272019.car_buying.processed_listing_pages`
+  ADD COLUMN IF NOT EXISTS predicted_price FLOAT64,
+  ADD COLUMN IF NOT EXISTS deal_ratio FLOAT64;
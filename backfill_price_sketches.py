@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One-off: seeds the price sketches from the listings already in
+processed_listing_pages.
+
+The parse jobs only add listings to the sketches as they parse them, so
+right after price_bounds is deployed **price_quantile_bounds** covers just
+what's been parsed since. lm_fit_sketch_vw falls back to APPROX_QUANTILES
+for make/model/years it doesn't cover yet, but the bounds it does have come
+from a fraction of the window. Run this once, with the parse jobs stopped,
+before setting LM_FIT_VIEW=lm_fit_sketch_vw. It rebuilds the sketch file
+from the whole six-month window, replacing what the parse jobs had kept,
+and publishes the bounds.
+"""
+
+import os
+import socket
+from datetime import datetime
+
+from checkpoints import format_time
+from price_bounds import SKETCH_PATH, WINDOW_DAYS, PriceSketches
+from warehouse import connect_warehouse
+
+BATCH_SIZE = int(os.getenv("PRICE_BACKFILL_BATCH", "50000"))
+
+FIELDS = ("make", "model", "year", "odometer", "price", "condition", "time_posted")
+
+
+def main() :
+
+    start = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    warehouse = connect_warehouse()
+
+    # Start from nothing; the listings the parse jobs already sketched are
+    # in the table too.
+    sketches = PriceSketches(path=SKETCH_PATH)
+
+    listings = 0
+    batch = []
+
+    for row in warehouse.price_history(WINDOW_DAYS) :
+        row = dict(zip(FIELDS, row))
+        # BigQuery hands back datetimes; the sketches key on the day string
+        row["time_posted"] = format_time(row["time_posted"])
+        batch.append(row)
+
+        if len(batch) >= BATCH_SIZE :
+            listings += sketches.update_rows(batch)
+            batch = []
+            print(f"Sketched {listings} listings.")
+
+    listings += sketches.update_rows(batch)
+
+    sketches.expire()
+    sketches.save()
+    published = sketches.publish(warehouse)
+
+    print(f"Sketched {listings} listings; published price bounds for {published} make/model/years.")
+
+    log_row = [{
+        'task' : "backfill_price_sketches",
+        'time_started' : start,
+        'time_finished' : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        'notes' : f"sketched {listings} listings into {len(sketches)} make/model/year weeks, "
+                  f"bounds for {published} make/model/years on {socket.gethostname()}."
+    }]
+
+    warehouse.upload('log',log_row)
+
+    warehouse.close()
+
+    return(0)
+
+
+if __name__ == '__main__':
+    main()
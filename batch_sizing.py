@@ -0,0 +1,121 @@
+"""
+Batch sizes for the cron jobs, learned from their recent runs.
+
+process_listing_pages took 2500 pages a run and harvest_pages 130 links,
+whatever the backlog and however fast the last runs went. A run that
+finishes early leaves the backlog to grow until the next one, and a run
+that overruns its cron interval piles up behind the next. A `BatchSizer`
+keeps the last few runs of a job in a checkpoint: how many items they
+took, how long the per-item work took, the fixed overhead (connecting,
+reading the backlog) and bytes per item. From those it sizes the next
+batch to finish in the job's target duration and keep the job's pages
+within its memory budget:
+
+    items = min((target - overhead) / seconds per item,
+                memory budget / bytes per item,
+                backlog)
+
+Rates are totals over the recent runs rather than an average of per-run
+rates, so a short run doesn't count for as much as a long one. A batch can
+at most double the largest of the recent runs, so one fast run on a quiet
+network can't commit the next to an overrun. Runs that took everything
+waiting say nothing about how many more they could have done, so they
+don't count towards that cap. With no history yet the job's old fixed size
+is used.
+"""
+
+import os
+import statistics
+
+from checkpoints import load_checkpoint, save_checkpoint
+
+RECENT_RUNS = int(os.getenv("BATCH_RECENT_RUNS", "8"))
+MAX_GROWTH = 2.0
+
+
+class BatchSizer :
+
+    def __init__(self, job, target_seconds, memory_bytes, initial, minimum=1, maximum=None) :
+        self.job = job
+        self.target_seconds = target_seconds
+        self.memory_bytes = memory_bytes
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+        checkpoint = load_checkpoint(f"{job}_batch") or {}
+        self.runs = checkpoint.get("runs", [])[-RECENT_RUNS:]
+
+        # What the last `size` asked for, and why
+        self.requested = None
+        self.reason = None
+
+    def rates(self) :
+        """ (seconds per item, overhead seconds, bytes per item) over the recent runs, or None."""
+        if not self.runs :
+            return(None)
+
+        items = sum(run["items"] for run in self.runs)
+        seconds_per_item = sum(run["work_seconds"] for run in self.runs) / items
+        bytes_per_item = sum(run["bytes"] for run in self.runs) / items
+        overhead = statistics.median(run["overhead_seconds"] for run in self.runs)
+
+        return(seconds_per_item, overhead, bytes_per_item)
+
+    def size(self, backlog=None) :
+        """ How many items the next run should take, given `backlog` items waiting if known."""
+        rates = self.rates()
+
+        if rates is None :
+            size = self.initial
+            reason = "no history"
+        else :
+            seconds_per_item, overhead, bytes_per_item = rates
+
+            limits = {"time" : (self.target_seconds - overhead) / max(seconds_per_item, 1e-6)}
+            if self.memory_bytes and bytes_per_item > 0 :
+                limits["memory"] = self.memory_bytes / bytes_per_item
+            full_runs = [run["items"] for run in self.runs if not run.get("backlog_limited")]
+            limits["growth"] = max(max(full_runs, default=self.initial), self.minimum) * MAX_GROWTH
+
+            reason = min(limits, key=limits.get)
+            size = int(limits[reason])
+
+        if self.maximum is not None and size > self.maximum :
+            size, reason = self.maximum, "maximum"
+        if size < self.minimum :
+            size, reason = self.minimum, "minimum"
+        if backlog is not None and backlog < size :
+            size, reason = backlog, "backlog"
+
+        if rates is None :
+            print(f"{self.job}: taking {size} items ({reason}).")
+        else :
+            print(f"{self.job}: taking {size} items ({reason}); recent runs did "
+                  f"{1 / max(rates[0], 1e-6):.1f} items/s after {rates[1]:.0f}s overhead, "
+                  f"{rates[2] / 1024:.0f} KiB/item.")
+
+        self.requested = size
+        self.reason = reason
+
+        return(size)
+
+    def record(self, items, work_seconds, total_seconds, bytes_used=0) :
+        """
+        Save a finished run: `items` took `work_seconds` of a `total_seconds`
+        run. A run that got fewer items than `size` asked for, or was sized
+        to the backlog, is marked as limited by the backlog.
+        """
+        if items <= 0 :
+            return
+
+        self.runs.append({
+            "items" : int(items),
+            "work_seconds" : round(work_seconds, 3),
+            "overhead_seconds" : round(max(total_seconds - work_seconds, 0.0), 3),
+            "bytes" : int(bytes_used),
+            "backlog_limited" : self.requested is not None and (self.reason == "backlog" or items < self.requested),
+        })
+        self.runs = self.runs[-RECENT_RUNS:]
+
+        save_checkpoint(f"{self.job}_batch", {"runs" : self.runs})
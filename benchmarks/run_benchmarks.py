@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for the parsing and model fitting code.
+
+Everything runs against the checked-in corpus under benchmarks/corpus, so
+nothing touches Craigslist or the warehouse and runs can be compared
+between versions. The corpus covers:
+
+- listing pages with and without `ld_posting_data`, with no attrgroup at
+  all, and with odd odometer values (in thousands, with a comma, 0,
+  999999, a decimal);
+- misspelled and abbreviated makes and models, a hyphenated make, and a
+  make that's only in the title;
+- a page stored as compressed fragments (see raw_page_codec);
+- search result pages with "nearby areas" links mixed in.
+
+Pages are anonymized: post IDs, coordinates, image IDs and posting text
+are made up. `manifest.json` lists each page with what it covers, the
+make/model rows the matcher is built from, and the fields the parser is
+expected to pull out. The run checks those fields first, since a fast
+parser that gets the wrong answer isn't an improvement, and that the
+listing_scanner fast path gives the same rows as the soup. After an
+intentional change in what's parsed, refresh them with --record.
+
+Each benchmark runs `--repeat` times and reports the fastest and median
+time in seconds, and the time per item in microseconds. The report is
+JSON, written to stdout or `--output`. `--compare` takes an earlier
+report, prints the change per benchmark, and exits 1 if anything got
+slower by more than `--threshold`.
+
+    python benchmarks/run_benchmarks.py --output before.json
+    (make a change)
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "lm_fit_uploader_cloud_function"))
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from get_links import get_listing_urls
+from grouped_ols import fit_grouped_ols
+from make_model_matcher import MakeModelMatcher
+from process_listing_pages import (ListingDocument, find_best_match, get_listing_name, get_make,
+                                   get_make_models, get_model, get_price, parse_attrgroup,
+                                   parse_listing_page, parse_rows, verify_fast_path)
+from raw_page_codec import decode_page
+
+# Fields checked against the manifest for every listing page
+CHECKED_FIELDS = ["make", "model", "year", "price", "odometer", "condition", "time_posted",
+                  "latitude", "longitude", "num_images"]
+
+# Misspellings for the fuzzy matcher, as (text, make)
+FUZZY_INPUTS = [
+    ("tacomma prerunner", "toyota"), ("silverdo 1500", "chevrolet"), ("outbak limited", "subaru"),
+    ("wranglr sahara", "jeep"), ("odysey touring", "honda"), ("frontire 4x4", "nissan"),
+    ("f 150 lariat", "ford"), ("highlandr xle", "toyota"), ("grand cherokkee", "jeep"),
+    ("crosstrack premium", "subaru"), ("altma sv", "nissan"), ("explorerr xlt", "ford"),
+]
+
+
+class CorpusMakeModels :
+    """ Stands in for the warehouse so `get_make_models` reads the manifest's rows."""
+
+    def __init__(self, rows) :
+        self.rows = [tuple(row) for row in rows]
+
+    def make_models(self) :
+        return(self.rows)
+
+
+def read_file(name) :
+    with open(os.path.join(CORPUS_DIR, name)) as f :
+        return(f.read())
+
+
+def load_corpus() :
+    with open(os.path.join(CORPUS_DIR, "manifest.json")) as f :
+        manifest = json.load(f)
+
+    for entry in manifest["listings"] + manifest["search"] :
+        entry["html"] = read_file(entry["file"])
+
+    return(manifest)
+
+
+def time_it(func, repeat, setup=None) :
+    """
+    Run `func` `repeat` times and return the wall time of each run. `setup`
+    runs before each one, untimed, and its result is passed to `func`.
+    Anything the code under test prints is swallowed so it doesn't skew
+    the timing.
+    """
+    times = []
+
+    for _ in range(repeat) :
+        arg = setup() if setup is not None else None
+
+        with contextlib.redirect_stdout(io.StringIO()) :
+            start = time.perf_counter()
+            func(arg) if setup is not None else func()
+            times.append(time.perf_counter() - start)
+
+    return(times)
+
+
+def summarize(times, items) :
+    best = min(times)
+    return({
+        "items" : items,
+        "repeat" : len(times),
+        "min_s" : best,
+        "median_s" : statistics.median(times),
+        "per_item_us" : best / items * 1e6 if items else None,
+        "items_per_s" : items / best if best > 0 else None,
+    })
+
+
+def parsed_fields(manifest, matcher) :
+    """ url -> the CHECKED_FIELDS parse_listing_page gives for each listing page."""
+    with contextlib.redirect_stdout(io.StringIO()) :
+        rows = [parse_listing_page(entry["url"], entry["html"], entry["location"], matcher)
+                for entry in manifest["listings"]]
+
+    return({row["url"] : {field : row.get(field) for field in CHECKED_FIELDS} for row in rows})
+
+
+def check_corpus(manifest, matcher) :
+    """ Differences between what's parsed now and what the manifest expects."""
+    problems = []
+    parsed = parsed_fields(manifest, matcher)
+
+    for entry in manifest["listings"] :
+        expected = entry.get("expected")
+        if expected is None :
+            problems.append(f"{entry['file']}: no expected fields recorded")
+            continue
+
+        got = parsed[entry["url"]]
+        for field, value in expected.items() :
+            if got.get(field) != value :
+                problems.append(f"{entry['file']} ({entry['case']}): {field} is {got.get(field)!r}, expected {value!r}")
+
+    with contextlib.redirect_stdout(io.StringIO()) :
+        differences = {entry["file"] : verify_fast_path(entry["url"], entry["html"], entry["location"], matcher)
+                       for entry in manifest["listings"]}
+
+    for name, fields in differences.items() :
+        for field, (fast, soup) in (fields or {}).items() :
+            problems.append(f"{name}: fast path gives {field} {fast!r}, the soup {soup!r}")
+
+    for entry in manifest["search"] :
+        links = get_listing_urls(entry["html"], entry["location"])
+        if len(links) != entry["expected_links"] :
+            problems.append(f"{entry['file']}: {len(links)} links, expected {entry['expected_links']}")
+
+    return(problems)
+
+
+def record_expected(manifest, matcher) :
+    """ Store what's parsed now as the expected fields in manifest.json."""
+    parsed = parsed_fields(manifest, matcher)
+
+    for entry in manifest["listings"] :
+        entry["expected"] = parsed[entry["url"]]
+
+    stored = {key : [{k : v for k, v in entry.items() if k != "html"} for entry in manifest[key]]
+              for key in ("listings", "search")}
+    stored["make_models"] = manifest["make_models"]
+
+    with open(os.path.join(CORPUS_DIR, "manifest.json"), "w") as f :
+        json.dump(stored, f, indent=1)
+        f.write("\n")
+
+
+def synthetic_fit_data(rows, groups, seed=0) :
+    """ Listings shaped like lm_fit_vw: price ~ log_odometer + condition + year per make/model."""
+    rng = np.random.default_rng(seed)
+
+    group = rng.zipf(1.3, rows) % groups
+    year = rng.integers(1995, 2024, rows).astype("float64")
+    log_odometer = np.log(rng.uniform(5000, 250000, rows) + 1)
+    condition = rng.integers(0, 2, rows).astype("float64")
+
+    base = rng.uniform(5000, 40000, groups)[group]
+    price = (base + 900 * (year - 2010) - 2500 * (log_odometer - 11) + 1500 * condition
+             + rng.normal(0, 2000, rows))
+
+    return(pd.DataFrame({
+        "make" : pd.Categorical.from_codes(group % 40, [f"make{i}" for i in range(40)]),
+        "model" : pd.Categorical.from_codes(group, [f"model{i}" for i in range(groups)]),
+        "year" : year.astype("float32"),
+        "log_odometer" : log_odometer,
+        "price" : price,
+        "condition_mapped" : condition.astype("float32"),
+    }))
+
+
+def run_benchmarks(manifest, matcher, repeat, only=None, fit_rows=200000, fit_groups=3000, workers=2) :
+    listings = manifest["listings"]
+    html = [decode_page(entry["html"]) for entry in listings]
+    results = {}
+
+    def wanted(name) :
+        return(only is None or any(name.startswith(prefix) for prefix in only))
+
+    def fresh_documents() :
+        # The documents cache what they decode, so every run gets new ones
+        return([ListingDocument(soup) for soup in soups])
+
+    soups = [BeautifulSoup(page, "html.parser") for page in html]
+
+    if wanted("soup") :
+        times = time_it(lambda : [BeautifulSoup(page, "html.parser") for page in html], repeat)
+        results["soup"] = summarize(times, len(html))
+
+    if wanted("scan_listing") :
+        # The fast path's equivalent of soup + listing_document; pages it
+        # can't take come back as None
+        times = time_it(lambda : [ListingDocument.scanned(page) for page in html], repeat)
+        results["scan_listing"] = summarize(times, len(html))
+
+    if wanted("listing_document") :
+        times = time_it(fresh_documents, repeat)
+        results["listing_document"] = summarize(times, len(soups))
+
+    if wanted("parse_attrgroup") :
+        times = time_it(lambda docs : [parse_attrgroup(doc) for doc in docs], repeat, fresh_documents)
+        results["parse_attrgroup"] = summarize(times, len(soups))
+
+    if wanted("get_price") :
+        times = time_it(lambda docs : [get_price(doc) for doc in docs], repeat, fresh_documents)
+        results["get_price"] = summarize(times, len(soups))
+
+    if wanted("get_make_model") :
+        def make_and_model(docs) :
+            for doc in docs :
+                name = get_listing_name(doc)
+                make = get_make(doc, name, matcher)
+                if make :
+                    get_model(make, doc, name, matcher)
+
+        times = time_it(make_and_model, repeat, fresh_documents)
+        results["get_make_model"] = summarize(times, len(soups))
+
+    if wanted("find_best_match") :
+        def cold_index() :
+            # Misspellings repeat in real traffic, but here we want the
+            # cost of a miss, so start every run with an empty cache.
+            matcher.fuzzy.clear_cache()
+
+        times = time_it(lambda _ : [find_best_match(text, matcher.fuzzy.targets.get(make, []),
+                                                    index=matcher.fuzzy, scope=make)
+                                    for text, make in FUZZY_INPUTS],
+                        repeat, cold_index)
+        results["find_best_match"] = summarize(times, len(FUZZY_INPUTS))
+
+        times = time_it(lambda : [find_best_match(text, matcher.fuzzy.targets.get(make, []),
+                                                  index=matcher.fuzzy, scope=make)
+                                  for text, make in FUZZY_INPUTS], repeat)
+        results["find_best_match_cached"] = summarize(times, len(FUZZY_INPUTS))
+
+    if wanted("parse_listing_page") :
+        times = time_it(lambda : [parse_listing_page(entry["url"], entry["html"], entry["location"], matcher)
+                                  for entry in listings], repeat)
+        results["parse_listing_page"] = summarize(times, len(listings))
+
+    if wanted("parse_rows") :
+        # Enough copies of the corpus to keep the pool busy
+        rows = [(entry["url"], entry["html"], entry["location"]) for entry in listings] * 20
+        times = time_it(lambda : list(parse_rows(rows, matcher, workers=workers)), repeat)
+        results[f"parse_rows_{workers}_workers"] = summarize(times, len(rows))
+
+    if wanted("get_listing_urls") :
+        search = manifest["search"]
+        times = time_it(lambda : [get_listing_urls(entry["html"], entry["location"]) for entry in search],
+                        repeat)
+        results["get_listing_urls"] = summarize(times, len(search))
+
+    if wanted("fit_grouped_ols") :
+        df = synthetic_fit_data(fit_rows, fit_groups)
+        times = time_it(lambda : fit_grouped_ols(df), repeat)
+        results["fit_grouped_ols"] = summarize(times, fit_rows)
+        results["fit_grouped_ols"]["groups"] = fit_groups
+
+    return(results)
+
+
+def git_version() :
+    try :
+        return(subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError) :
+        return(None)
+
+
+def compare(report, baseline, threshold) :
+    """ Print each benchmark's change against `baseline`; return the ones slower by more than `threshold`."""
+    regressions = []
+
+    for name, result in report["benchmarks"].items() :
+        before = baseline.get("benchmarks", {}).get(name)
+        if before is None or not before.get("per_item_us") :
+            print(f"{name:28s} new", file=sys.stderr)
+            continue
+
+        # Per item, so runs with a different --fit-rows still compare
+        ratio = result["per_item_us"] / before["per_item_us"]
+        flag = ""
+        if ratio > 1 + threshold :
+            flag = "  <-- slower"
+            regressions.append(name)
+
+        print(f"{name:28s} {before['per_item_us']:12.1f} us -> {result['per_item_us']:12.1f} us per item "
+              f"({ratio - 1:+.1%}){flag}", file=sys.stderr)
+
+    return(regressions)
+
+
+def main() :
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--only", nargs="*", help="benchmark name prefixes to run")
+    arg_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    arg_parser.add_argument("--compare", help="an earlier JSON report to compare against")
+    arg_parser.add_argument("--threshold", type=float, default=0.10,
+                            help="fail --compare if a benchmark is this much slower (default 0.10)")
+    arg_parser.add_argument("--fit-rows", type=int, default=200000)
+    arg_parser.add_argument("--fit-groups", type=int, default=3000)
+    arg_parser.add_argument("--workers", type=int, default=2, help="pool size for the parse_rows benchmark")
+    arg_parser.add_argument("--record", action="store_true",
+                            help="store what's parsed now as the corpus's expected fields, then exit")
+    args = arg_parser.parse_args()
+
+    manifest = load_corpus()
+    matcher = MakeModelMatcher(get_make_models(CorpusMakeModels(manifest["make_models"])))
+
+    if args.record :
+        record_expected(manifest, matcher)
+        print(f"Recorded expected fields for {len(manifest['listings'])} listing pages.", file=sys.stderr)
+        return(0)
+
+    problems = check_corpus(manifest, matcher)
+    for problem in problems :
+        print(f"Corpus check: {problem}", file=sys.stderr)
+
+    report = {
+        "version" : git_version(),
+        "timestamp" : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "corpus" : {"listings" : len(manifest["listings"]), "search_pages" : len(manifest["search"])},
+        "corpus_check" : {"passed" : not problems, "problems" : problems},
+        "benchmarks" : run_benchmarks(manifest, matcher, args.repeat, args.only,
+                                      args.fit_rows, args.fit_groups, args.workers),
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output :
+        with open(args.output, "w") as f :
+            f.write(text + "\n")
+    else :
+        print(text)
+
+    failed = bool(problems)
+
+    if args.compare :
+        with open(args.compare) as f :
+            regressions = compare(report, json.load(f), args.threshold)
+        failed = failed or bool(regressions)
+
+    return(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
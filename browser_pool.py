@@ -0,0 +1,136 @@
+"""
+A pool of long-lived headless Chrome sessions for get_links.
+
+Starting a fresh `webdriver.Chrome` for every location was the biggest
+fixed cost of a crawl. Instead we keep `size` sessions alive and hand them
+out to worker threads. A session is health-checked before it's handed out
+and replaced after `max_uses` locations, or as soon as it looks
+disconnected, since drivers tend to drop after a while.
+"""
+
+import queue
+import threading
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chrome.service import Service as ChromeService
+
+
+def chrome_options() :
+    # Set options
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless')
+    options.add_argument("--no-sandbox")
+    return(options)
+
+
+class BrowserSession :
+
+    def __init__(self) :
+        self.driver = webdriver.Chrome(service=ChromeService(), options=chrome_options())
+        self.uses = 0
+
+    def healthy(self) :
+        try :
+            self.driver.execute_script("return 1")
+            return(True)
+        except WebDriverException :
+            return(False)
+
+    def quit(self) :
+        try :
+            self.driver.quit()
+        except WebDriverException :
+            pass
+
+
+class BrowserPool :
+    """
+    Use as a context manager; `session()` checks out a healthy session:
+
+        with BrowserPool(size=4) as pool :
+            with pool.session() as driver :
+                driver.get(url)
+    """
+
+    def __init__(self, size=1, max_uses=25) :
+        self.size = size
+        self.max_uses = max_uses
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.started = 0
+
+        for _ in range(size) :
+            self.idle.put(None)  # sessions are started lazily
+
+    def __enter__(self) :
+        return(self)
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    def _start(self) :
+        session = BrowserSession()
+        with self.lock :
+            self.sessions.add(session)
+            self.started += 1
+        return(session)
+
+    def _retire(self, session) :
+        with self.lock :
+            self.sessions.discard(session)
+        session.quit()
+
+    def acquire(self) :
+        session = self.idle.get()
+
+        if session is not None and (session.uses >= self.max_uses or not session.healthy()) :
+            self._retire(session)
+            session = None
+
+        if session is None :
+            try :
+                session = self._start()
+            except Exception :
+                # Give the slot back so the pool doesn't shrink
+                self.idle.put(None)
+                raise
+
+        return(session)
+
+    def release(self, session, broken=False) :
+        if broken :
+            self._retire(session)
+            session = None
+        else :
+            session.uses += 1
+
+        self.idle.put(session)
+
+    def session(self) :
+        return(_CheckedOut(self))
+
+    def close(self) :
+        with self.lock :
+            sessions = list(self.sessions)
+            self.sessions.clear()
+
+        for session in sessions :
+            session.quit()
+
+
+class _CheckedOut :
+
+    def __init__(self, pool) :
+        self.pool = pool
+        self.browser = None
+
+    def __enter__(self) :
+        self.browser = self.pool.acquire()
+        return(self.browser.driver)
+
+    def __exit__(self, exc_type, exc, tb) :
+        # A driver error means the session is probably gone; replace it.
+        self.pool.release(self.browser, broken=isinstance(exc, WebDriverException))
+        return(False)
@@ -0,0 +1,142 @@
+"""
+Watermark checkpoints for the cron jobs.
+
+Instead of anti-joining against the whole history of `raw_listing_pages` or
+`processed_listing_pages` on every run, each job remembers the last
+timestamp it consumed (`watermark`) and the URLs it already handled at
+exactly that timestamp (`in_flight`). The next run only selects rows at or
+past the watermark, minus those URLs. Every `RECONCILE_HOURS` a job falls
+back to its original full query as a safety net for anything that slipped
+past the watermark, e.g. rows inserted late.
+
+Link timestamps aren't guaranteed to only go up (a relisted url comes back
+with a new `row_created`), so harvest_pages still checks the links past its
+watermark against `raw_listing_pages`.
+
+Checkpoints are small JSON files, one per job, under `CHECKPOINT_DIR`.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+RECONCILE_HOURS = float(os.getenv("RECONCILE_HOURS", "24"))
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def format_time(ts) :
+    """ Timestamps come back from BigQuery as datetimes; store them as strings."""
+    if ts is None or isinstance(ts, str) :
+        return(ts)
+    return(ts.strftime(TIME_FORMAT))
+
+
+def parse_time(ts) :
+    if ts is None :
+        return(None)
+    return(datetime.strptime(ts, TIME_FORMAT))
+
+
+def _checkpoint_path(job) :
+    return(os.path.join(CHECKPOINT_DIR, f"{job}.json"))
+
+
+def load_checkpoint(job) :
+    """ Return the saved checkpoint dict for `job`, or None if there isn't one."""
+    path = _checkpoint_path(job)
+
+    if not os.path.exists(path) :
+        return(None)
+
+    try :
+        with open(path) as f :
+            return(json.load(f))
+    except (OSError, ValueError) as e :
+        print(f"Error reading checkpoint for {job}, doing a full reconcile: {e}")
+        return(None)
+
+
+def save_checkpoint(job, checkpoint) :
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+
+    path = _checkpoint_path(job)
+    tmp_path = path + ".tmp"
+
+    # Write then rename so a crash mid-write can't leave a broken checkpoint
+    with open(tmp_path, "w") as f :
+        json.dump(checkpoint, f)
+
+    os.replace(tmp_path, path)
+
+
+def needs_reconcile(checkpoint, hours=RECONCILE_HOURS) :
+    """ True if there's no usable watermark or the last full reconcile is too old."""
+    if not checkpoint or not checkpoint.get("watermark") :
+        return(True)
+
+    last_reconcile = parse_time(checkpoint.get("last_reconcile"))
+    if last_reconcile is None :
+        return(True)
+
+    return(datetime.utcnow() - last_reconcile > timedelta(hours=hours))
+
+
+def request_reconcile(job) :
+    """
+    Make `job` do a full reconcile on its next run, e.g. after something
+    other than the job itself has been consuming its rows.
+    """
+    checkpoint = load_checkpoint(job)
+
+    if checkpoint and checkpoint.pop("last_reconcile", None) :
+        save_checkpoint(job, checkpoint)
+
+
+def consumed_before_failure(consumed, failed_urls) :
+    """
+    The (url, timestamp) pairs up to the first one whose url failed. Moving
+    the watermark only this far means failed rows are selected again on the
+    next run instead of waiting for a reconcile.
+    """
+    prefix = []
+    for url, ts in consumed :
+        if url in failed_urls :
+            break
+        prefix.append((url, ts))
+    return(prefix)
+
+
+def advance_checkpoint(checkpoint, consumed, reconciled=False) :
+    """
+    Move the watermark past the (url, timestamp) pairs a run consumed.
+
+    Callers have to consume rows oldest first so that nothing older than the
+    new watermark is left behind. On a reconcile run the candidate list was
+    the complete backlog, so the watermark is reset to what was consumed
+    rather than only moving forward.
+    """
+    checkpoint = dict(checkpoint or {})
+
+    watermark = None if reconciled else checkpoint.get("watermark")
+    in_flight = set() if reconciled else set(checkpoint.get("in_flight", []))
+
+    for url, ts in consumed :
+        ts = format_time(ts)
+        if watermark is None or ts > watermark :
+            watermark = ts
+            in_flight = {url}
+        elif ts == watermark :
+            in_flight.add(url)
+
+    # Nothing consumed on a reconcile means the backlog is empty, so the old
+    # watermark is still safe to keep.
+    if watermark is not None :
+        checkpoint["watermark"] = watermark
+        checkpoint["in_flight"] = sorted(in_flight)
+
+    if reconciled :
+        checkpoint["last_reconcile"] = datetime.utcnow().strftime(TIME_FORMAT)
+
+    return(checkpoint)
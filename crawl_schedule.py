@@ -0,0 +1,215 @@
+"""
+Which Craigslist locations get_links should crawl, and in what order.
+
+The list of locations barely changes, so it's cached for LOCATIONS_TTL_HOURS
+instead of fetched every run. For each location we keep a little history:
+how many new links it turned up per hour since its previous crawl, and how
+many gallery pages a crawl took, as exponentially weighted averages. The
+scheduler uses that to estimate how many new listings are waiting at each
+location right now. A location isn't due until about CRAWL_MIN_NEW_LINKS
+are expected there, and the due ones are crawled richest first, per page of
+effort, until the page budget (if there is one) runs out. Any location not
+crawled for MIN_REVISIT_HOURS goes to the front regardless, and ones we
+know nothing about yet are treated as worth a look.
+
+The gallery is only asked for listings posted in the last day
+(`postedToday=1`), so a location left for longer than that would lose
+listings for good. MIN_REVISIT_HOURS is therefore capped at a day less one
+CRAWL_INTERVAL_HOURS, so the budget can't push a location past its day, and
+a location that went longer anyway (the job was down, say) is crawled
+without the filter. Those full crawls only reset `last_crawled`; their
+links and pages would skew the moving averages.
+
+Both files live next to the job checkpoints.
+"""
+
+import json
+import os
+from datetime import datetime
+
+from checkpoints import CHECKPOINT_DIR, TIME_FORMAT, parse_time
+
+LOCATIONS_PATH = os.path.join(CHECKPOINT_DIR, "locations.json")
+STATS_PATH = os.path.join(CHECKPOINT_DIR, "location_stats.json")
+
+LOCATIONS_TTL_HOURS = float(os.getenv("LOCATIONS_TTL_HOURS", "168"))
+
+# How far back the gallery's postedToday filter reaches, and how often the
+# crawl runs
+POSTED_TODAY_HOURS = 24.0
+CRAWL_INTERVAL_HOURS = float(os.getenv("CRAWL_INTERVAL_HOURS", "1"))
+
+
+def revisit_hours(interval_hours, requested=None) :
+    """ The revisit floor for a crawl every `interval_hours`, at most a day less one interval."""
+    limit = POSTED_TODAY_HOURS - interval_hours
+    if requested is None or requested > limit :
+        return(limit)
+    return(requested)
+
+
+MIN_REVISIT_HOURS = revisit_hours(CRAWL_INTERVAL_HOURS,
+                                  float(os.getenv("MIN_REVISIT_HOURS")) if os.getenv("MIN_REVISIT_HOURS") else None)
+
+# A location isn't worth a crawl until this many new links are expected
+MIN_NEW_LINKS = float(os.getenv("CRAWL_MIN_NEW_LINKS", "10"))
+
+# Weight given to the newest run in the moving averages
+SMOOTHING = 0.3
+
+# What we assume for a location we haven't crawled yet
+DEFAULT_LINKS_PER_HOUR = 5.0
+DEFAULT_PAGES = 2.0
+
+
+def _read_json(path) :
+    if not os.path.exists(path) :
+        return(None)
+    try :
+        with open(path) as f :
+            return(json.load(f))
+    except (OSError, ValueError) as e :
+        print(f"Error reading {path}: {e}")
+        return(None)
+
+
+def _write_json(path, data) :
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f :
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _hours_since(ts, now) :
+    return((now - parse_time(ts)).total_seconds() / 3600)
+
+
+def load_locations(fetch_locations, ttl_hours=LOCATIONS_TTL_HOURS, path=LOCATIONS_PATH) :
+    """
+    The location -> url dictionary, from the cache if it's fresher than
+    `ttl_hours`, otherwise from `fetch_locations()` (which is then cached).
+    If the fetch fails we fall back to a stale cache rather than give up.
+    """
+    now = datetime.utcnow()
+    cached = _read_json(path)
+
+    if cached and _hours_since(cached["fetched_at"], now) < ttl_hours :
+        return(cached["locations"])
+
+    try :
+        locations = fetch_locations()
+    except Exception as e :
+        if cached :
+            print(f"Error fetching locations, using the cached list: {e}")
+            return(cached["locations"])
+        raise
+
+    _write_json(path, {"fetched_at": now.strftime(TIME_FORMAT), "locations": locations})
+
+    return(locations)
+
+
+class LocationStats :
+    """
+    Per-location crawl history: `last_crawled`, `links_per_hour` and
+    `pages`. The last two are moving averages.
+    """
+
+    def __init__(self, stats=None) :
+        self.stats = stats or {}
+
+    @classmethod
+    def load(cls, path=STATS_PATH) :
+        return(cls(_read_json(path)))
+
+    def save(self, path=STATS_PATH) :
+        _write_json(path, self.stats)
+
+    def record(self, location, new_links, pages, now=None, full=False) :
+        """
+        Fold one crawl of `location` into its history. A `full` crawl,
+        without postedToday, only moves `last_crawled`.
+        """
+        now = now or datetime.utcnow()
+        entry = self.stats.get(location)
+
+        if full and entry is not None :
+            entry["last_crawled"] = now.strftime(TIME_FORMAT)
+            return
+
+        if entry is None :
+            # No previous crawl to measure against; assume a day's worth.
+            hours = 24.0
+            self.stats[location] = entry = {
+                "links_per_hour": new_links / hours,
+                "pages": float(pages),
+                "runs": 0,
+            }
+        else :
+            hours = max(_hours_since(entry["last_crawled"], now), 0.25)
+            entry["links_per_hour"] += SMOOTHING * (new_links / hours - entry["links_per_hour"])
+            entry["pages"] += SMOOTHING * (pages - entry["pages"])
+
+        entry["runs"] += 1
+        entry["last_crawled"] = now.strftime(TIME_FORMAT)
+
+    def expected_new_links(self, location, now) :
+        entry = self.stats.get(location)
+        if entry is None :
+            return(DEFAULT_LINKS_PER_HOUR * MIN_REVISIT_HOURS)
+        return(entry["links_per_hour"] * _hours_since(entry["last_crawled"], now))
+
+    def expected_pages(self, location) :
+        entry = self.stats.get(location)
+        if entry is None :
+            return(DEFAULT_PAGES)
+        return(max(entry["pages"], 1.0))
+
+    def overdue(self, location, now, min_revisit_hours=MIN_REVISIT_HOURS) :
+        entry = self.stats.get(location)
+        return(entry is None or _hours_since(entry["last_crawled"], now) >= min_revisit_hours)
+
+    def lapsed(self, location, now) :
+        """ True if `location` went longer than the postedToday window since its last crawl."""
+        entry = self.stats.get(location)
+        return(entry is not None and _hours_since(entry["last_crawled"], now) >= POSTED_TODAY_HOURS)
+
+
+def schedule(locations, stats, page_budget=None, min_revisit_hours=MIN_REVISIT_HOURS, now=None,
+             min_new_links=MIN_NEW_LINKS) :
+    """
+    Order `locations` for this run. Overdue locations come first, then the
+    rest by expected new links per page, leaving out those expected to
+    have fewer than `min_new_links`. With a `page_budget` we stop adding
+    locations once their expected pages would go over it, though overdue
+    ones are always kept.
+    """
+    now = now or datetime.utcnow()
+
+    def priority(location) :
+        return(stats.expected_new_links(location, now) / stats.expected_pages(location))
+
+    overdue = [loc for loc in locations if stats.overdue(loc, now, min_revisit_hours)]
+    overdue_set = set(overdue)
+    rest = [loc for loc in locations
+            if loc not in overdue_set and stats.expected_new_links(loc, now) >= min_new_links]
+
+    # Sort by priority, then name, so the order is stable between runs
+    overdue.sort(key=lambda loc : (-priority(loc), loc))
+    rest.sort(key=lambda loc : (-priority(loc), loc))
+
+    if page_budget is None :
+        return(overdue + rest)
+
+    chosen = list(overdue)
+    pages = sum(stats.expected_pages(loc) for loc in overdue)
+
+    for location in rest :
+        cost = stats.expected_pages(location)
+        if pages + cost > page_budget :
+            continue
+        chosen.append(location)
+        pages += cost
+
+    return(chosen)
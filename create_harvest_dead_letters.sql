@@ -0,0 +1,12 @@
+-- One-off: links harvest_pages.py gave up on (see harvest_retry.py). `outcome`
+-- is "gone" for deleted or expired posts and "error"/"throttled" for links
+-- that ran out of retries; `status` is the last HTTP status, if there was one.
+CREATE TABLE IF NOT EXISTS `car-buying-272019.car_buying.harvest_dead_letters` (
+  url STRING,
+  location STRING,
+  row_created TIMESTAMP,
+  outcome STRING,
+  status INT64,
+  attempts INT64,
+  time_dead_lettered TIMESTAMP
+);
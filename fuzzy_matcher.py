@@ -0,0 +1,149 @@
+"""
+Fuzzy matching for misspelled models.
+
+Running the four fuzzywuzzy scorers over every target on every call is too
+slow to use on each listing. Instead we keep a character n-gram index per
+scope (normally the make), pull a short list of targets that share enough
+n-grams with the input, and only score that short list. Inputs are
+normalized and the results kept in a bounded LRU cache, since the same
+misspellings come up over and over. fuzzywuzzy's default processor
+lowercases what it scores anyway; only the exact-match check sees the
+input as given, like the old `process.extract` calls.
+"""
+
+from collections import Counter, OrderedDict
+import re
+
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import process
+
+SCORERS = [fuzz.ratio, fuzz.partial_ratio, fuzz.token_sort_ratio, fuzz.token_set_ratio]
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text) :
+    """ Lowercase and collapse whitespace so near-identical inputs share a cache entry."""
+    if text is None :
+        return(None)
+    return(_whitespace.sub(" ", text.lower()).strip())
+
+
+def ngrams(text, n=3) :
+    """ Character n-grams of `text`, padded so short strings still get a few."""
+    padded = f" {text} "
+    if len(padded) <= n :
+        return({padded})
+    return({padded[i:i+n] for i in range(len(padded) - n + 1)})
+
+
+class FuzzyIndex :
+    """
+    `targets_by_scope` maps a scope (e.g. a make) to the strings we can
+    match within it. Use `None` as the scope for a single flat list.
+    """
+
+    def __init__(self, targets_by_scope, n=3, shortlist_size=10,
+                 min_overlap=0.3, cache_size=10000) :
+        self.n = n
+        self.shortlist_size = shortlist_size
+        self.min_overlap = min_overlap
+        self.cache_size = cache_size
+
+        # scope -> sorted list of targets, and scope -> gram -> target positions
+        self.targets = {}
+        self.index = {}
+        self.target_gram_counts = {}
+
+        for scope, targets in targets_by_scope.items() :
+            targets = sorted(t for t in set(targets) if t)
+            grams_to_targets = {}
+            gram_counts = []
+
+            for pos, target in enumerate(targets) :
+                target_grams = ngrams(target, n)
+                gram_counts.append(len(target_grams))
+                for gram in target_grams :
+                    grams_to_targets.setdefault(gram, []).append(pos)
+
+            self.targets[scope] = targets
+            self.index[scope] = grams_to_targets
+            self.target_gram_counts[scope] = gram_counts
+
+        self._cache = OrderedDict()
+
+    def clear_cache(self) :
+        """ Forget the cached matches, e.g. to time matching from cold."""
+        self._cache.clear()
+
+    def shortlist(self, text, scope=None) :
+        """
+        Targets in `scope` that share n-grams with `text`, ranked by how
+        much of the target shows up in the input. Measuring containment of
+        the target (rather than plain overlap) keeps short models like
+        "f150" in the running for long titles, which `partial_ratio` needs.
+        """
+        targets = self.targets.get(scope)
+        if not targets :
+            return([])
+
+        grams_to_targets = self.index[scope]
+        gram_counts = self.target_gram_counts[scope]
+
+        shared = Counter()
+        for gram in ngrams(text, self.n) :
+            shared.update(grams_to_targets.get(gram, ()))
+
+        candidates = []
+        for pos, count in shared.items() :
+            overlap = count / gram_counts[pos]
+            if overlap >= self.min_overlap :
+                candidates.append((-overlap, targets[pos]))
+
+        candidates.sort()
+        return([target for _, target in candidates[:self.shortlist_size]])
+
+    def _score(self, text, scope, score_cutoff, top_n) :
+        shortlist = self.shortlist(text, scope)
+        if not shortlist :
+            return([])
+
+        best_scores = {}
+        for scorer in SCORERS :
+            for match, score in process.extract(text, shortlist, scorer=scorer, limit=top_n) :
+                if score >= score_cutoff and score > best_scores.get(match, -1) :
+                    best_scores[match] = score
+
+        # Highest score first, ties broken alphabetically so the order is stable
+        return([match for match, _ in sorted(best_scores.items(), key=lambda kv : (-kv[1], kv[0]))])
+
+    def match(self, input_str, scope=None, score_cutoff=90, top_n=3) :
+        """ Return the targets in `scope` that score at least `score_cutoff`, best first."""
+        if not input_str :
+            return([])
+
+        targets = self.targets.get(scope)
+        if targets is None :
+            return([])
+
+        # Check for exact match first, on the input as given, so "F150"
+        # isn't an exact match for "f150"
+        if input_str in targets :
+            return([input_str])
+
+        text = normalize(input_str)
+        if not text :
+            return([])
+
+        key = (text, scope, score_cutoff, top_n)
+        if key in self._cache :
+            self._cache.move_to_end(key)
+            return(list(self._cache[key]))
+
+        matches = self._score(text, scope, score_cutoff, top_n)
+
+        self._cache[key] = tuple(matches)
+        if len(self._cache) > self.cache_size :
+            self._cache.popitem(last=False)
+
+        return(matches)
@@ -0,0 +1,198 @@
+"""
+One place for the jobs to write rows to BigQuery.
+
+`upload_to_gbq` used to be pasted into every script. It looked up the table
+on every call and sent everything in a single `insert_rows_json` request,
+which broke on big batches of raw html and only printed partial failures.
+Here table handles are cached, rows are split into chunks by row count and
+payload size, chunks go out concurrently with retries on transient errors,
+and the rows that still fail are handed back so callers can re-queue them.
+
+Each row gets an insertId from its table and contents, the same on every
+attempt, so a retry of a request that timed out but was committed is
+dropped by BigQuery's de-duplication instead of writing the rows twice.
+"""
+
+import hashlib
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from google.api_core import exceptions as api_exceptions
+
+# Streaming inserts are capped at 10MB per request; stay well under it.
+MAX_CHUNK_ROWS = 500
+MAX_CHUNK_BYTES = 5 * 1024 * 1024
+
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_WORKERS = 4
+
+# Errors worth trying again rather than giving up on.
+TRANSIENT_EXCEPTIONS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    ConnectionError,
+    TimeoutError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+# Per-row error reasons that mean "try again" rather than "bad row". Rows
+# that were fine but rejected because another row in the request was bad
+# come back as "stopped".
+TRANSIENT_REASONS = {"stopped", "backendError", "internalError", "timeout", "rateLimitExceeded"}
+
+_table_cache = {}
+
+
+def get_table(client, dataset_id, table_name) :
+    """ Look up a table once per client and reuse the handle."""
+    key = (id(client), dataset_id, table_name)
+
+    if key not in _table_cache :
+        table_ref = client.dataset(dataset_id).table(table_name)
+        _table_cache[key] = client.get_table(table_ref)
+
+    return(_table_cache[key])
+
+
+def row_size(row) :
+    return(len(json.dumps(row, default=str).encode("utf-8")))
+
+
+def row_id(table_name, row) :
+    """ A stable insertId for `row`: the same row sent to the same table always gets the same one."""
+    payload = json.dumps(row, default=str, sort_keys=True)
+    return(hashlib.sha1(f"{table_name}\n{payload}".encode("utf-8")).hexdigest())
+
+
+def chunk_rows(rows, max_rows=MAX_CHUNK_ROWS, max_bytes=MAX_CHUNK_BYTES) :
+    """
+    Yield lists of row indices, each under `max_rows` rows and `max_bytes`
+    of JSON. A single row bigger than `max_bytes` goes out on its own.
+    """
+    chunk = []
+    chunk_bytes = 0
+
+    for idx, row in enumerate(rows) :
+        size = row_size(row)
+
+        if chunk and (len(chunk) >= max_rows or chunk_bytes + size > max_bytes) :
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(idx)
+        chunk_bytes += size
+
+    if chunk :
+        yield chunk
+
+
+def _is_transient(errors) :
+    return(all(error.get("reason") in TRANSIENT_REASONS for error in errors))
+
+
+def _insert_chunk(client, table, rows, row_ids, indices, max_retries, backoff_seconds) :
+    """
+    Insert the rows at `indices`, retrying transient failures with the
+    same `row_ids`. Returns a dict of index -> list of errors for the rows
+    that didn't make it.
+    """
+    pending = list(indices)
+    failures = {}
+    last_errors = {}
+
+    for attempt in range(max_retries + 1) :
+        if attempt :
+            # exponential backoff with a little jitter
+            time.sleep(backoff_seconds * (2 ** (attempt - 1)) * (1 + random.random()))
+
+        try :
+            errors = client.insert_rows_json(table, [rows[idx] for idx in pending],
+                                             row_ids=[row_ids[idx] for idx in pending])
+        except TRANSIENT_EXCEPTIONS as e :
+            last_errors = {idx: [{"reason": "exception", "message": str(e)}] for idx in pending}
+            continue
+        except Exception as e :
+            # Anything else won't get better by retrying
+            failures.update({idx: [{"reason": "exception", "message": str(e)}] for idx in pending})
+            return(failures)
+
+        retry = []
+        last_errors = {}
+
+        for error in errors :
+            idx = pending[error["index"]]
+            if _is_transient(error["errors"]) :
+                retry.append(idx)
+                last_errors[idx] = error["errors"]
+            else :
+                failures[idx] = error["errors"]
+
+        if not retry :
+            return(failures)
+
+        pending = retry
+
+    # Out of retries; whatever is still pending has failed.
+    failures.update({idx: last_errors.get(idx, [{"reason": "retries exhausted"}]) for idx in pending})
+
+    return(failures)
+
+
+def write_rows(client, data, dataset_id, table_name,
+               max_rows=MAX_CHUNK_ROWS,
+               max_bytes=MAX_CHUNK_BYTES,
+               max_workers=MAX_WORKERS,
+               max_retries=MAX_RETRIES,
+               backoff_seconds=BACKOFF_SECONDS) :
+    """
+    Insert `data` into `dataset_id.table_name` in chunks. Returns a list of
+    {'index', 'row', 'errors'} dicts for rows that could not be inserted,
+    in the order they appeared in `data`.
+    """
+    if not data :
+        return([])
+
+    table = get_table(client, dataset_id, table_name)
+    chunks = list(chunk_rows(data, max_rows=max_rows, max_bytes=max_bytes))
+    row_ids = [row_id(table_name, row) for row in data]
+
+    failures = {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as executor :
+        futures = [executor.submit(_insert_chunk, client, table, data, row_ids, chunk,
+                                   max_retries, backoff_seconds)
+                   for chunk in chunks]
+
+        for future in futures :
+            failures.update(future.result())
+
+    return([{"index": idx, "row": data[idx], "errors": failures[idx]} for idx in sorted(failures)])
+
+
+def upload_to_gbq(client,data,dataset_id,table_name) :
+    """
+    Insert `data` and report how it went. Returns the number of rows that
+    were inserted; use `write_rows` to get the failed rows back.
+    """
+
+    if not data :
+        return(0)
+
+    failures = write_rows(client, data, dataset_id, table_name)
+
+    if not failures :
+        print(f"{len(data)} row inserted successfully to {table_name}.")
+    else :
+        print(f"Errors occurred while inserting {len(failures)} of {len(data)} rows to {table_name}:",
+              [failure["errors"] for failure in failures])
+
+    return(len(data) - len(failures))
@@ -9,12 +9,17 @@ import os
 
 
 from bs4 import BeautifulSoup
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from selenium.common.exceptions import WebDriverException
 
-from google.cloud import bigquery
-from google.oauth2 import service_account
-
-import socket
+from checkpoints import TIME_FORMAT, load_checkpoint, needs_reconcile, parse_time, save_checkpoint
+from seen_index import SEEN_INDEX_PATH, SeenIndex
+from browser_pool import BrowserPool
+from crawl_schedule import LocationStats, load_locations, schedule
+from instrumentation import RunMetrics
+from warehouse import connect_warehouse
 
 
 
@@ -47,62 +52,50 @@ def dedupe_links(links,recent_links) :
     
     return(links)
 
-def upload_to_gbq(client,data,dataset_id,table_name) :
-
-    if not data : 
-        return(0)
-
-    table_ref = client.dataset(dataset_id).table(table_name)
-    table = client.get_table(table_ref)
-    errors = client.insert_rows_json(table, data)
-
-    if errors == []:
-        print(f"{len(data)} row inserted successfully to {table_name}.")
-    else:
-        print("Errors occurred while inserting rows:", errors)
-
-    return(len(data))
     
     
-def get_recent_pulls(client) :
+def get_recent_pulls(warehouse, since=None) :
     
     # 
-    # Now I'm going to just put all the links in a set rather than
-    # splitting them by location. Upper bound on size is about 6K*30 < 200K 
-    # so it should be fine. 
+    # Returns a dictionary of url -> when we first saw it, covering the
+    # last 30 days of raw_listing_pages plus everything waiting in
+    # links_need_harvesting. If `since` is given we only read rows at or
+    # after it, to top up the cached copy from the last run.
     
-    query = """
-        SELECT location, url 
-        FROM `car-buying-272019.car_buying.raw_listing_pages` 
-        WHERE datetime_pulled > DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
-    """
-
-    query_job = client.query(query,
-                             location = "US")
-
-    rows = query_job.result()  # Wait for the job to complete.
-
-    pulls = set()
-
-    for row in rows : 
-        location, url = row
-        pulls.add(url)
-
-
-    query = """
-        SELECT DISTINCT url 
-        FROM `car-buying-272019.car_buying.links_need_harvesting` 
-    """
+    return(warehouse.recent_pulls(since))
 
-    query_job = client.query(query,
-                             location = "US")
 
-    rows = query_job.result()  # Wait for the job to complete.
-
-    for row in rows : 
-        pulls.add(row[0])
+def load_recent_pulls(warehouse) :
+    
+    # The listings we've seen are kept between runs in a compact on-disk
+    # index keyed on post ID (see seen_index), so normally we only query
+    # for rows added since the last run. Entries expire after 30 days.
+    # Every so often we rebuild it from scratch in case something was
+    # missed.
+    
+    checkpoint = load_checkpoint("getting_links")
+    query_started = datetime.utcnow()
+    
+    if needs_reconcile(checkpoint) or not os.path.exists(SEEN_INDEX_PATH) : 
+        seen_index = SeenIndex()
+        seen_index.update(get_recent_pulls(warehouse))
+        checkpoint = {'last_reconcile': query_started.strftime(TIME_FORMAT)}
+    else : 
+        seen_index = SeenIndex.load()
+        # Rows are stamped before they're inserted, so step the watermark
+        # back a bit to catch late arrivals. Re-reading a few is harmless.
+        since = parse_time(checkpoint['watermark']) - timedelta(minutes=30)
+        seen_index.update(get_recent_pulls(warehouse, since))
+    
+    seen_index.save()
+    
+    checkpoint['watermark'] = query_started.strftime(TIME_FORMAT)
+    checkpoint.pop('urls', None)
+    save_checkpoint("getting_links", checkpoint)
     
-    return(pulls)
+    print(f"Seen index holds {len(seen_index)} recent listings.")
+    
+    return(seen_index)
     
 def get_all_locations() :
     # URL for all Craigslist locations
@@ -125,122 +118,222 @@ def get_all_locations() :
     return(locations)    
 
 
+@contextmanager
+def _untimed(name) : 
+    yield
+
+
+def crawl_location(pool, location, location_url, metrics=None, posted_today=True) :
+    
+    # Page through the gallery for one location and return every listing
+    # link on it. If the browser drops mid-crawl we get a fresh one from
+    # the pool and try the location once more.
+    
+    for attempt in range(2) : 
+        try : 
+            with pool.session() as driver : 
+                return(crawl_location_pages(driver, location, location_url, metrics, posted_today))
+        except WebDriverException as e : 
+            print(f"Browser error on {location} (attempt {attempt + 1}): {e}")
+            if metrics is not None : 
+                metrics.count("browser_errors")
+    
+    return([], 0)
+
+
+def crawl_location_pages(driver, location, location_url, metrics=None, posted_today=True) :
+    
+    # Returns the links and how many gallery pages it took to get them.
+    # With `metrics`, page loads, link extraction and the pauses between
+    # pages are timed per page, and the page source size is counted.
+    # Without `posted_today` the whole gallery is paged through, for a
+    # location that's gone longer than a day since its last crawl.
+    
+    location_links = list()
+    timed = metrics.timed if metrics is not None else _untimed
+    
+    # Append the base query to the city URL
+    if posted_today : 
+        base_url = location_url + "/search/cta?bundleDuplicates=1&postedToday=1&purveyor=owner"
+    else : 
+        base_url = location_url + "/search/cta?bundleDuplicates=1&purveyor=owner"
+    page = 0 
+    
+    while True : 
+        # Append the page number to the URL
+        request_url = base_url + "#search=1~gallery~" + str(page) + "~0"
+        
+        print(f"requesting {request_url}")
+        
+        with timed("gallery_page") : 
+            driver.get(request_url)
+
+        with timed("sleep") : 
+            time.sleep(1 + random.random())
+
+        page_source = driver.page_source
+        
+        with timed("extract_links") : 
+            links = get_listing_urls(page_source, location)
+        
+        if metrics is not None : 
+            metrics.count("gallery_pages")
+            metrics.count("bytes_fetched", len(page_source.encode("utf-8")))
+        
+        print(f"Returned {len(links)} links")
+        
+        if not links or (set(links).issubset(set(location_links))):
+            break
+        else : 
+            location_links.extend(links)        
+            
+        print(f"Total links: {len(location_links)}")
+
+        page += 1
+        
+        with timed("sleep") : 
+            time.sleep(random.random() + 0.25)
+    
+    return(location_links, page + 1)
+
+
+def crawl_locations(locations, scheduled, pool_size=1, max_locations=25, metrics=None, lapsed=()) :
+    
+    # Crawl the `scheduled` locations over a pool of `pool_size` long-lived
+    # headless sessions, each recycled after `max_locations` locations or
+    # when it drops. Yields (location, links, pages) as each one finishes,
+    # so the caller can de-dupe and upload on its own thread. `metrics` is
+    # passed on to each crawl. Locations in `lapsed` are crawled without
+    # the postedToday filter.
+    
+    with BrowserPool(size=pool_size, max_uses=max_locations) as pool, \
+         ThreadPoolExecutor(max_workers=pool_size) as executor : 
+
+        futures = {executor.submit(crawl_location, pool, location, locations[location], metrics,
+                                   location not in lapsed) : location
+                   for location in scheduled}
+
+        try : 
+            for future in as_completed(futures) : 
+                location = futures[future]
+
+                try : 
+                    location_links, pages = future.result()
+                except Exception as e : 
+                    print(f"Error crawling {location}: {e}")
+                    continue
+                
+                yield(location, location_links, pages)
+        finally : 
+            # If the caller stops early, don't crawl the rest on the way out
+            for future in futures : 
+                future.cancel()
+
+
+def new_link_rows(location_links, location, seen_index) :
+    
+    # Rows for `links_need_harvesting`, for the links we haven't seen in
+    # the last month. Each one is added to `seen_index` as we go.
+    
+    upload_data = list()
+    
+    for link in dedupe_links(location_links, seen_index) : 
+        row_data = {
+            "url": link,
+            "location": location,
+            "row_created": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        
+        upload_data.append(row_data)
+        seen_index.add(link, row_data["row_created"])
+    
+    return(upload_data)
+
+
 def main() : 
 
-    start = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    # Stage timings, page load times and bytes fetched for the log row
+    metrics = RunMetrics("getting_links")
 
-    # Get all the locations. At some point maybe we store this and update 
-    # it? Maybe it doesn't matter, since it runs instantly.
-    locations = get_all_locations()
+    # Get all the locations. The list is cached for LOCATIONS_TTL_HOURS, and
+    # we crawl them in order of how many new listings we expect to find,
+    # up to CRAWL_PAGE_BUDGET gallery pages (see crawl_schedule).
+    with metrics.stage("locations") : 
+        locations = load_locations(get_all_locations)
+        location_stats = LocationStats.load()
+        
+        page_budget = os.getenv("CRAWL_PAGE_BUDGET")
+        scheduled = schedule(list(locations), location_stats,
+                             page_budget=float(page_budget) if page_budget else None)
+        
+        # Locations that went past the postedToday window get their whole gallery
+        now = datetime.utcnow()
+        lapsed = {location for location in scheduled if location_stats.lapsed(location, now)}
+    
+    print(f"Crawling {len(scheduled)} of {len(locations)} locations this run, "
+          f"{len(lapsed)} of them in full.")
 
     # Now let's go get all the listings we've found over the last month. 
     # That will prevent us from pulling duplicates. 
 
-    # dotenv stuff
-    service_path = os.getenv("SERVICE_PATH")
-    service_file = os.getenv("SERVICE_FILE")     
-    gbq_proj_id = os.getenv("GBQ_PROJECT_ID") 
-    dataset_id = os.getenv("GBQ_DATASET_ID")
-
-    credentials = service_account.Credentials.from_service_account_file(service_path + service_file)
-
-    client = bigquery.Client(credentials = credentials, project=gbq_proj_id)    
+    # BigQuery by default; set WAREHOUSE=sqlite to run against a local copy.
+    with metrics.stage("connect") : 
+        warehouse = connect_warehouse()
     
-    last_month_pulls = get_recent_pulls(client)    
+    with metrics.stage("read_recent_pulls") : 
+        last_month_pulls = load_recent_pulls(warehouse)    
     total_listing_links = 0
 
 
-    # Now we'll iterate over the locations. For each location we'll do the following: 
+    # Now we'll crawl the locations. For each location we'll do the following: 
     # 
     # 1. Get the links from the last day.
     # 2. Ignore any that are duplicates for that location
     # 3. Load the links into `links_need_harvesting`
+    #
+    # Locations are spread over a pool of BROWSER_POOL_SIZE long-lived
+    # headless sessions, each recycled after BROWSER_MAX_LOCATIONS locations
+    # or when it drops. De-duping and uploads stay on this thread.
 
-    service = ChromeService()
-    
-    # Set options
-    options = webdriver.ChromeOptions()
-    options.add_argument('--headless')
-    options.add_argument("--no-sandbox")
+    pool_size = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+    max_locations = int(os.getenv("BROWSER_MAX_LOCATIONS", "25"))
 
+    # Time spent waiting on the browsers is charged to "crawl"
+    crawled = crawl_locations(locations, scheduled, pool_size, max_locations, metrics=metrics,
+                              lapsed=lapsed)
     
-    for idx, location in enumerate(locations) :
-        location_url = locations[location]
-        
-        # Drivers seem to get disconnected after a while, so we'll reconnect for each 
-        # location. 
-        driver = webdriver.Chrome(service=service, options=options)
+    for location, location_links, pages in metrics.iterate("crawl", crawled) : 
         
-        location_links = list()
+        # De-dupe links
+        with metrics.stage("dedupe") : 
+            upload_data = new_link_rows(location_links, location, last_month_pulls)
+        print(f"{location}: post de-duping we have {len(upload_data)} total links.")
         
-        # Append the base query to the city URL
-        base_url = location_url + "/search/cta?bundleDuplicates=1&postedToday=1&purveyor=owner"
-        page = 0 
+        metrics.count("locations_crawled")
+        metrics.count("links_found", len(location_links))
+        metrics.count("links_new", len(upload_data))
         
-        while True : 
-            # Append the page number to the URL
-            request_url = base_url + "#search=1~gallery~" + str(page) + "~0"
-            
-            print(f"requesting {request_url}")
-            
-            driver.get(request_url)
-    
-            time.sleep(1 + random.random())
-    
-            links = get_listing_urls(driver.page_source, location)
-            
-            print(f"Returned {len(links)} links")
-            
-            if not links or (set(links).issubset(set(location_links))):
-                break
-            else : 
-                location_links.extend(links)        
-                
-            print(f"Total links: {len(location_links)}")
-    
-            page += 1
-            
-            time.sleep(random.random() + 0.25)
-                
-        
-        # De-dupe links
-        location_links = dedupe_links(location_links,last_month_pulls)
-        print(f"Post de-duping we have {len(location_links)} total links.")
+        if pages : 
+            location_stats.record(location, len(upload_data), pages, full=location in lapsed)
         
-        total_listing_links += len(location_links)
+        total_listing_links += len(upload_data)
         
         # upload links
-        upload_data = list()
-        
-        for link in location_links : 
-            row_data = {
-                "url": link,
-                "location": location,
-                "row_created": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            
-            upload_data.append(row_data)
-            
-        upload_to_gbq(client,upload_data,dataset_id,'links_need_harvesting')
+        with metrics.stage("insert"), metrics.timed("insert_batch") : 
+            warehouse.upload('links_need_harvesting',upload_data)
                     
         print("-"*45)
-        driver.quit()
-        
-#        if idx > 10 :
-#            break
     
     
-    log_row = [{
-        'task' : "getting_links",
-        'time_started' : start,
-        'time_finished' : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-        'notes' : f"pulled {total_listing_links} links on {hostname}."
-    }]
+    # Keep what we found this run so the next one doesn't need to ask for it
+    with metrics.stage("save_state") : 
+        last_month_pulls.save()
+        location_stats.save()
     
-    upload_to_gbq(client,log_row,dataset_id,'log')
+    metrics.finish(warehouse, f"pulled {total_listing_links} links on {metrics.hostname}.")
 
 
-    client.close()
+    warehouse.close()
 
 
 if __name__ == '__main__':
@@ -13,143 +13,254 @@ import time
 from datetime import datetime
 import random
 import requests
-import socket
 import os
 
 
-from google.cloud import bigquery
-from google.oauth2 import service_account
+from batch_sizing import BatchSizer
+from checkpoints import advance_checkpoint, load_checkpoint, needs_reconcile, save_checkpoint
+from async_harvest import TIMEOUT_SECONDS, harvest_async
+from harvest_retry import DEAD_LETTER_TABLE, ERROR, OK, SKIPPED, RetryQueue, classify
+from instrumentation import RunMetrics
+from raw_page_codec import encode_page
+from warehouse import connect_warehouse
 
-def get_urls_to_harvest(client) : 
-    
-    query = """
-        SELECT url, location
-        FROM `car-buying-272019.car_buying.links_need_harvesting` 
-        WHERE url NOT IN (
-            SELECT DISTINCT url 
-            FROM `car-buying-272019.car_buying.raw_listing_pages`)
-        ORDER BY row_created ASC
-        LIMIT 130
-        """
-
-    query_job = client.query(query,
-                             location = "US")
-    
-    rows = query_job.result()  # Wait for the job to complete.
-    
-    urls = []
+def get_urls_to_harvest(warehouse, checkpoint=None, limit=130, exclude=()) : 
+    """
+    Returns (url, location, row_created) for the oldest links that still
+    need harvesting, leaving out the urls in `exclude`. With no checkpoint
+    this anti-joins against the whole of raw_listing_pages; with one we
+    only read links created at or after its watermark.
+    """
     
-    for row in rows : 
-        url, location = row
+    if checkpoint is None : 
+        return(warehouse.links_to_harvest(limit, exclude=exclude))
         
-        urls.append((url,location))
-        
-    return(urls)
+    return(warehouse.links_to_harvest(limit,
+                                      watermark=checkpoint['watermark'],
+                                      in_flight=checkpoint.get('in_flight', []),
+                                      exclude=exclude))
     
 
-def upload_to_gbq(client,data,dataset_id,table_name) :
 
-    if not data : 
-        return(0)
+def delete_harvested_links(warehouse, pulled_links) :
+    # once we've requested the pages, we remove the links 
+    # from the "links needing harvesting" table
+    
+    warehouse.delete_harvested_links(pulled_links)
 
-    table_ref = client.dataset(dataset_id).table(table_name)
-    table = client.get_table(table_ref)
-    errors = client.insert_rows_json(table, data)
 
-    if errors == []:
-        print(f"{len(data)} row inserted successfully to {table_name}.")
-    else:
-        print("Errors occurred while inserting rows:", errors)
 
-    return(len(data))
 
-def delete_harvested_links(client, pulled_links) :
-    # once we've requested the pages, we remove the links 
-    # from the "links needing harvesting" table
+def _get(link) : 
+    """ (status, text) for a link, or (None, None) if the request itself failed."""
+    
+    try : 
+        response = requests.get(link, timeout=TIMEOUT_SECONDS)
+    except requests.RequestException as e : 
+        print(f"Error fetching {link}: {e}")
+        return(None, None)
+    
+    return(response.status_code, response.text)
+
+
+def harvest_serial(links, metrics=None, backoff=None) : 
+    """
+    Fetch one page at a time with a polite pause after each. Returns
+    (link, location, datetime_pulled, status, text) tuples like
+    `harvest_async`. With `metrics`, each request's latency is recorded
+    and the pauses are charged to a "sleep" stage. With a HostBackoff as
+    `backoff`, links on a host that's throttling us aren't fetched and
+    come back with status SKIPPED.
+    """
+    
+    results = []
+    
+    for idx, link_tuple in enumerate(links) : 
+        link, location = link_tuple
+        
+        if backoff is not None and backoff.waiting(location) : 
+            results.append((link, location, None, SKIPPED, None))
+            continue
+        
+        if metrics is None : 
+            status, text = _get(link)
+            time.sleep(1 + random.random())
+        else : 
+            with metrics.timed("http_get") : 
+                status, text = _get(link)
+            with metrics.stage("sleep") : 
+                time.sleep(1 + random.random())
+        
+        if backoff is not None : 
+            backoff.record(location, classify(status, text))
     
+        current_datetime = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")    
     
-    query = """
-    DELETE FROM `car-buying-272019.car_buying.links_need_harvesting` 
-    WHERE url IN (
-      SELECT url FROM `car-buying-272019.car_buying.links_need_harvesting`
-      WHERE url IN UNNEST(@pulled_links)
-    )
+        results.append((link, location, current_datetime, status, text))
+        
+    return(results)
+
+
+def pages_to_rows(fetched) : 
+    """
+    Turn (link, location, datetime_pulled, status, text) tuples into
+    raw_listing_pages rows. Returns (rows, failed_links). Only responses
+    harvest_retry.classify calls OK are stored; the other links fail.
     """
     
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ArrayQueryParameter("pulled_links", "STRING", pulled_links)
-        ]
-    )
+    # RAW_PAGE_FORMAT controls how much of each page we keep; see
+    # raw_page_codec. The parser reads every format.
+    rows_to_insert = []
+    failed_links = set()
+    
+    for link, location, current_datetime, status, listing_page in fetched : 
+        if classify(status, listing_page) != OK : 
+            failed_links.add(link)
+            continue
     
-    try:
-        query_job = client.query(query, job_config=job_config)
-        query_job.result()  # Wait for the query to complete
-        print("Deletion completed successfully.")
-    except Exception as e:
-        print("Error occurred during deletion:", str(e))
+        rows_to_insert.append({
+            "url": link,  
+            "datetime_pulled": current_datetime,
+            "raw_html": encode_page(listing_page),
+            "location": location  
+        })
+        
+    return(rows_to_insert, failed_links)
 
 
+def record_fetches(metrics, fetched) : 
+    """ Count HTTP statuses and bytes fetched for (link, location, datetime_pulled, status, text) tuples."""
+    
+    for _, _, _, status, text in fetched : 
+        metrics.http_status(status)
+        if text is not None : 
+            metrics.count("bytes_fetched", len(text.encode("utf-8")))
 
 
 def main() : 
     
-    start = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    # Stage timings, fetch latencies, statuses and bytes for the log row
+    metrics = RunMetrics("harvesting_pages")
     
-    # dotenv stuff
-    service_path = os.getenv("SERVICE_PATH")
-    service_file = os.getenv("SERVICE_FILE")     
-    gbq_proj_id = os.getenv("GBQ_PROJECT_ID") 
-    dataset_id = os.getenv("GBQ_DATASET_ID")
-
+    # BigQuery by default; set WAREHOUSE=sqlite to run against a local copy.
+    with metrics.stage("connect") : 
+        warehouse = connect_warehouse()
     
-    credentials = service_account.Credentials.from_service_account_file(service_path + service_file)
+    # Only look at links past the last watermark, with a full anti-join
+    # against raw_listing_pages every so often as a safety net.
+    checkpoint = load_checkpoint("harvesting_pages")
+    reconcile = needs_reconcile(checkpoint)
     
-    client = bigquery.Client(credentials = credentials, project=gbq_proj_id)    
+    # Links that failed before wait here, past the watermark, until their
+    # retry or their host's backoff is due.
+    retry_queue = RetryQueue.from_checkpoint(checkpoint)
     
-    links = get_urls_to_harvest(client)
+    # HARVEST_MODE=async fetches many subdomains at once, each behind its
+    # own rate limit, so it can take a much bigger batch per run.
+    harvest_mode = os.getenv("HARVEST_MODE", "serial")
     
-    if len(links) > 0 : 
+    # Size the batch to finish in HARVEST_TARGET_SECONDS at the rate recent
+    # runs in this mode managed, with every fetched page held in memory
+    # until the insert. HARVEST_LIMIT pins the size instead.
+    sizer = BatchSizer(f"harvesting_pages_{harvest_mode}",
+                       target_seconds=float(os.getenv("HARVEST_TARGET_SECONDS", "240")),
+                       memory_bytes=float(os.getenv("HARVEST_MEMORY_MB", "512")) * 2**20,
+                       initial=130,
+                       minimum=int(os.getenv("HARVEST_BATCH_MIN", "10")),
+                       maximum=int(os.getenv("HARVEST_BATCH_MAX", "5000")))
+    
+    if os.getenv("HARVEST_LIMIT") : 
+        limit = int(os.getenv("HARVEST_LIMIT"))
+    else : 
+        limit = sizer.size()
+    
+    # Due retries go first and new links fill the rest of the batch. Links
+    # in the queue are left out of the query, or a reconcile would find the
+    # oldest of them again and fill the batch with them.
+    with metrics.stage("read_links") : 
+        retries = retry_queue.due(limit)
+        new_links = []
+        queried = limit > len(retries)
+        if queried : 
+            new_links = get_urls_to_harvest(warehouse, None if reconcile else checkpoint,
+                                            limit=limit - len(retries),
+                                            exclude=list(retry_queue.entries))
     
-        table_id = "car-buying-272019.car_buying.raw_listing_pages"
+    links = retries + new_links
     
-        rows_to_insert = []
+    if len(links) > 0 : 
+    
+        to_fetch = [(link, location) for link, location, _ in links]
+        work_start = time.perf_counter()
         
-        for idx, link_tuple in enumerate(links) : 
-            link, location = link_tuple
-            
-            response = requests.get(link)
-            time.sleep(1 + random.random())
+        with metrics.stage("fetch") : 
+            if harvest_mode == "async" : 
+                fetched = harvest_async(to_fetch, metrics=metrics, backoff=retry_queue.backoff)
+            else : 
+                fetched = harvest_serial(to_fetch, metrics=metrics, backoff=retry_queue.backoff)
+        
+        record_fetches(metrics, fetched)
+        
+        with metrics.stage("encode") : 
+            rows_to_insert, failed_links = pages_to_rows(fetched)
         
-            listing_page = response.text
-            current_datetime = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")    
+        metrics.count("bytes_stored", sum(len(row["raw_html"]) for row in rows_to_insert))
         
-            rows_to_insert.append({
-                "url": link,  
-                "datetime_pulled": current_datetime,
-                "raw_html": listing_page,
-                "location": location  
-            })
+        # The writer splits the pages into size-limited chunks and hands back
+        # whatever it couldn't store.
+        with metrics.stage("insert") : 
+            failures = warehouse.append_rows('raw_listing_pages', rows_to_insert)
+        failed_links.update(failure['row']['url'] for failure in failures)
         
+        metrics.count("pages_stored", len(rows_to_insert) - len(failures))
+        metrics.count("pages_failed", len(failed_links))
         
+        outcomes = {link : classify(status, text) for link, _, _, status, text in fetched}
+        statuses = {link : status for link, _, _, status, _ in fetched}
         
-        errors = client.insert_rows_json(table_id, json_rows=rows_to_insert)
+        # A page we fetched but couldn't store is retried like a failed request
+        for failure in failures : 
+            outcomes[failure['row']['url']] = ERROR
+        
+        for outcome in outcomes.values() : 
+            metrics.count(f"harvest_{outcome}")
+        
+        dead_letters = retry_queue.settle(links, outcomes, statuses)
+        
+        # Dead letters are kept for a look later and taken out of
+        # links_need_harvesting; if they can't be stored the links stay put
+        # and a reconcile brings them back.
+        if dead_letters : 
+            with metrics.stage("dead_letter") : 
+                stored = warehouse.upload(DEAD_LETTER_TABLE, dead_letters)
+                if stored == len(dead_letters) : 
+                    warehouse.delete_harvested_links([row["url"] for row in dead_letters])
+            metrics.count("dead_lettered", len(dead_letters))
+        
+        sizer.record(len(links), time.perf_counter() - work_start,
+                     time.perf_counter() - metrics.started, metrics.counters["bytes_fetched"])
             
-        if errors == []:
+        if not failures:
             print(f"{len(rows_to_insert)} rows inserted successfully in raw_listing_pages.")
         else:
-            print("Errors occurred while inserting rows:", errors)
+            print(f"Errors occurred while inserting {len(failures)} rows:",
+                  [failure['errors'] for failure in failures])
         
         
         
-        log_row = [{
-            'task' : "harvesting_pages",
-            'time_started' : start,
-            'time_finished' : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
-            'notes' : f"harvested {len(rows_to_insert)} pages on {hostname}"
-        }]
+        metrics.finish(warehouse, f"harvested {len(rows_to_insert) - len(failures)} pages "
+                                  f"({len(retries)} links retried), {len(retry_queue)} waiting to retry, "
+                                  f"{len(dead_letters)} dead-lettered on {metrics.hostname}")
         
-        upload_to_gbq(client,log_row,dataset_id,'log')
+    # Every new link is now stored, queued for a retry or dead-lettered, so
+    # the watermark can pass all of them. A reconcile that didn't get to
+    # query, because retries filled the batch, is left for the next run.
+    consumed = [(link, row_created) for link, _, row_created in new_links]
+    save_checkpoint("harvesting_pages",
+                    retry_queue.save_to(advance_checkpoint(checkpoint, consumed,
+                                                           reconciled=reconcile and queried)))
+    
+    warehouse.close()
         
     return(0)
 
@@ -0,0 +1,219 @@
+"""
+What to do with each harvested response.
+
+harvest_pages used to store whatever came back as `raw_html`: 404s for
+deleted posts, rate-limit and "this IP has been blocked" pages included.
+process_listing_pages then paid for a full parse of each and flagged it
+`needs_ai_parsing`. Now every response is classified first:
+
+    ok         a listing page; stored
+    gone       deleted, expired or otherwise never coming back (404, 410,
+               other 4xx, Craigslist's "this posting has been deleted"
+               pages); written to the harvest_dead_letters table
+    throttled  429, 403, 503 or a "blocked" page; the host backs off and
+               the link waits in the retry queue until it's done
+    error      the request failed, timed out or got a 5xx; retried with
+               exponential delay, and dead-lettered after
+               HARVEST_MAX_ATTEMPTS
+
+A link whose host is backing off isn't fetched at all and comes back with
+status SKIPPED; it waits in the retry queue without using up an attempt.
+
+The retry queue and the per-host backoff live in harvest_pages'
+checkpoint next to its watermark. Links in the queue are past the
+watermark, and if the checkpoint is lost the next full reconcile finds
+them in links_need_harvesting again. Dead-lettered links are removed from
+links_need_harvesting so a reconcile doesn't pick them up again.
+"""
+
+import os
+import random
+from datetime import datetime, timedelta
+
+from checkpoints import format_time, parse_time
+
+OK = "ok"
+GONE = "gone"
+THROTTLED = "throttled"
+ERROR = "error"
+
+# The status for a link we didn't fetch because its host was backing off
+SKIPPED = "skipped"
+
+RETRY_BASE_SECONDS = float(os.getenv("HARVEST_RETRY_BASE_SECONDS", "600"))
+RETRY_MAX_SECONDS = float(os.getenv("HARVEST_RETRY_MAX_SECONDS", str(12 * 3600)))
+MAX_ATTEMPTS = int(os.getenv("HARVEST_MAX_ATTEMPTS", "5"))
+HOST_BACKOFF_SECONDS = float(os.getenv("HARVEST_HOST_BACKOFF_SECONDS", "120"))
+HOST_BACKOFF_MAX_SECONDS = float(os.getenv("HARVEST_HOST_BACKOFF_MAX_SECONDS", "7200"))
+
+DEAD_LETTER_TABLE = "harvest_dead_letters"
+
+# Craigslist serves these with a 404 but they've turned up with a 200 too
+GONE_MARKERS = ("This posting has been deleted", "This posting has expired",
+                "This posting has been flagged for removal")
+BLOCKED_MARKERS = ("This IP has been automatically blocked", "your IP has been blocked")
+
+THROTTLED_STATUSES = {403, 429, 503}
+RETRYABLE_STATUSES = {408, 425}
+
+
+def classify(status, text) :
+    """ OK, GONE, THROTTLED or ERROR for a response, or SKIPPED if it wasn't fetched."""
+    if status == SKIPPED :
+        return(SKIPPED)
+
+    if status is None or text is None :
+        return(ERROR)
+
+    if status in THROTTLED_STATUSES :
+        return(THROTTLED)
+
+    if status in RETRYABLE_STATUSES or status >= 500 :
+        return(ERROR)
+
+    if status >= 400 :
+        return(GONE)
+
+    if status != 200 or not text.strip() :
+        return(ERROR)
+
+    # A real listing has a posting body; the block and deleted pages don't
+    if 'id="postingbody"' not in text :
+        if any(marker in text for marker in BLOCKED_MARKERS) :
+            return(THROTTLED)
+        if any(marker in text for marker in GONE_MARKERS) :
+            return(GONE)
+
+    return(OK)
+
+
+class HostBackoff :
+    """
+    Per-host (Craigslist subdomain) backoff. Each throttled response
+    doubles the host's delay, from HARVEST_HOST_BACKOFF_SECONDS up to
+    HARVEST_HOST_BACKOFF_MAX_SECONDS, and a good one clears it.
+    """
+
+    def __init__(self, hosts=None) :
+        # host -> {"until": time string, "delay": seconds}
+        self.hosts = dict(hosts or {})
+
+    def until(self, host) :
+        """ When `host` can be fetched again, or None if it isn't backing off."""
+        state = self.hosts.get(host)
+        return(parse_time(state["until"]) if state else None)
+
+    def waiting(self, host, now=None) :
+        until = self.until(host)
+        return(until is not None and until > (now or datetime.utcnow()))
+
+    def record(self, host, outcome, now=None) :
+        if outcome == OK :
+            self.hosts.pop(host, None)
+
+        elif outcome == THROTTLED :
+            now = now or datetime.utcnow()
+            state = self.hosts.get(host)
+            # Several throttled responses from one burst only count once
+            if state and parse_time(state["until"]) > now :
+                return
+            delay = min(state["delay"] * 2, HOST_BACKOFF_MAX_SECONDS) if state else HOST_BACKOFF_SECONDS
+            self.hosts[host] = {"until" : format_time(now + timedelta(seconds=delay)), "delay" : delay}
+            print(f"{host} is throttling us, backing off for {delay:.0f}s.")
+
+    def to_checkpoint(self, now=None) :
+        # Forget hosts that have been quiet for as long as the longest backoff
+        cutoff = (now or datetime.utcnow()) - timedelta(seconds=HOST_BACKOFF_MAX_SECONDS)
+        return({host : state for host, state in self.hosts.items() if parse_time(state["until"]) > cutoff})
+
+
+def retry_delay(attempts) :
+    """ Seconds before attempt `attempts` + 1, doubling each time, with some jitter."""
+    delay = min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), RETRY_MAX_SECONDS)
+    return(delay * random.uniform(0.75, 1.25))
+
+
+class RetryQueue :
+    """ Links waiting to be fetched again, keyed by url."""
+
+    def __init__(self, entries=None, backoff=None) :
+        # url -> {"location", "row_created", "attempts", "next_attempt", "outcome", "status"}
+        self.entries = dict(entries or {})
+        self.backoff = backoff if backoff is not None else HostBackoff()
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint) :
+        checkpoint = checkpoint or {}
+        return(cls(checkpoint.get("retry"), HostBackoff(checkpoint.get("host_backoff"))))
+
+    def save_to(self, checkpoint) :
+        """ `checkpoint` with the queue and the host backoff in it."""
+        checkpoint = dict(checkpoint or {})
+        checkpoint["retry"] = self.entries
+        checkpoint["host_backoff"] = self.backoff.to_checkpoint()
+        return(checkpoint)
+
+    def __len__(self) :
+        return(len(self.entries))
+
+    def __contains__(self, url) :
+        return(url in self.entries)
+
+    def due(self, limit, now=None) :
+        """ Up to `limit` (url, location, row_created) whose retry is due, oldest first."""
+        now = format_time(now or datetime.utcnow())
+
+        due = [(url, entry["location"], entry["row_created"]) for url, entry in self.entries.items()
+               if entry["next_attempt"] <= now and not self.backoff.waiting(entry["location"])]
+        due.sort(key=lambda link : link[2])
+
+        return(due[:max(limit, 0)])
+
+    def settle(self, links, outcomes, statuses, now=None) :
+        """
+        Update the queue with how each of `links` (url, location,
+        row_created) went: `outcomes` and `statuses` map url to its
+        classification and HTTP status. Returns the dead letter rows for
+        links that won't be retried.
+        """
+        now = now or datetime.utcnow()
+        dead_letters = []
+
+        for url, location, row_created in links :
+            outcome = outcomes[url]
+            entry = self.entries.pop(url, None) or {"attempts" : 0}
+
+            if outcome == OK :
+                continue
+
+            attempts = entry["attempts"]
+
+            if outcome in (THROTTLED, SKIPPED) :
+                # Not the link's fault, so no attempt is used up
+                next_attempt = self.backoff.until(location) or now
+            else :
+                attempts += 1
+                next_attempt = now + timedelta(seconds=retry_delay(attempts))
+
+            if outcome == GONE or attempts >= MAX_ATTEMPTS :
+                dead_letters.append({
+                    "url" : url,
+                    "location" : location,
+                    "row_created" : format_time(row_created),
+                    "outcome" : outcome,
+                    "status" : statuses.get(url) if isinstance(statuses.get(url), int) else None,
+                    "attempts" : attempts,
+                    "time_dead_lettered" : format_time(now),
+                })
+                continue
+
+            self.entries[url] = {
+                "location" : location,
+                "row_created" : format_time(row_created),
+                "attempts" : attempts,
+                "next_attempt" : format_time(next_attempt),
+                "outcome" : outcome,
+                "status" : statuses.get(url),
+            }
+
+        return(dead_letters)
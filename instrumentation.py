@@ -0,0 +1,233 @@
+"""
+Per-run timing and counters for the cron jobs.
+
+Each job used to log a single row: start, finish and a count in `notes`.
+When a run was slow there was no telling whether the time went to
+BigQuery, HTTP, sleeps, soup parsing or inserts. A `RunMetrics` collects
+three things over one run:
+
+- stage wall time. `with metrics.stage("insert") :` adds the time spent in
+  the block to "insert". Stages nest, and a parent's clock pauses while a
+  child runs, so each thread's stages add up to its wall time without
+  double counting. `metrics.iterate(name, items)` charges the time spent
+  waiting on each item of a lazy iterator to a stage.
+- per-item latency histograms, e.g. one HTTP fetch or one page parsed, in
+  fixed buckets. They're safe to record from worker threads.
+- counters: bytes fetched and stored, HTTP status codes, matcher hits and
+  misses, and so on.
+
+`finish` writes the job's `log` row with these as structured columns (see
+add_log_metrics_columns.sql). If METRICS_TEXTFILE_DIR is set it also
+writes the run in Prometheus text format to <dir>/carbitrage_<task>.prom,
+for node_exporter's textfile collector to pick up.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+
+# Upper bounds in seconds, from a fast parse up to a slow BigQuery job
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Histogram :
+
+    def __init__(self, buckets=LATENCY_BUCKETS) :
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds) :
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index] :
+            index += 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q) :
+        """ Estimated from the buckets, interpolating within the one the quantile falls in."""
+        if not self.count :
+            return(None)
+
+        rank = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts) :
+            if count and seen + count >= rank :
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return(min(lower + (upper - lower) * (rank - seen) / count, self.max))
+            seen += count
+
+        return(self.max)
+
+
+class RunMetrics :
+
+    def __init__(self, task) :
+        self.task = task
+        self.hostname = socket.gethostname()
+        self.time_started = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.perf_counter()
+
+        self.lock = threading.Lock()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name) :
+        stack = getattr(self._local, "stack", None)
+        if stack is None :
+            stack = self._local.stack = []
+
+        now = time.perf_counter()
+        if stack :
+            self._charge(stack[-1], now)
+        stack.append([name, now])
+
+        try :
+            yield
+        finally :
+            now = time.perf_counter()
+            self._charge(stack.pop(), now)
+            if stack :
+                stack[-1][1] = now
+
+    def _charge(self, entry, now) :
+        name, resumed = entry
+        with self.lock :
+            self.stages[name] += now - resumed
+        entry[1] = now
+
+    def iterate(self, name, items) :
+        """ Yield from `items`, charging the wait for each one to stage `name`."""
+        items = iter(items)
+        while True :
+            with self.stage(name) :
+                try :
+                    item = next(items)
+                except StopIteration :
+                    return
+            yield item
+
+    def count(self, name, n=1) :
+        with self.lock :
+            self.counters[name] += n
+
+    def observe(self, name, seconds) :
+        with self.lock :
+            histogram = self.histograms.get(name)
+            if histogram is None :
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name) :
+        """ Observe how long the block takes as one `name` item."""
+        started = time.perf_counter()
+        try :
+            yield
+        finally :
+            self.observe(name, time.perf_counter() - started)
+
+    def http_status(self, status) :
+        self.count(f"http_{status}" if status is not None else "http_error")
+
+    def log_row(self, notes) :
+        """ The `log` row for this run, with the metrics as repeated records."""
+        with self.lock :
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+
+        return({
+            'task' : self.task,
+            'time_started' : self.time_started,
+            'time_finished' : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            'notes' : notes,
+            'hostname' : self.hostname,
+            'duration_seconds' : round(time.perf_counter() - self.started, 3),
+            'stage_seconds' : [{'stage' : name, 'seconds' : round(seconds, 3)}
+                               for name, seconds in sorted(stages.items())],
+            'counters' : [{'name' : name, 'value' : value} for name, value in sorted(counters.items())],
+            'latencies' : [{
+                'name' : name,
+                'count' : histogram.count,
+                'total_seconds' : round(histogram.total, 3),
+                'max_seconds' : round(histogram.max, 4),
+                'p50_seconds' : round(histogram.quantile(0.5), 4),
+                'p90_seconds' : round(histogram.quantile(0.9), 4),
+                'p99_seconds' : round(histogram.quantile(0.99), 4),
+            } for name, histogram in sorted(histograms.items())],
+        })
+
+    def prometheus_text(self) :
+        labels = f'task="{self.task}",host="{self.hostname}"'
+        lines = [
+            "# TYPE carbitrage_run_duration_seconds gauge",
+            f"carbitrage_run_duration_seconds{{{labels}}} {time.perf_counter() - self.started:.3f}",
+            "# TYPE carbitrage_run_finished_timestamp_seconds gauge",
+            f"carbitrage_run_finished_timestamp_seconds{{{labels}}} {time.time():.0f}",
+        ]
+
+        with self.lock :
+            lines.append("# TYPE carbitrage_stage_seconds gauge")
+            lines += [f'carbitrage_stage_seconds{{{labels},stage="{name}"}} {seconds:.3f}'
+                      for name, seconds in sorted(self.stages.items())]
+
+            lines.append("# TYPE carbitrage_run_count gauge")
+            lines += [f'carbitrage_run_count{{{labels},name="{name}"}} {value}'
+                      for name, value in sorted(self.counters.items())]
+
+            lines.append("# TYPE carbitrage_item_seconds histogram")
+            for name, histogram in sorted(self.histograms.items()) :
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts) :
+                    cumulative += count
+                    lines.append(f'carbitrage_item_seconds_bucket{{{labels},name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'carbitrage_item_seconds_sum{{{labels},name="{name}"}} {histogram.total:.6f}')
+                lines.append(f'carbitrage_item_seconds_count{{{labels},name="{name}"}} {histogram.count}')
+
+        return("\n".join(lines) + "\n")
+
+    def write_prometheus(self, directory=METRICS_TEXTFILE_DIR) :
+        """ Write the textfile-collector file, replacing the last run's. Returns its path."""
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, f"carbitrage_{self.task}.prom")
+        tmp_path = path + ".tmp"
+
+        # Write then rename so the collector never reads half a file
+        with open(tmp_path, "w") as f :
+            f.write(self.prometheus_text())
+
+        os.replace(tmp_path, path)
+
+        return(path)
+
+    def finish(self, warehouse, notes) :
+        """ Log the run, and write the Prometheus file if METRICS_TEXTFILE_DIR is set."""
+        if METRICS_TEXTFILE_DIR :
+            try :
+                self.write_prometheus()
+            except OSError as e :
+                print(f"Error writing Prometheus metrics: {e}")
+
+        row = self.log_row(notes)
+        print(f"{self.task}: {json.dumps(row['stage_seconds'])}")
+
+        return(warehouse.upload('log', [row]))
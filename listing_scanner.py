@@ -0,0 +1,268 @@
+"""
+A tree-free scanner for the parts of a listing page the parser reads.
+
+Building a `html.parser` BeautifulSoup tree is by far the most expensive
+part of parsing a listing page, and the extractors only ever look at a few
+elements of it: the `ld_posting_data` JSON-LD, the `attr` divs with their
+`labl`/`valu` spans, `titletextonly`, `postingbody`, `time.timeago`, the
+makemodel/year spans and `slider-info`. `scan_listing` finds those with a
+handful of regexes over the page text and hands back `Fragment`s, which
+offer the few bits of the bs4 Tag API the extractors use (`.text`,
+`.string`, `.get`, `.find`).
+
+The scanner follows what html.parser and bs4 would do closely enough to
+give the same rows on ordinary pages: comments and script/style bodies
+are skipped, an element runs to its matching end tag, and text is the
+page text between tags with character references decoded as bs4 decodes
+them. Anything it isn't sure of (a reference bs4 treats specially, stray
+markup inside a text run, an element that's never closed) raises
+`ScanError`, and a page that's missing one of the required fragments
+gets None back. Either way the caller falls back to the soup.
+"""
+
+import html
+import re
+from bisect import bisect_right
+
+from bs4.dammit import EntitySubstitution
+
+# The patterns are case sensitive, which makes them several times faster;
+# pages with upper case tags go to the soup.
+_UPPER_CASE_TAG = re.compile(r"</?[A-Z]")
+
+# Attribute values may be quoted and contain '>'
+_ATTRS = r"""(?:[^>"']|"[^"]*"|'[^']*')*"""
+_QUOTED_ATTRS = re.compile(_ATTRS)
+
+# Comments and script/style bodies, which html.parser doesn't look inside
+_OPAQUE = re.compile(rf"<!--.*?(?:-->|\Z)|<(script|style)(?=[\s/>])({_ATTRS})>(.*?)(?:</\1\s*>|\Z)", re.S)
+
+# Start tags that might be one of the elements we want. Whole-page scans
+# stop at the first '>', which is much quicker than allowing for quoted
+# ones; the tags we use are checked for a '>' inside quotes.
+_CANDIDATE = re.compile(r"<(div|span|section|time|a)(?=[\s/>])([^>]*)>")
+_KEYWORDS = re.compile(r"attr|titletextonly|labl|valu|slider-info|postingbody|timeago")
+
+_ATTR = re.compile(r"""([^\s/>"'=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>"']+))?""")
+
+_MARKUP = re.compile(rf"<!--.*?-->|<(script|style)(?=[\s/>]){_ATTRS}>.*?</\1\s*>|</?[a-zA-Z]{_ATTRS}>", re.S)
+_STRAY_MARKUP = re.compile(r"<[!?/a-zA-Z]")
+
+_REFERENCE = re.compile(r"&([#a-zA-Z][^;&<\s]*)(;?)")
+_NUMERIC = re.compile(r"#(?:([0-9]+)|[xX]([0-9a-fA-F]+))")
+
+_TAG_ENDS = {}
+
+# The fragments a page has to have for its scan to be used
+REQUIRED = ("ld_script", "attr_divs", "title_span", "body_section", "time_tag")
+
+
+class ScanError(ValueError) :
+    """ The scanner can't be sure it would match the soup on this page."""
+
+
+def _unescape(text) :
+    """ Decode character references the way bs4's html.parser builder does, or raise ScanError."""
+    if "&" not in text :
+        return(text)
+
+    def replace(match) :
+        name, semicolon = match.groups()
+        if not semicolon :
+            raise ScanError(f"unterminated character reference &{name}")
+
+        numeric = _NUMERIC.fullmatch(name)
+        if numeric :
+            code = int(numeric.group(1)) if numeric.group(1) else int(numeric.group(2), 16)
+            # bs4 reads 128-159 as windows-1252 and replaces the invalid ones
+            if 32 <= code < 127 or 160 <= code < 0xD800 or 0xE000 <= code < 0x110000 :
+                return(chr(code))
+            raise ScanError(f"numeric reference &{name};")
+
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        if character is None :
+            raise ScanError(f"unknown entity &{name};")
+        return(character)
+
+    return(_REFERENCE.sub(replace, text))
+
+
+def _parse_attrs(text) :
+    attrs = {}
+    for name, value in _ATTR.findall(text) :
+        if value[:1] in ("'", '"') :
+            value = value[1:-1]
+        attrs[name.lower()] = html.unescape(value) if "&" in value else value
+    return(attrs)
+
+
+class Fragment :
+    """ One element of a scanned page, standing in for the bs4 Tag."""
+
+    def __init__(self, page, name, attrs, start, end=None) :
+        self.page = page
+        self.name = name
+        self.attrs = attrs
+        self.classes = attrs.get("class", "").split()
+        # The element's content runs from `start` to its end tag, which is
+        # only looked for if the content is used
+        self.start = start
+        self._end = end
+
+    @property
+    def end(self) :
+        if self._end is None :
+            self._end = self.page.element_end(self.name, self.start)
+        return(self._end)
+
+    def get(self, key, default=None) :
+        return(self.attrs.get(key, default))
+
+    @property
+    def string(self) :
+        """ The raw content, which is what bs4 gives for a script."""
+        content = self.page.html[self.start:self.end]
+        return(content or None)
+
+    @property
+    def text(self) :
+        content = self.page.html[self.start:self.end]
+
+        pieces = []
+        position = 0
+        for match in _MARKUP.finditer(content) :
+            pieces.append(content[position:match.start()])
+            position = match.end()
+        pieces.append(content[position:])
+
+        for piece in pieces :
+            if _STRAY_MARKUP.search(piece) :
+                raise ScanError(f"markup inside <{self.name}> text that the scanner doesn't handle")
+
+        return("".join(_unescape(piece) for piece in pieces))
+
+    def find(self, name, class_=None) :
+        """ The first `name` element inside this one with `class_` among its classes."""
+        for fragment in self.page.elements(self.start, self.end, name) :
+            if class_ is None or class_ in fragment.classes :
+                return(fragment)
+        return(None)
+
+
+class ScannedPage :
+
+    def __init__(self, text) :
+        self.html = text
+
+        self.opaque_starts = []
+        self.opaque_ends = []
+        self.scripts = []
+
+        for match in _OPAQUE.finditer(text) :
+            self.opaque_starts.append(match.start())
+            self.opaque_ends.append(match.end())
+            if match.group(1) :
+                self.scripts.append(Fragment(self, "script", _parse_attrs(match.group(2)),
+                                             match.start(3), match.end(3)))
+
+    def _opaque(self, position) :
+        index = bisect_right(self.opaque_starts, position) - 1
+        return(index >= 0 and position < self.opaque_ends[index])
+
+    def element_end(self, name, position) :
+        """ Where the element whose content starts at `position` ends, counting nested `name`s."""
+        pattern = _TAG_ENDS.get(name)
+        if pattern is None :
+            pattern = _TAG_ENDS[name] = re.compile(rf"<(/?){name}(?=[\s/>]){_ATTRS}>")
+
+        depth = 1
+        for match in pattern.finditer(self.html, position) :
+            if self._opaque(match.start()) :
+                continue
+            if match.group(1) :
+                depth -= 1
+                if depth == 0 :
+                    return(match.start())
+            elif not match.group(0).endswith("/>") :
+                depth += 1
+
+        raise ScanError(f"<{name}> at {position} is never closed")
+
+    def elements(self, start=0, end=None, name=None) :
+        """ Yield candidate Fragments starting between `start` and `end`, in page order."""
+        end = len(self.html) if end is None else end
+
+        for match in _CANDIDATE.finditer(self.html, start, end) :
+            tag_name, attrs = match.groups()
+            if name is not None and tag_name != name :
+                continue
+            # An odd quote means the match may have stopped at a '>' inside one
+            if (attrs.count('"') % 2 or attrs.count("'") % 2) and not _QUOTED_ATTRS.fullmatch(attrs) :
+                if not self._opaque(match.start()) :
+                    raise ScanError(f"<{tag_name}> at {match.start()} has a '>' inside an attribute")
+            if not _KEYWORDS.search(attrs) or self._opaque(match.start()) :
+                continue
+
+            # A self-closed tag has no content
+            content_end = match.end() if match.group(0).endswith("/>") else None
+
+            yield Fragment(self, tag_name, _parse_attrs(attrs), match.end(), content_end)
+
+
+def scan_listing(text) :
+    """
+    {ListingDocument field: Fragment} for a listing page, picking the same
+    elements ListingDocument's walk over the soup would, or None if one of
+    the REQUIRED fragments is missing. Raises ScanError on pages it can't
+    be sure of.
+    """
+    if _UPPER_CASE_TAG.search(text) :
+        raise ScanError("upper case tags")
+
+    page = ScannedPage(text)
+
+    found = {
+        "ld_script" : next((script for script in page.scripts if script.get("id") == "ld_posting_data"), None),
+        "attr_divs" : [],
+        "title_span" : None,
+        "body_section" : None,
+        "time_tag" : None,
+        "make_model_tag" : None,
+        "year_tag" : None,
+        "slider_span" : None,
+    }
+
+    # The same checks, in the same order, as ListingDocument.__init__
+    for fragment in page.elements() :
+        name = fragment.name
+        tag_id = fragment.get("id")
+        classes = fragment.classes
+
+        if name == "div" :
+            if "attr" in classes :
+                found["attr_divs"].append(fragment)
+
+        elif name == "span" :
+            if tag_id == "titletextonly" and found["title_span"] is None :
+                found["title_span"] = fragment
+            elif found["year_tag"] is None and " ".join(classes) == "valu year" :
+                found["year_tag"] = fragment
+            elif found["slider_span"] is None and "slider-info" in classes :
+                found["slider_span"] = fragment
+
+        elif name == "section" :
+            if tag_id == "postingbody" and found["body_section"] is None :
+                found["body_section"] = fragment
+
+        elif name == "time" :
+            if found["time_tag"] is None and " ".join(classes) == "date timeago" :
+                found["time_tag"] = fragment
+
+        elif name == "a" :
+            if found["make_model_tag"] is None and " ".join(classes) == "valu makemodel" :
+                found["make_model_tag"] = fragment
+
+    if not all(found[field] for field in REQUIRED) :
+        return(None)
+
+    return(found)
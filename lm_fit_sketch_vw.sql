@@ -0,0 +1,69 @@
+WITH Filtered AS ( --same rows as lm_fit_vw
+    SELECT 
+        make, 
+        model, 
+        year, 
+        log(odometer+1) as log_odometer, --avoiding errors on log(0)
+        price, 
+        CASE 
+            WHEN condition IN ('new', 'like new', 'excellent') THEN 1
+            WHEN condition IN ('good', 'fair', 'salvage') THEN 0
+            ELSE NULL
+        END AS condition_mapped,
+        time_posted
+    FROM `car-buying-272019.car_buying.processed_listing_pages`
+    WHERE make IS NOT NULL 
+      AND model IS NOT NULL 
+      AND year IS NOT NULL 
+      AND odometer IS NOT NULL 
+      AND price IS NOT NULL
+      AND condition IS NOT NULL
+      AND time_posted >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 6 * 30 DAY)
+),
+
+ValidMakesModels AS (
+    SELECT make, model
+    FROM Filtered
+    GROUP BY make, model
+    HAVING COUNT(*) >= 100
+),
+
+ValidMakesModelsListings AS (
+    SELECT F.*
+    FROM Filtered F
+    INNER JOIN ValidMakesModels V ON F.make = V.make AND F.model = V.model
+),
+
+-- APPROX_QUANTILES as in lm_fit_vw, only for the make/model/years the
+-- sketches don't cover yet (see backfill_price_sketches.py)
+FallbackQuantiles AS (
+    SELECT
+        VL.make,
+        VL.model,
+        VL.year,
+        APPROX_QUANTILES(VL.price, 100)[OFFSET(5)] AS low_quantile,
+        APPROX_QUANTILES(VL.price, 100)[OFFSET(95)] AS high_quantile
+    FROM ValidMakesModelsListings VL
+    LEFT JOIN `car-buying-272019.car_buying.price_quantile_bounds` PQ
+        ON VL.make = PQ.make AND VL.model = PQ.model AND VL.year = PQ.year
+    WHERE PQ.make IS NULL
+    GROUP BY VL.make, VL.model, VL.year
+)
+
+-- The 5th/95th percentile bounds come from the price sketches kept as listings
+-- are parsed (price_bounds.py) rather than APPROX_QUANTILES over the window
+SELECT 
+    F.make, 
+    F.model, 
+    F.year, 
+    F.log_odometer, 
+    F.price, 
+    F.condition_mapped, 
+    F.time_posted
+FROM ValidMakesModelsListings F
+LEFT JOIN `car-buying-272019.car_buying.price_quantile_bounds` PQ
+    ON F.make = PQ.make AND F.model = PQ.model AND F.year = PQ.year
+LEFT JOIN FallbackQuantiles FQ
+    ON F.make = FQ.make AND F.model = FQ.model AND F.year = FQ.year
+WHERE F.price > COALESCE(PQ.low_quantile, FQ.low_quantile)
+  AND F.price < COALESCE(PQ.high_quantile, FQ.high_quantile)
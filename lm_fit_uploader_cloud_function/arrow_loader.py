@@ -0,0 +1,103 @@
+"""
+Memory-lean loading of the model fit data.
+
+`query_job.to_dataframe()` builds the whole result as pandas objects, with
+make and model as Python strings on every row. The float64 casts that
+followed then copied each numeric column again. In the memory-limited
+cloud function that was the peak, and it's why the window couldn't grow
+past six months.
+
+Here the result is streamed as Arrow record batches straight into
+preallocated numpy columns. make/model go in as int32 category codes
+(there are only a few thousand distinct values). Each numeric column is
+stored in the smallest dtype that holds it exactly. Nothing is held twice
+apart from the batch currently being copied in.
+"""
+
+import resource
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+
+CATEGORICAL_COLUMNS = ['make', 'model']
+
+# Years and the 0/1 condition are exact in float32; odometer and price keep
+# float64 so the fitted coefficients don't move.
+NUMERIC_DTYPES = {
+    'year': 'float32',
+    'log_odometer': 'float64',
+    'price': 'float64',
+    'condition_mapped': 'float32',
+}
+
+
+class _CodeBook:
+    """ Assigns each distinct string a stable code across record batches."""
+
+    def __init__(self):
+        self.codes = {}
+        self.categories = []
+
+    def _code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def encode(self, array):
+        encoded = pc.dictionary_encode(array)
+
+        # Map the batch's own dictionary onto ours, then gather; only the
+        # dictionary goes through Python, not the rows.
+        lookup = np.array([self._code(value) for value in encoded.dictionary.to_pylist()] or [0],
+                          dtype='int32')
+        indices = encoded.indices.fill_null(0).to_numpy()
+        codes = lookup[indices]
+
+        if encoded.null_count:
+            codes[encoded.is_null().to_numpy(zero_copy_only=False)] = -1
+
+        return codes
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process so far, in MB (Linux reports KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_query(client, query, categorical=CATEGORICAL_COLUMNS, dtypes=NUMERIC_DTYPES):
+    """
+    Run `query` and return a dataframe with the `categorical` columns as
+    pandas categoricals and the `dtypes` columns in those dtypes. Other
+    columns in the result are ignored.
+    """
+    rows = client.query(query).result()
+    total = rows.total_rows or 0
+
+    codes = {name: np.empty(total, dtype='int32') for name in categorical}
+    books = {name: _CodeBook() for name in categorical}
+    numeric = {name: np.empty(total, dtype=dtype) for name, dtype in dtypes.items()}
+
+    filled = 0
+
+    for batch in rows.to_arrow_iterable():
+        size = batch.num_rows
+        rows_slice = slice(filled, filled + size)
+
+        for name in categorical:
+            codes[name][rows_slice] = books[name].encode(batch.column(batch.schema.get_field_index(name)))
+
+        # Nulls come through as NaN, which dropna handles later
+        for name in dtypes:
+            column = batch.column(batch.schema.get_field_index(name))
+            numeric[name][rows_slice] = column.to_numpy(zero_copy_only=False)
+
+        filled += size
+
+    columns = {name: pd.Categorical.from_codes(codes[name][:filled], categories=books[name].categories)
+               for name in categorical}
+    columns.update({name: numeric[name][:filled] for name in dtypes})
+
+    return pd.DataFrame(columns, copy=False)
@@ -0,0 +1,275 @@
+"""
+Fit price ~ log_odometer + condition_mapped + year for every make/model at once.
+
+Instead of masking the whole dataframe and running a statsmodels OLS per
+make/model, we make one pass to build each group's normal equations as
+segment sums (np.bincount with weights), then solve every group together
+as a stack of small k x k systems. Cost is linear in rows plus a tiny
+amount per group, so more groups or a few more features barely register.
+
+Sums are taken about an offset per group (normally the group mean) so the
+normal equations stay well conditioned with raw model years. Results match
+statsmodels' OLS: slopes come from the centered system and the intercept
+from the means. A group whose predictors are collinear, e.g. every listing
+has the same condition, gets the same answer statsmodels gives, quirks
+included (see `_solve_min_norm`).
+"""
+
+import numpy as np
+import pandas as pd
+
+GROUP_KEYS = ['make', 'model']
+FEATURES = ['log_odometer', 'condition_mapped', 'year']
+TARGET = 'price'
+
+# Features dropped for groups where they only take one value; with a
+# single year in the group, `year` is just a second intercept.
+DROP_IF_CONSTANT = ['year']
+
+# Column names lm_lookup_table uses for the coefficients
+COEFF_COLUMNS = {
+    'log_odometer': 'miles_coeff',
+    'condition_mapped': 'condition_coeff',
+    'year': 'year_coeff',
+}
+
+# Below this reciprocal condition number (of the correlation matrix) a group
+# is treated as collinear and solved with the pseudo-inverse instead.
+COLLINEAR_RCOND = 1e-10
+
+
+class GroupMoments:
+    """
+    Sufficient statistics for G separate regressions on k features, taken
+    about per-group offsets: n, sum x, sum y, x'x, x'y and y'y of
+    (x - x_offset, y - y_offset). Arrays are shaped (G,), (G, k), (G,),
+    (G, k, k), (G, k), (G,); the offsets are (G, k) and (G,).
+    """
+
+    def __init__(self, n, sx, sy, sxx, sxy, syy, x_offset, y_offset):
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxx = sxx
+        self.sxy = sxy
+        self.syy = syy
+        self.x_offset = x_offset
+        self.y_offset = y_offset
+
+    @classmethod
+    def from_arrays(cls, codes, n_groups, X, y, x_offset=None, y_offset=None):
+        """
+        Segment sums over rows of X (n_rows, k) and y, grouped by integer
+        `codes` in [0, n_groups). Offsets default to zero.
+        """
+        k = X.shape[1]
+
+        if x_offset is None:
+            x_offset = np.zeros((n_groups, k))
+        if y_offset is None:
+            y_offset = np.zeros(n_groups)
+
+        # One subtraction per row; everything after is a weighted bincount
+        xc = X - x_offset[codes]
+        yc = y - y_offset[codes]
+
+        def segment_sum(weights):
+            return np.bincount(codes, weights=weights, minlength=n_groups)
+
+        n = segment_sum(None)
+        sx = np.empty((n_groups, k))
+        sxx = np.empty((n_groups, k, k))
+        sxy = np.empty((n_groups, k))
+
+        for i in range(k):
+            sx[:, i] = segment_sum(xc[:, i])
+            sxy[:, i] = segment_sum(xc[:, i] * yc)
+            for j in range(i, k):
+                sxx[:, i, j] = sxx[:, j, i] = segment_sum(xc[:, i] * xc[:, j])
+
+        return cls(n, sx, segment_sum(yc), sxx, sxy, segment_sum(yc * yc), x_offset, y_offset)
+
+    def raw(self):
+        """ The same sums about zero: (sum x, sum y, x'x, x'y, y'y)."""
+        n, o, yo = self.n, self.x_offset, self.y_offset
+
+        sx = self.sx + n[:, None] * o
+        sy = self.sy + n * yo
+        sxx = (self.sxx
+               + o[:, :, None] * self.sx[:, None, :]
+               + self.sx[:, :, None] * o[:, None, :]
+               + n[:, None, None] * o[:, :, None] * o[:, None, :])
+        sxy = self.sxy + o * self.sy[:, None] + self.sx * yo[:, None] + n[:, None] * o * yo[:, None]
+        syy = self.syy + 2 * yo * self.sy + n * yo * yo
+
+        return sx, sy, sxx, sxy, syy
+
+    def take(self, groups):
+        """ The moments for a subset of the groups (an index or mask)."""
+        return GroupMoments(self.n[groups], self.sx[groups], self.sy[groups], self.sxx[groups],
+                            self.sxy[groups], self.syy[groups], self.x_offset[groups], self.y_offset[groups])
+
+    def constant(self):
+        """ (G, k) mask of the features that don't vary within each group, up to rounding."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sx / self.n[:, None]
+            spread = np.einsum('gii->gi', self.sxx) - self.sx * mean
+            return spread <= 1e-20 * self.n[:, None] * (mean + self.x_offset) ** 2
+
+
+def solve_moments(moments, active=None):
+    """
+    Least squares for every group. `active` is a (G, k) boolean mask of the
+    features each group uses; inactive features get a coefficient of 0.
+    Returns (intercept (G,), coefficients (G, k), r_squared (G,)).
+    """
+    n = moments.n
+    G, k = moments.sx.shape
+
+    if active is None:
+        active = np.ones((G, k), dtype=bool)
+
+    # Groups with no rows have nothing to solve; they come back as NaN
+    empty = n == 0
+    if empty.any():
+        intercept, beta, r_squared = np.full(G, np.nan), np.full((G, k), np.nan), np.full(G, np.nan)
+        intercept[~empty], beta[~empty], r_squared[~empty] = solve_moments(moments.take(~empty),
+                                                                            active[~empty])
+        return intercept, beta, r_squared
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mx = moments.sx / n[:, None]
+        my = moments.sy / n
+
+        # Centered cross products
+        Sxx = moments.sxx - moments.sx[:, :, None] * mx[:, None, :]
+        Sxy = moments.sxy - moments.sx * my[:, None]
+        Syy = moments.syy - moments.sy * my
+
+        # A feature that doesn't vary within the group. An all-zero one just
+        # gets a coefficient of 0.
+        diag = np.einsum('gii->gi', Sxx)
+        mean = mx + moments.x_offset
+        constant = moments.constant()
+        active = active & ~(constant & (mean == 0))
+        constant &= active
+
+        # statsmodels' add_constant leaves the intercept out when a feature
+        # is already a nonzero constant; that feature's coefficient then
+        # plays the intercept and `const` comes back missing.
+        implicit_constant = constant.any(axis=1)
+
+        # Solve for the features that vary, scaled to a correlation matrix
+        # so the collinearity test doesn't depend on each feature's units
+        varying = active & ~constant
+        both = varying[:, :, None] & varying[:, None, :]
+        scale = np.where(varying, np.sqrt(np.abs(diag)), 1.0)
+        corr = np.where(both, Sxx, 0.0) / (scale[:, :, None] * scale[:, None, :])
+        Sxy = np.where(varying, Sxy, 0.0)
+
+        probe = corr + np.eye(k) * (~varying)[:, :, None]
+        singular_values = np.linalg.svd(probe, compute_uv=False)
+        collinear = (singular_values[:, -1] <= COLLINEAR_RCOND * singular_values[:, 0]) \
+            | implicit_constant
+
+        beta = np.einsum('gij,gj->gi', np.linalg.pinv(corr), Sxy / scale) / scale
+
+        intercept = (my + moments.y_offset) - np.einsum('gi,gi->g', mx + moments.x_offset, beta)
+
+        # Any least-squares solution gives the same fitted values, so R^2
+        # comes from the centered solution even for collinear groups.
+        r_squared = 1 - (Syy - np.einsum('gi,gi->g', beta, Sxy)) / Syy
+
+    if collinear.any():
+        intercept[collinear], beta[collinear] = _solve_min_norm(moments, active, collinear,
+                                                                implicit_constant)
+
+    return intercept, beta, r_squared
+
+
+def _solve_min_norm(moments, active, groups, implicit_constant):
+    """
+    statsmodels fits with the pseudo-inverse of the design matrix, so for a
+    collinear group it returns the minimum-norm solution over the intercept
+    and coefficients together. pinv(X'X) X'y is that same solution. Groups
+    with an `implicit_constant` are fit without the intercept column and
+    get a NaN intercept, as statsmodels gives.
+    """
+    sx, sy, sxx, sxy, _ = moments.raw()
+    n = moments.n[groups]
+    active = active[groups]
+    no_intercept = implicit_constant[groups]
+    G, k = active.shape
+
+    full_active = np.concatenate([~no_intercept[:, None], active], axis=1)
+    both = full_active[:, :, None] & full_active[:, None, :]
+
+    M = np.empty((G, k + 1, k + 1))
+    M[:, 0, 0] = n
+    M[:, 0, 1:] = M[:, 1:, 0] = sx[groups]
+    M[:, 1:, 1:] = sxx[groups]
+    M = np.where(both, M, 0.0)
+
+    v = np.concatenate([sy[groups][:, None], sxy[groups]], axis=1)
+    v = np.where(full_active, v, 0.0)
+
+    theta = np.einsum('gij,gj->gi', np.linalg.pinv(M, rcond=1e-12), v)
+
+    return np.where(no_intercept, np.nan, theta[:, 0]), theta[:, 1:]
+
+
+def fit_grouped_ols(df, features=FEATURES, target=TARGET, group_keys=GROUP_KEYS,
+                    drop_if_constant=DROP_IF_CONSTANT):
+    """
+    Fit `target` ~ `features` separately for each `group_keys` group of
+    `df`. Returns one row per group, in order of first appearance, with the
+    intercept, a coefficient column per feature, r_squared and sample_size.
+    """
+    grouped = df.groupby(group_keys, sort=False, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    n_groups = grouped.ngroups
+
+    # Codes number the groups in order of first appearance
+    first_rows = np.unique(codes, return_index=True)[1]
+    keys = df[group_keys].iloc[first_rows].reset_index(drop=True)
+
+    complete = df[list(features) + [target]].notna().all(axis=1).to_numpy()
+    df = df[complete]
+    codes = codes[complete]
+
+    X = np.column_stack([df[feature].to_numpy(dtype='float64') for feature in features])
+    y = df[target].to_numpy(dtype='float64')
+
+    # Take the sums about each group's mean (two cheap passes) for accuracy
+    n = np.bincount(codes, minlength=n_groups)
+    safe_n = np.maximum(n, 1)
+    x_mean = np.column_stack([np.bincount(codes, weights=X[:, i], minlength=n_groups)
+                              for i in range(X.shape[1])]) / safe_n[:, None]
+    y_mean = np.bincount(codes, weights=y, minlength=n_groups) / safe_n
+
+    moments = GroupMoments.from_arrays(codes, n_groups, X, y, x_mean, y_mean)
+
+    active = np.ones((n_groups, len(features)), dtype=bool)
+    for feature in drop_if_constant:
+        if feature in features:
+            distinct = df[feature].groupby(codes).nunique().reindex(range(n_groups), fill_value=0).to_numpy()
+            active[:, list(features).index(feature)] = distinct > 1
+
+    intercept, coefficients, r_squared = solve_moments(moments, active)
+
+    results = results_frame(keys, features, intercept, coefficients, r_squared, n)
+
+    # A group with no complete rows has nothing to fit
+    return results[n > 0].reset_index(drop=True)
+
+
+def results_frame(keys, features, intercept, coefficients, r_squared, n):
+    """ lm_lookup_table rows: the `keys` dataframe's columns, then the fit."""
+    results = pd.DataFrame({key: keys[key].astype(object).to_numpy() for key in keys.columns})
+    results['intercept'] = intercept
+    for i, feature in enumerate(features):
+        results[COEFF_COLUMNS.get(feature, f'{feature}_coeff')] = coefficients[:, i]
+    results['r_squared'] = r_squared
+    results['sample_size'] = np.asarray(n).astype('int64')
+
+    return results
@@ -0,0 +1,314 @@
+"""
+Per-day sufficient statistics for the make/model price models.
+
+A full refit reads six months of listings through lm_fit_vw every week,
+even though only the newest few days have changed. Here each day's
+listings are reduced, once, to per-make/model sums: n, x'x, x'y and y'y,
+plus the column sums. Those go in lm_daily_moments. The window's running
+total lives in lm_window_moments. To slide the window we add the days that
+came in and subtract the days that fell out. grouped_ols then solves every
+make/model straight from the totals, without reading any listings.
+
+All sums are taken about the fixed offsets below rather than zero. Raw
+years squared would cost most of a float's precision once the intercept
+is centered back out, and the offsets have to be fixed so that days can
+be added and subtracted.
+
+The totals pick up a little rounding with every slide, so every
+REBUILD_DAYS they're summed again from the daily rows.
+
+Ingesting still isn't free: to trim prices the way lm_fit_vw does, each
+ingest takes APPROX_QUANTILES over the six months up to its last day, so
+it scans six months of processed_listing_pages however few days it adds.
+What the refit saves is reading and re-summing every listing in the window.
+
+This differs from lm_fit_vw in three ways:
+- Price trimming uses the 5/95 quantiles of the six months up to the last
+  day being ingested, not the quantiles as of the refit.
+- The 100-listing minimum counts rows after trimming rather than before.
+- The window is whole days, ending SETTLE_DAYS ago so late-processed
+  listings have arrived.
+"""
+
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from grouped_ols import DROP_IF_CONSTANT, FEATURES, TARGET, GroupMoments, results_frame, solve_moments
+
+TABLE_PREFIX = 'car-buying-272019.car_buying'
+DAILY_TABLE = f'{TABLE_PREFIX}.lm_daily_moments'
+WINDOW_TABLE = f'{TABLE_PREFIX}.lm_window_moments'
+
+WINDOW_DAYS = int(os.getenv('LM_WINDOW_DAYS', '180'))
+SETTLE_DAYS = int(os.getenv('LM_SETTLE_DAYS', '3'))
+REBUILD_DAYS = int(os.getenv('LM_REBUILD_DAYS', '7'))
+MIN_SAMPLE_SIZE = 100
+
+# Roughly the middle of each feature, and of price
+X_OFFSETS = {'log_odometer': 11.0, 'condition_mapped': 0.0, 'year': 2010.0}
+Y_OFFSET = 15000.0
+
+# The rows lm_fit_vw would give for [@start_day, @end_day], except that
+# make/models under 100 listings are kept; they may pass once summed. The
+# trimming bounds are the trailing six-month quantiles as of @end_day, so
+# the query scans six months whatever the range.
+DAY_ROWS_QUERY = """
+    WITH Filtered AS (
+        SELECT
+            make,
+            model,
+            year,
+            log(odometer+1) as log_odometer,
+            price,
+            CASE
+                WHEN condition IN ('new', 'like new', 'excellent') THEN 1
+                WHEN condition IN ('good', 'fair', 'salvage') THEN 0
+                ELSE NULL
+            END AS condition_mapped,
+            DATE(time_posted) AS day
+        FROM `car-buying-272019.car_buying.processed_listing_pages`
+        WHERE make IS NOT NULL
+          AND model IS NOT NULL
+          AND year IS NOT NULL
+          AND odometer IS NOT NULL
+          AND price IS NOT NULL
+          AND condition IS NOT NULL
+          AND DATE(time_posted) BETWEEN DATE_SUB(@end_day, INTERVAL 6 * 30 DAY) AND @end_day
+    ),
+
+    PriceQuantiles AS (
+        SELECT
+            make,
+            model,
+            year,
+            APPROX_QUANTILES(price, 100)[OFFSET(5)] AS low_quantile,
+            APPROX_QUANTILES(price, 100)[OFFSET(95)] AS high_quantile
+        FROM Filtered
+        GROUP BY make, model, year
+    )
+
+    SELECT F.make, F.model, F.year, F.log_odometer, F.price, F.condition_mapped, F.day
+    FROM Filtered F
+    INNER JOIN PriceQuantiles PQ ON F.make = PQ.make AND F.model = PQ.model AND F.year = PQ.year
+    WHERE F.day BETWEEN @start_day AND @end_day
+      AND F.price > PQ.low_quantile AND F.price < PQ.high_quantile
+"""
+
+
+def moment_columns(features=FEATURES):
+    """ Column names for the flattened sums, in a fixed order."""
+    columns = ['n', 'sy', 'syy']
+    columns += [f'sx_{feature}' for feature in features]
+    columns += [f'sxy_{feature}' for feature in features]
+    columns += [f'sxx_{a}_{b}' for i, a in enumerate(features) for b in features[i:]]
+    return columns
+
+
+def _offsets(n_groups, features):
+    x_offset = np.tile([X_OFFSETS.get(feature, 0.0) for feature in features], (n_groups, 1))
+    return x_offset, np.full(n_groups, Y_OFFSET)
+
+
+def moments_frame(df, by, features=FEATURES, target=TARGET):
+    """ Sums for each `by` group of `df`, one row per group, indexed by `by`."""
+    df = df.dropna(subset=list(features) + [target])
+
+    grouped = df.groupby(by, sort=True, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    n_groups = grouped.ngroups
+
+    X = np.column_stack([df[feature].to_numpy(dtype='float64') for feature in features])
+    y = df[target].to_numpy(dtype='float64')
+
+    moments = GroupMoments.from_arrays(codes, n_groups, X, y, *_offsets(n_groups, features))
+
+    frame = pd.DataFrame(index=grouped.size().index)
+    frame['n'] = moments.n.astype('float64')
+    frame['sy'] = moments.sy
+    frame['syy'] = moments.syy
+    for i, feature in enumerate(features):
+        frame[f'sx_{feature}'] = moments.sx[:, i]
+    for i, feature in enumerate(features):
+        frame[f'sxy_{feature}'] = moments.sxy[:, i]
+    for i, a in enumerate(features):
+        for j in range(i, len(features)):
+            frame[f'sxx_{a}_{features[j]}'] = moments.sxx[:, i, j]
+
+    return frame
+
+
+def frame_moments(frame, features=FEATURES):
+    """ The GroupMoments for the rows of a `moments_frame`."""
+    n_groups, k = len(frame), len(features)
+
+    sx = np.column_stack([frame[f'sx_{feature}'].to_numpy() for feature in features])
+    sxy = np.column_stack([frame[f'sxy_{feature}'].to_numpy() for feature in features])
+    sxx = np.empty((n_groups, k, k))
+    for i, a in enumerate(features):
+        for j in range(i, k):
+            sxx[:, i, j] = sxx[:, j, i] = frame[f'sxx_{a}_{features[j]}'].to_numpy()
+
+    return GroupMoments(frame['n'].to_numpy(), sx, frame['sy'].to_numpy(), sxx, sxy,
+                        frame['syy'].to_numpy(), *_offsets(n_groups, features))
+
+
+def fit_moments(totals, features=FEATURES, drop_if_constant=DROP_IF_CONSTANT,
+                min_sample_size=MIN_SAMPLE_SIZE):
+    """ lm_lookup_table rows from a make/model `moments_frame`, same as `fit_grouped_ols`."""
+    totals = totals[totals['n'] >= min_sample_size]
+    moments = frame_moments(totals, features)
+
+    active = np.ones((len(totals), len(features)), dtype=bool)
+    constant = moments.constant()
+    for feature in drop_if_constant:
+        if feature in features:
+            i = list(features).index(feature)
+            active[:, i] = ~constant[:, i]
+
+    intercept, coefficients, r_squared = solve_moments(moments, active)
+
+    keys = totals.index.to_frame(index=False)
+
+    return results_frame(keys, features, intercept, coefficients, r_squared, moments.n)
+
+
+def _empty_totals():
+    index = pd.MultiIndex.from_tuples([], names=['make', 'model'])
+    return pd.DataFrame(columns=moment_columns(), index=index, dtype='float64')
+
+
+class MomentStore:
+    """
+    The running make/model totals for the days [start, end]. `slide` moves
+    the window using two callables: `ingest(first, last)` returns the
+    day/make/model sums for new days (and stores them), and
+    `stored(first, last)` reads back sums stored earlier.
+    """
+
+    def __init__(self, totals=None, start=None, end=None, rebuilt=None):
+        self.totals = totals if totals is not None else _empty_totals()
+        self.start = start
+        self.end = end
+        self.rebuilt = rebuilt
+
+    @staticmethod
+    def _by_make_model(daily):
+        if daily.empty:
+            return _empty_totals()
+        return daily.groupby(level=['make', 'model']).sum()
+
+    def slide(self, end, ingest, stored, window_days=WINDOW_DAYS, rebuild_days=REBUILD_DAYS):
+        start = end - timedelta(days=window_days - 1)
+
+        if self.end is None or start > self.end:
+            # Nothing we have overlaps the new window
+            self.totals = self._by_make_model(ingest(start, end))
+            self.rebuilt = end
+        else:
+            if end > self.end:
+                added = self._by_make_model(ingest(self.end + timedelta(days=1), end))
+                self.totals = self.totals.add(added, fill_value=0)
+
+            if start > self.start:
+                expired = self._by_make_model(stored(self.start, start - timedelta(days=1)))
+                self.totals = self.totals.sub(expired, fill_value=0)
+
+            if self.rebuilt is None or (end - self.rebuilt).days >= rebuild_days:
+                self.totals = self._by_make_model(stored(start, end))
+                self.rebuilt = end
+
+        # Make/models whose listings all fell out of the window
+        self.totals = self.totals[self.totals['n'] > 0.5]
+        self.start, self.end = start, end
+
+    def fit(self, min_sample_size=MIN_SAMPLE_SIZE):
+        return fit_moments(self.totals, min_sample_size=min_sample_size)
+
+
+def _query(client, query, params=None):
+    job_config = bigquery.QueryJobConfig(query_parameters=params or [])
+    return client.query(query, job_config=job_config).to_dataframe()
+
+
+def _day_params(first, last):
+    return [bigquery.ScalarQueryParameter('start_day', 'DATE', first),
+            bigquery.ScalarQueryParameter('end_day', 'DATE', last)]
+
+
+def ingest_days(client, first, last):
+    """
+    Sum the listings posted on [first, last] by day/make/model and store
+    them in lm_daily_moments. Trimming needs the six months up to `last`,
+    so this reads that much of processed_listing_pages however short the
+    range is.
+    """
+    rows = _query(client, DAY_ROWS_QUERY, _day_params(first, last))
+    daily = moments_frame(rows, ['day', 'make', 'model'])
+
+    # Replace rather than append, so re-running a day can't count it twice
+    try:
+        client.query(f"DELETE FROM `{DAILY_TABLE}` WHERE day BETWEEN @start_day AND @end_day",
+                     job_config=bigquery.QueryJobConfig(query_parameters=_day_params(first, last))).result()
+    except NotFound:
+        pass  # first run; the load below creates the table
+
+    if not daily.empty:
+        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        client.load_table_from_dataframe(daily.reset_index(), DAILY_TABLE, job_config=job_config).result()
+
+    return daily
+
+
+def stored_days(client, first, last):
+    """ The lm_daily_moments rows for [first, last], indexed by day/make/model."""
+    daily = _query(client, f"SELECT * FROM `{DAILY_TABLE}` WHERE day BETWEEN @start_day AND @end_day",
+                   _day_params(first, last))
+    return daily.set_index(['day', 'make', 'model'])
+
+
+def load_store(client):
+    """ The window totals saved by the last refit, or an empty store on the first run."""
+    try:
+        totals = _query(client, f"SELECT * FROM `{WINDOW_TABLE}`")
+    except Exception as e:
+        print(f"No window moments yet, starting from scratch: {e}")
+        return MomentStore()
+
+    if totals.empty:
+        return MomentStore()
+
+    start, end, rebuilt = totals[['window_start', 'window_end', 'rebuilt']].iloc[0]
+    totals = totals.drop(columns=['window_start', 'window_end', 'rebuilt']).set_index(['make', 'model'])
+
+    return MomentStore(totals, start, end, rebuilt)
+
+
+def save_store(client, store):
+    totals = store.totals.reset_index()
+    totals['window_start'] = store.start
+    totals['window_end'] = store.end
+    totals['rebuilt'] = store.rebuilt
+
+    job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    client.load_table_from_dataframe(totals, WINDOW_TABLE, job_config=job_config).result()
+
+
+def refit_window(client, today=None):
+    """ Slide the saved window up to SETTLE_DAYS ago and fit every make/model from it."""
+    end = (today or date.today()) - timedelta(days=SETTLE_DAYS)
+
+    store = load_store(client)
+    store.slide(end,
+                ingest=lambda first, last: ingest_days(client, first, last),
+                stored=lambda first, last: stored_days(client, first, last))
+    save_store(client, store)
+
+    print(f"Window {store.start} to {store.end}: {int(store.totals['n'].sum())} listings "
+          f"over {len(store.totals)} make/models.")
+
+    return store.fit()
@@ -1,75 +1,126 @@
+import os
+import socket
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
 from google.cloud import bigquery
-import pandas as pd
-import statsmodels.api as sm
+
+from arrow_loader import load_query, peak_rss_mb
+from grouped_ols import fit_grouped_ols
+from moments_store import refit_window
+
+LM_FIT_VIEW = os.getenv('LM_FIT_VIEW', 'lm_fit_vw')
+LOG_TABLE = 'car-buying-272019.car_buying.log'
+
+
+class RunLog:
+    """
+    Stage timings and counts for a fit, logged to `log` in the same columns the cron jobs
+    write through instrumentation.py (this folder is deployed on its own, so it can't import it).
+    """
+
+    def __init__(self, task):
+        self.task = task
+        self.time_started = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def write(self, client, notes):
+        row = {
+            'task': self.task,
+            'time_started': self.time_started,
+            'time_finished': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            'notes': notes,
+            'hostname': socket.gethostname(),
+            'duration_seconds': round(time.perf_counter() - self.started, 3),
+            'stage_seconds': [{'stage': name, 'seconds': round(seconds, 3)} for name, seconds in sorted(self.stages.items())],
+            'counters': [{'name': name, 'value': value} for name, value in sorted(self.counters.items())],
+        }
+
+        # Losing the log row shouldn't fail a fit that's already been uploaded
+        try:
+            errors = client.insert_rows_json(LOG_TABLE, [row])
+            if errors:
+                print(f"Errors logging the run: {errors}")
+        except Exception as e:
+            print(f"Error logging the run: {e}")
+
+        return row
 
 
 def lm_fit_uploader(request): #simply wrapped everything in a function to use with google cloud function
     # Initialize a BigQuery client
     client = bigquery.Client()
+    run_log = RunLog('lm_fit_uploader')
 
     # Query data from GBQ view lm_fit_vw
     # This view uses last 6 months of listings, filters out rows with any nulls in columns being queries, 
     # maps 'condition' in listing from 6 categories to 0/1, filters to only include makes/models with over 100 listings,
     # then filters out outliers by price - anything below 0.05 quantile or above 0.95 quantile. Exact query can be viewed in GBQ.
 
-    query = """
-        SELECT make, model, year, log_odometer, price, condition_mapped, time_posted FROM `car-buying-272019.car_buying.lm_fit_vw`
+    # Set LM_FIT_VIEW=lm_fit_sketch_vw to trim with the bounds the parse jobs keep in price_quantile_bounds
+    # instead of computing APPROX_QUANTILES over the whole window.
+    query = f"""
+        SELECT make, model, year, log_odometer, price, condition_mapped FROM `car-buying-272019.car_buying.{LM_FIT_VIEW}`
     """
-    query_job = client.query(query)
-    lm_fit_vw = query_job.to_dataframe()
-
-    # Convert 'year', 'odometer', and 'condition_mapped' to float64, which is compatible with statsmodels
-    lm_fit_vw['year'] = lm_fit_vw['year'].astype('float64')
-    lm_fit_vw['log_odometer'] = lm_fit_vw['log_odometer'].astype('float64')
-    lm_fit_vw['condition_mapped'] = lm_fit_vw['condition_mapped'].astype('float64')
-
-
-    # Generate a list of unique make/model combinations from lm_fit_vw
-    unique_make_model = lm_fit_vw[['make', 'model']].drop_duplicates()
-    make_model_list = list(unique_make_model.itertuples(index=False, name=None))
-
-    # Initialize an empty list to store the results
-    results = []
-
-    for make, model in make_model_list:
-        temp_df = lm_fit_vw[(lm_fit_vw['make'] == make) & (lm_fit_vw['model'] == model)]
-        
-        # Ensure there's no missing values in the columns of interest
-        temp_df = temp_df.dropna(subset=['log_odometer', 'year', 'price', 'condition_mapped'])
-        predictors = ['log_odometer', 'condition_mapped']
-        if temp_df['year'].nunique() > 1:
-            predictors.append('year')  # Add 'year' if more than one unique value, if a make/model only has 1 year there will be a bug.
-        
-        X = temp_df[predictors]
-        y = temp_df['price']
-        
-        try:
-            X = sm.add_constant(X)  # Add a constant term for the intercept
-            model_fit = sm.OLS(y, X).fit()
-            
-            # Extract the model parameters
-            intercept = model_fit.params.get('const')
-            miles_coeff = model_fit.params.get('log_odometer', 0)  # Default to 0 if not present
-            condition_coeff = model_fit.params.get('condition_mapped', 0)  # Extract condition coefficient
-            year_coeff = model_fit.params.get('year', 0)  # Default to 0 if 'year' was not included
-            
-            # Store results including the sample size
-            results.append({
-                'make': make, 
-                'model': model, 
-                'intercept': intercept, 
-                'miles_coeff': miles_coeff, 
-                'condition_coeff': condition_coeff,
-                'year_coeff': year_coeff, 
-                'r_squared': model_fit.rsquared, #including r_squared and sample size to add some uncertainty estimate in dashboard
-                'sample_size': len(temp_df)
-            })
-        except Exception as e:
-            print(f"Error fitting model for {make} {model}: {e}")
 
-    # Convert the list of dictionaries to a DataFrame
-    lm_lookup_table = pd.DataFrame(results)
+    # Streamed in as Arrow batches, with make/model as category codes and compact numeric columns (see arrow_loader)
+    with run_log.stage('load'):
+        lm_fit_vw = load_query(client, query)
+    run_log.count('rows_loaded', len(lm_fit_vw))
+    run_log.count('bytes_loaded', lm_fit_vw.memory_usage(deep=True).sum())
+    print(f"Loaded {len(lm_fit_vw)} rows, {lm_fit_vw.memory_usage(deep=True).sum() / 2**20:.1f} MB; "
+          f"peak RSS so far {peak_rss_mb():.0f} MB")
+
+    # Fit every make/model at once from per-group normal equations (see grouped_ols). Same rules as the
+    # old per-pair statsmodels loop: rows with nulls are dropped, 'year' is left out for make/models with
+    # only one year, and the coefficients, r_squared and sample_size match what OLS gave.
+    with run_log.stage('fit'):
+        lm_lookup_table = fit_grouped_ols(lm_fit_vw)
+    print(f"Fit {len(lm_lookup_table)} make/models; peak RSS {peak_rss_mb():.0f} MB")
+
+    return _upload_and_log(client, lm_lookup_table, run_log)
+
+
+def lm_refit_uploader(request):
+    # Incremental alternative to lm_fit_uploader, cheap enough to run daily. Only the days that entered the
+    # window are read from processed listings; the rest comes from stored per-day sums (see moments_store).
+    client = bigquery.Client()
+    run_log = RunLog('lm_refit_uploader')
+
+    with run_log.stage('refit'):
+        lm_lookup_table = refit_window(client)
+
+    return _upload_and_log(client, lm_lookup_table, run_log)
+
+
+def _upload_and_log(client, lm_lookup_table, run_log):
+    with run_log.stage('upload'):
+        result = upload_lm_lookup_table(client, lm_lookup_table)
+
+    run_log.count('make_models_fit', len(lm_lookup_table))
+    run_log.count('peak_rss_mb', peak_rss_mb())
+    row = run_log.write(client, f"fit {len(lm_lookup_table)} make/models")
+
+    result['stage_seconds'] = {stage['stage']: stage['seconds'] for stage in row['stage_seconds']}
+
+    return result
+
 
+def upload_lm_lookup_table(client, lm_lookup_table):
     # Define the schema
     schema = [
         bigquery.SchemaField("make", "STRING"),
@@ -94,4 +145,4 @@ def lm_fit_uploader(request): #simply wrapped everything in a function to use wi
     # Wait for the job to complete
     job.result()
 
-    return {"message": f"uploaded and overwrote data in {table_id}"}
+    return {"message": f"uploaded and overwrote data in {table_id}", "peak_rss_mb": round(peak_rss_mb())}
@@ -0,0 +1,141 @@
+"""
+A compiled make/model index for the listing parser.
+
+The old approach looped over every make (and then every model of that make)
+and ran substring tests against the listing name and title. That gets slower
+as `make_model_year` grows, and the winning model depended on set iteration
+order. Here we build an Aho-Corasick automaton once from the output of
+`get_make_models` and find every candidate make and model in a single pass
+over the text. When several candidates hit, the longest pattern wins, then
+the earliest one in the text, then alphabetical order, so results are
+deterministic.
+"""
+
+from collections import deque
+
+from fuzzy_matcher import FuzzyIndex
+
+
+class AhoCorasick :
+    """
+    A plain character-level Aho-Corasick automaton. Each pattern carries a
+    list of payloads; `scan` yields (start, length, payload) for every
+    occurrence of every pattern in the text.
+    """
+
+    def __init__(self, patterns) :
+        # patterns: dict of pattern string -> list of payloads
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+        for pattern, payloads in patterns.items() :
+            if not pattern :
+                continue
+
+            state = 0
+            for char in pattern :
+                next_state = self.goto[state].get(char)
+                if next_state is None :
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = next_state
+
+            self.out[state].extend((len(pattern), payload) for payload in payloads)
+
+        # Breadth-first pass to fill in the failure links and merge outputs.
+        queue = deque(self.goto[0].values())
+
+        while queue :
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items() :
+                queue.append(next_state)
+
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback] :
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def scan(self, text) :
+        state = 0
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        for idx, char in enumerate(text) :
+            while state and char not in goto[state] :
+                state = fail[state]
+            state = goto[state].get(char, 0)
+
+            for length, payload in out[state] :
+                yield (idx - length + 1, length, payload)
+
+
+def _rank(hits) :
+    """ Longest match first, then earliest in the text, then alphabetical."""
+    return(sorted(hits, key=lambda hit : (-hit[1], hit[0], hit[2])))
+
+
+class MakeModelMatcher :
+    """
+    Built once per run from the `make -> set of models` dictionary that
+    `get_make_models` returns. Both the plain and the hyphen-to-space form
+    of each make and model are indexed, matching the old substring tests.
+    `fuzzy` holds an n-gram index of the models per make for misspellings.
+    """
+
+    def __init__(self, make_2_models) :
+        make_patterns = {}
+        model_patterns = {}
+
+        for make in sorted(make_2_models) :
+            for pattern in {make, make.replace("-"," ")} :
+                make_patterns.setdefault(pattern, []).append(make)
+
+            for model in sorted(make_2_models[make]) :
+                for pattern in {model, model.replace("-"," ")} :
+                    model_patterns.setdefault(pattern, []).append((make, model))
+
+        self.makes = frozenset(make_2_models)
+        self.make_index = AhoCorasick(make_patterns)
+        self.model_index = AhoCorasick(model_patterns)
+        self.fuzzy = FuzzyIndex(make_2_models)
+
+    def find_makes(self, text) :
+        """ Every make found in `text`, best candidate first."""
+        if not text :
+            return([])
+
+        hits = {}
+        for start, length, make in self.make_index.scan(text) :
+            # keep the best hit for each make
+            if make not in hits or (-length, start) < (-hits[make][1], hits[make][0]) :
+                hits[make] = (start, length, make)
+
+        return([hit[2] for hit in _rank(hits.values())])
+
+    def find_models(self, text, make) :
+        """ Every model of `make` found in `text`, best candidate first."""
+        if not text :
+            return([])
+
+        hits = {}
+        for start, length, (this_make, model) in self.model_index.scan(text) :
+            if this_make != make :
+                continue
+            if model not in hits or (-length, start) < (-hits[model][1], hits[model][0]) :
+                hits[model] = (start, length, model)
+
+        return([hit[2] for hit in _rank(hits.values())])
+
+    def best_make(self, text) :
+        makes = self.find_makes(text)
+        return(makes[0] if makes else None)
+
+    def best_model(self, text, make) :
+        models = self.find_models(text, make)
+        return(models[0] if models else None)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A long-running mode that runs all four cron jobs as one process.
+
+Run as cron jobs, the stages only meet through `links_need_harvesting` and
+`raw_listing_pages`, so a listing waits for the next harvest run (130 links
+at a time), then for the next parse run, and can take hours to reach
+`processed_listing_pages`. Here each stage is a thread and the stages are
+linked by bounded queues:
+
+    discovery -> links -> harvest -> pages -> parse -> rows -> writer
+
+Discovery sweeps the scheduled locations the same way get_links does. Each
+new link goes to `links_need_harvesting` and onto the link queue. The
+harvester fetches links in small batches and stores them in
+`raw_listing_pages`. It then removes them from `links_need_harvesting`
+(the cleanup job) and passes the pages on. The parser turns pages into rows
+and the writer appends them to `processed_listing_pages` in batches. A full
+queue blocks the stage feeding it, so a slow parser slows the harvester,
+which in turn pauses crawling.
+
+Every table the cron jobs write is still written, so the tables remain the
+audit trail. Anything that never makes it through, such as a failed fetch
+or a run stopped mid-batch, is left where the cron jobs will find it. On
+the way out the harvest and parse checkpoints are marked for a full
+reconcile, so the cron jobs pick up cleanly after a pipeline run.
+
+Stop it with Ctrl-C or SIGTERM. Discovery stops and the queues drain.
+PIPELINE_SWEEPS limits how many discovery sweeps to run (0 runs until
+stopped).
+"""
+
+import os
+import queue
+import signal
+import socket
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from async_harvest import harvest_async
+from checkpoints import request_reconcile
+from crawl_schedule import MIN_REVISIT_HOURS, LocationStats, load_locations, revisit_hours, schedule
+from get_links import crawl_locations, get_all_locations, load_recent_pulls, new_link_rows
+from harvest_pages import harvest_serial, pages_to_rows
+from harvest_retry import HostBackoff
+from make_model_matcher import MakeModelMatcher
+from price_bounds import load_price_sketches
+from price_scoring import load_scorer
+from process_listing_pages import get_make_models, parse_pool, parse_rows
+from warehouse import connect_warehouse
+
+LINK_QUEUE_SIZE = int(os.getenv("PIPELINE_LINK_QUEUE_SIZE", "2000"))
+PAGE_QUEUE_SIZE = int(os.getenv("PIPELINE_PAGE_QUEUE_SIZE", "200"))
+ROW_QUEUE_SIZE = int(os.getenv("PIPELINE_ROW_QUEUE_SIZE", "1000"))
+
+HARVEST_BATCH = int(os.getenv("PIPELINE_HARVEST_BATCH", "50"))
+PARSE_BATCH = int(os.getenv("PIPELINE_PARSE_BATCH", "50"))
+FLUSH_SIZE = int(os.getenv("PIPELINE_FLUSH_SIZE", "100"))
+
+# How long a stage waits to fill a batch before working on what it has
+MAX_WAIT_SECONDS = float(os.getenv("PIPELINE_MAX_WAIT_SECONDS", "20"))
+
+SWEEP_MINUTES = float(os.getenv("PIPELINE_SWEEP_MINUTES", "60"))
+LOG_MINUTES = float(os.getenv("PIPELINE_LOG_MINUTES", "15"))
+
+# Put on a queue by a stage that has finished
+_DONE = object()
+
+
+class PipelineStats :
+    """ Counters shared by the stages, plus discovery-to-written latency."""
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.discovered = {}
+        self.latencies = deque(maxlen=1000)
+
+    def add(self, name, n=1) :
+        with self.lock :
+            self.counts[name] += n
+
+    def found(self, urls) :
+        now = time.monotonic()
+        with self.lock :
+            for url in urls :
+                self.discovered.setdefault(url, now)
+
+    def dropped(self, urls) :
+        with self.lock :
+            for url in urls :
+                self.discovered.pop(url, None)
+
+    def written(self, urls) :
+        now = time.monotonic()
+        with self.lock :
+            for url in urls :
+                found = self.discovered.pop(url, None)
+                if found is not None :
+                    self.latencies.append(now - found)
+
+    def summary(self) :
+        with self.lock :
+            counts = dict(self.counts)
+            latencies = list(self.latencies)
+
+        notes = ", ".join(f"{counts.get(name, 0)} {name}"
+                          for name in ("links found", "pages harvested", "pages parsed", "rows written"))
+
+        if latencies :
+            notes += f", median {statistics.median(latencies) / 60:.1f} min from discovery to written"
+
+        return(notes)
+
+
+def _put(q, item, abort) :
+    """ Put `item` on `q`, waiting for room. Gives up if the pipeline is aborting."""
+    while not abort.is_set() :
+        try :
+            q.put(item, timeout=1)
+            return(True)
+        except queue.Full :
+            continue
+    return(False)
+
+
+def _drain(q, max_items, max_wait, abort) :
+    """
+    Wait for the next item on `q`, then keep taking items until there are
+    `max_items` or `max_wait` seconds have passed. Returns (batch, done),
+    where `done` means the stage upstream has finished.
+    """
+    while True :
+        if abort.is_set() :
+            return([], True)
+        try :
+            item = q.get(timeout=1)
+            break
+        except queue.Empty :
+            continue
+
+    if item is _DONE :
+        return([], True)
+
+    batch = [item]
+    deadline = time.monotonic() + max_wait
+
+    while len(batch) < max_items :
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 :
+            break
+        try :
+            item = q.get(timeout=remaining)
+        except queue.Empty :
+            break
+        if item is _DONE :
+            return(batch, True)
+        batch.append(item)
+
+    return(batch, False)
+
+
+def discover(link_queue, stats, stop, abort, sweeps=0) :
+    """ Crawl the scheduled locations every SWEEP_MINUTES, queueing the new links."""
+
+    warehouse = connect_warehouse()
+    seen_index = load_recent_pulls(warehouse)
+
+    pool_size = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+    max_locations = int(os.getenv("BROWSER_MAX_LOCATIONS", "25"))
+    page_budget = os.getenv("CRAWL_PAGE_BUDGET")
+
+    # Sweeps come round every SWEEP_MINUTES rather than every cron interval
+    min_revisit_hours = revisit_hours(SWEEP_MINUTES / 60, MIN_REVISIT_HOURS)
+
+    sweep = 0
+
+    try :
+        while not stop.is_set() :
+            sweep_started = time.monotonic()
+
+            locations = load_locations(get_all_locations)
+            location_stats = LocationStats.load()
+            scheduled = schedule(list(locations), location_stats,
+                                 page_budget=float(page_budget) if page_budget else None,
+                                 min_revisit_hours=min_revisit_hours)
+
+            now = datetime.utcnow()
+            lapsed = {location for location in scheduled if location_stats.lapsed(location, now)}
+
+            print(f"Sweep {sweep + 1}: crawling {len(scheduled)} of {len(locations)} locations, "
+                  f"{len(lapsed)} of them in full.")
+
+            for location, location_links, pages in crawl_locations(locations, scheduled,
+                                                                   pool_size, max_locations,
+                                                                   lapsed=lapsed) :
+                upload_data = new_link_rows(location_links, location, seen_index)
+
+                if pages :
+                    location_stats.record(location, len(upload_data), pages, full=location in lapsed)
+
+                # Stored first, so a link we never get to is still harvested
+                # by the cron job.
+                warehouse.upload('links_need_harvesting', upload_data)
+
+                stats.found([row["url"] for row in upload_data])
+                stats.add("links found", len(upload_data))
+
+                for row in upload_data :
+                    if not _put(link_queue, (row["url"], row["location"]), abort) :
+                        return
+
+                if stop.is_set() :
+                    break
+
+            seen_index.save()
+            location_stats.save()
+
+            sweep += 1
+            if sweeps and sweep >= sweeps :
+                break
+
+            stop.wait(max(0, SWEEP_MINUTES * 60 - (time.monotonic() - sweep_started)))
+    finally :
+        seen_index.save()
+        warehouse.close()
+
+
+def harvest(link_queue, page_queue, stats, abort) :
+    """ Fetch queued links, store them in raw_listing_pages and pass the pages on."""
+
+    warehouse = connect_warehouse()
+    harvest_mode = os.getenv("HARVEST_MODE", "serial")
+
+    # Hosts that throttle us are left alone for a while; their links are
+    # dropped here and left to the cron job's retry queue.
+    backoff = HostBackoff()
+
+    try :
+        done = False
+        while not done :
+            links, done = _drain(link_queue, HARVEST_BATCH, MAX_WAIT_SECONDS, abort)
+            if not links :
+                continue
+
+            if harvest_mode == "async" :
+                fetched = harvest_async(links, backoff=backoff)
+            else :
+                fetched = harvest_serial(links, backoff=backoff)
+
+            rows, failed_links = pages_to_rows(fetched)
+
+            failures = warehouse.append_rows('raw_listing_pages', rows)
+            failed_links.update(failure['row']['url'] for failure in failures)
+
+            if failures :
+                print(f"Errors occurred while inserting {len(failures)} of {len(rows)} raw pages:",
+                      [failure['errors'] for failure in failures])
+
+            # Failed links stay in links_need_harvesting for the cron job
+            stored = [row for row in rows if row["url"] not in failed_links]
+            stats.dropped(failed_links)
+            stats.add("pages harvested", len(stored))
+
+            if stored :
+                warehouse.delete_harvested_links([row["url"] for row in stored])
+
+            for row in stored :
+                if not _put(page_queue, (row["url"], row["raw_html"], row["location"]), abort) :
+                    return
+    finally :
+        warehouse.close()
+
+
+def parse(page_queue, row_queue, matcher, stats, abort) :
+    """ Parse queued pages into processed rows."""
+
+    # Set PARSE_WORKERS to spread the soup parsing over several cores.
+    workers = int(os.getenv("PARSE_WORKERS", "1"))
+    pool = parse_pool(matcher, workers) if workers > 1 else None
+
+    try :
+        done = False
+        while not done :
+            pages, done = _drain(page_queue, PARSE_BATCH, MAX_WAIT_SECONDS, abort)
+            if not pages :
+                continue
+
+            for row in parse_rows(pages, matcher, workers=workers, pool=pool) :
+                stats.add("pages parsed")
+                if not _put(row_queue, row, abort) :
+                    return
+    finally :
+        if pool is not None :
+            pool.terminate()
+
+
+def write(row_queue, stats, abort) :
+    """
+    Price parsed rows and append them to processed_listing_pages in batches,
+    adding the stored ones to the price sketches.
+    """
+
+    warehouse = connect_warehouse()
+    scorer = load_scorer(warehouse)
+    sketches = load_price_sketches()
+
+    try :
+        done = False
+        while not done :
+            batch, done = _drain(row_queue, FLUSH_SIZE, MAX_WAIT_SECONDS, abort)
+            if not batch :
+                continue
+
+            if scorer is not None :
+                scorer.refresh(warehouse)
+                scorer.score_rows(batch)
+
+            failures = warehouse.append_rows('processed_listing_pages', batch)
+
+            if failures :
+                print(f"Errors occurred while inserting {len(failures)} of {len(batch)} processed rows:",
+                      [failure['errors'] for failure in failures])
+
+            failed_urls = {failure['row']['url'] for failure in failures}
+            written = [row["url"] for row in batch if row["url"] not in failed_urls]
+
+            stats.dropped(failed_urls)
+            stats.written(written)
+            stats.add("rows written", len(written))
+
+            if sketches is not None :
+                sketches.update_rows([row for row in batch if row["url"] not in failed_urls])
+                sketches.flush(warehouse)
+    finally :
+        if sketches is not None :
+            sketches.flush(warehouse, force=True)
+        warehouse.close()
+
+
+def _run_stage(name, target, args, out_queue, abort) :
+    try :
+        target(*args)
+    except Exception as e :
+        print(f"Pipeline stage {name} failed, stopping: {e}")
+        abort.set()
+    finally :
+        # Let the next stage know nothing more is coming
+        if out_queue is not None :
+            _put(out_queue, _DONE, abort)
+
+
+def main() :
+
+    start = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    hostname = socket.gethostname()
+
+    # BigQuery by default; set WAREHOUSE=sqlite to run against a local copy.
+    # Each stage opens its own connection; this one is for the log.
+    warehouse = connect_warehouse()
+    matcher = MakeModelMatcher(get_make_models(warehouse))
+
+    sweeps = int(os.getenv("PIPELINE_SWEEPS", "0"))
+
+    link_queue = queue.Queue(maxsize=LINK_QUEUE_SIZE)
+    page_queue = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+    row_queue = queue.Queue(maxsize=ROW_QUEUE_SIZE)
+
+    stats = PipelineStats()
+    stop = threading.Event()
+    abort = threading.Event()
+
+    stages = [
+        ("discovery", discover, (link_queue, stats, stop, abort, sweeps), link_queue),
+        ("harvest", harvest, (link_queue, page_queue, stats, abort), page_queue),
+        ("parse", parse, (page_queue, row_queue, matcher, stats, abort), row_queue),
+        ("write", write, (row_queue, stats, abort), None),
+    ]
+
+    threads = [threading.Thread(target=_run_stage, name=name,
+                                args=(name, target, args, out_queue, abort))
+               for name, target, args, out_queue in stages]
+
+    def request_stop(signum, frame) :
+        print("Stopping discovery; letting the queues drain.")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for thread in threads :
+        thread.start()
+
+    # Log the running totals every LOG_MINUTES while the stages run. Each
+    # row covers its own interval; the totals in the notes are since `start`.
+    interval_start = start
+    while any(thread.is_alive() for thread in threads) :
+        deadline = time.monotonic() + LOG_MINUTES * 60
+        for thread in threads :
+            thread.join(timeout=max(0, deadline - time.monotonic()))
+
+        now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"Pipeline: {stats.summary()}.")
+
+        warehouse.upload('log', [{
+            'task' : "streaming_pipeline",
+            'time_started' : interval_start,
+            'time_finished' : now,
+            'notes' : f"{stats.summary()} since {start} on {hostname}."
+        }])
+        interval_start = now
+
+    # The cron jobs' watermarks didn't see what we consumed, so have them
+    # start from a full anti-join next time.
+    request_reconcile("harvesting_pages")
+    request_reconcile("basic_html_parsing")
+
+    warehouse.close()
+
+    return(1 if abort.is_set() else 0)
+
+
+if __name__ == '__main__':
+    main()
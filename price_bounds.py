@@ -0,0 +1,263 @@
+"""
+Price outlier bounds for each make/model/year, kept up to date as listings
+are parsed.
+
+lm_fit_vw trims each make/model/year to prices between its 5th and 95th
+percentiles. To get those it runs APPROX_QUANTILES over six months of
+processed_listing_pages on every fit. Here every parsed batch goes into a
+KLL sketch (see quantile_sketch) per make/model/year and week posted. The
+bounds for the window are the quantiles of the merged weekly sketches.
+They're worked out for every make/model/year in one vectorized pass and
+published to the `price_quantile_bounds` table, which lm_fit_sketch_vw
+joins in place of the quantile query. In-process callers look them up
+with `bounds()`.
+
+Only rows lm_fit_vw would keep go in: make, model, year, odometer, price
+and condition all present. Whole weeks fall out of the window, so its
+start is up to a week earlier than lm_fit_vw's. The sketches are saved to
+PRICE_SKETCH_PATH, next to the job checkpoints; don't run two writers
+against the same file at once.
+"""
+
+import json
+import math
+import os
+import struct
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+
+from checkpoints import CHECKPOINT_DIR
+from price_scoring import number_or_nan
+from quantile_sketch import KLLSketch
+
+PRICE_SKETCHES = os.getenv("PRICE_SKETCHES", "1") == "1"
+SKETCH_PATH = os.getenv("PRICE_SKETCH_PATH", os.path.join(CHECKPOINT_DIR, "price_sketches.bin"))
+PUBLISH_SECONDS = float(os.getenv("PRICE_BOUNDS_PUBLISH_SECONDS", "900"))
+
+BOUNDS_TABLE = "price_quantile_bounds"
+WINDOW_DAYS = 6 * 30
+LOW_QUANTILE = 0.05
+HIGH_QUANTILE = 0.95
+
+_MAGIC = b"PSK1"
+_LENGTH = struct.Struct("<I")
+
+
+def _week(day) :
+    """ The Monday starting `day`'s week, as YYYY-MM-DD."""
+    return((day - timedelta(days=day.weekday())).strftime("%Y-%m-%d"))
+
+
+@lru_cache(maxsize=4096)
+def _posted_week(day) :
+    return(_week(date.fromisoformat(day)))
+
+
+def row_key(row) :
+    """ ((make, model, year, week), price) for a parsed row, or None if lm_fit_vw would drop it."""
+    fields = ("make", "model", "year", "odometer", "price", "condition", "time_posted")
+    if any(row.get(field) is None for field in fields) :
+        return(None)
+
+    price = number_or_nan(row["price"])
+    year = number_or_nan(row["year"])
+    if math.isnan(price) or math.isnan(year) :
+        return(None)
+
+    try :
+        week = _posted_week(row["time_posted"][:10])
+    except (TypeError, ValueError) :
+        return(None)
+
+    return((row["make"], row["model"], int(year), week), price)
+
+
+class PriceSketches :
+
+    def __init__(self, sketches=None, path=SKETCH_PATH) :
+        self.sketches = sketches if sketches is not None else {}
+        self.path = path
+        self.changed = False
+        self.flushed = time.monotonic()
+        self._bounds = None
+
+    def __len__(self) :
+        return(len(self.sketches))
+
+    def update_rows(self, rows) :
+        """ Add the prices of parsed rows to their make/model/year/week sketches."""
+        prices = defaultdict(list)
+
+        for row in rows :
+            keyed = row_key(row)
+            if keyed is not None :
+                prices[keyed[0]].append(keyed[1])
+
+        for key, values in prices.items() :
+            sketch = self.sketches.get(key)
+            if sketch is None :
+                sketch = self.sketches[key] = KLLSketch()
+            sketch.update(values)
+
+        if prices :
+            self.changed = True
+            self._bounds = None
+
+        return(sum(map(len, prices.values())))
+
+    def expire(self, today=None) :
+        """ Drop the weeks that have left the window."""
+        first_week = _week((today or datetime.utcnow()) - timedelta(days=WINDOW_DAYS))
+
+        for key in [key for key in self.sketches if key[3] < first_week] :
+            del self.sketches[key]
+            self.changed = True
+            self._bounds = None
+
+    def window_bounds(self, today=None, low=LOW_QUANTILE, high=HIGH_QUANTILE) :
+        """ {(make, model, year): (low bound, high bound, listings)} over the window's weeks."""
+        first_week = _week((today or datetime.utcnow()) - timedelta(days=WINDOW_DAYS))
+
+        keys = {}
+        codes, values, weights = [], [], []
+
+        for (make, model, year, week), sketch in self.sketches.items() :
+            if week < first_week or not len(sketch) :
+                continue
+            code = keys.setdefault((make, model, year), len(keys))
+            sketch_values, sketch_weights = sketch.weighted()
+            codes.append(np.full(len(sketch_values), code, dtype="int64"))
+            values.append(sketch_values)
+            weights.append(sketch_weights)
+
+        if not keys :
+            return({})
+
+        codes = np.concatenate(codes)
+        values = np.concatenate(values)
+        weights = np.concatenate(weights)
+
+        # Sort by make/model/year, then price. The running weight then climbs
+        # through each group in turn, so one searchsorted finds every
+        # group's quantile at once.
+        order = np.lexsort((values, codes))
+        values = values[order]
+        cumulative = np.cumsum(weights[order])
+
+        totals = np.bincount(codes, weights=weights, minlength=len(keys)).astype("int64")
+        base = np.cumsum(totals) - totals
+
+        def quantile(q) :
+            index = np.searchsorted(cumulative, base + q * (totals - 1), side="right")
+            return(values[np.minimum(index, len(values) - 1)].tolist())
+
+        return({key: bounds for key, bounds in zip(keys, zip(quantile(low), quantile(high), totals.tolist()))})
+
+    def bounds(self, make, model, year) :
+        """ (low, high, listings) for one make/model/year, or None if there's no data."""
+        if self._bounds is None :
+            self._bounds = self.window_bounds()
+        return(self._bounds.get((make, model, year)))
+
+    def save(self, path=None) :
+        path = path or self.path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "wb") as f :
+            f.write(_MAGIC + _LENGTH.pack(len(self.sketches)))
+            for key, sketch in self.sketches.items() :
+                key_bytes = json.dumps(key).encode("utf-8")
+                sketch_bytes = sketch.to_bytes()
+                f.write(_LENGTH.pack(len(key_bytes)) + key_bytes + _LENGTH.pack(len(sketch_bytes)) + sketch_bytes)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=SKETCH_PATH) :
+        if not os.path.exists(path) :
+            return(cls(path=path))
+
+        with open(path, "rb") as f :
+            data = f.read()
+
+        if data[:len(_MAGIC)] != _MAGIC :
+            raise ValueError(f"{path} isn't a price sketch file")
+
+        offset = len(_MAGIC)
+        (count,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+
+        sketches = {}
+        for _ in range(count) :
+            (key_length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            key = tuple(json.loads(data[offset:offset + key_length]))
+            offset += key_length
+
+            (sketch_length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            sketches[key] = KLLSketch.from_bytes(data[offset:offset + sketch_length])
+            offset += sketch_length
+
+        return(cls(sketches, path))
+
+    def publish(self, warehouse) :
+        """ Replace the price_quantile_bounds table with the current window's bounds."""
+        import pandas as pd
+
+        bounds = self.window_bounds()
+        self._bounds = bounds
+
+        df = pd.DataFrame([(make, model, year, low, high, n)
+                           for (make, model, year), (low, high, n) in bounds.items()],
+                          columns=["make", "model", "year", "low_quantile", "high_quantile", "sample_size"])
+        df["updated"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+        warehouse.load_dataframe(df, BOUNDS_TABLE)
+
+        return(len(df))
+
+    def flush(self, warehouse, every=PUBLISH_SECONDS, force=False) :
+        """
+        Save the sketches and publish the bounds if anything has changed,
+        at most once every `every` seconds unless `force`. Errors are
+        printed rather than raised so they can't stop a parse run.
+        """
+        if not self.changed or (not force and time.monotonic() - self.flushed < every) :
+            return(False)
+
+        self.flushed = time.monotonic()
+
+        try :
+            self.expire()
+            self.save()
+            published = self.publish(warehouse)
+        except Exception as e :
+            print(f"Error saving price sketches: {e}")
+            return(False)
+
+        self.changed = False
+        print(f"Published price bounds for {published} make/model/years.")
+
+        return(True)
+
+
+def load_price_sketches() :
+    """ The saved PriceSketches, or None if PRICE_SKETCHES is off or they can't be read."""
+    if not PRICE_SKETCHES :
+        return(None)
+
+    try :
+        sketches = PriceSketches.load()
+    except Exception as e :
+        print(f"Error loading price sketches, not tracking price bounds: {e}")
+        return(None)
+
+    print(f"Tracking price bounds over {len(sketches)} make/model/year weeks.")
+
+    return(sketches)
@@ -0,0 +1,158 @@
+"""
+Expected prices for listings as they're parsed.
+
+The dashboard's predicted price is worked out in hot_deals_dashboard_vw,
+which only runs once a day, so an underpriced car could sit unflagged for
+a day after parsing. `PriceScorer` keeps lm_lookup_table in memory: a
+(make, model) -> row dict over a numpy array of coefficients. It scores a
+whole batch of parsed rows at once, with the view's formula:
+
+    intercept + miles_coeff * LOG(odometer + 0.1)
+              + condition_coeff * condition_mapped + year_coeff * year
+
+`condition_mapped` is 1 for new, like new or excellent, 0 for good, fair
+or salvage, and NULL otherwise. As in SQL, a missing input or a make/model
+with no fit gives no prediction. Each row gets `predicted_price` and
+`deal_ratio` (price / predicted_price; below 1 is cheaper than expected).
+
+The weekly fit rewrites lm_lookup_table. `refresh` checks its version at
+most every SCORING_RELOAD_SECONDS and reloads if it changed, so a
+long-running process picks up new coefficients by itself.
+"""
+
+import math
+import os
+import time
+
+import numpy as np
+
+SCORE_LISTINGS = os.getenv("SCORE_LISTINGS", "1") == "1"
+RELOAD_SECONDS = float(os.getenv("SCORING_RELOAD_SECONDS", "300"))
+
+# Same mapping as hot_deals_dashboard_vw and lm_fit_vw
+CONDITION_MAPPING = {
+    "new": 1.0, "like new": 1.0, "excellent": 1.0,
+    "good": 0.0, "fair": 0.0, "salvage": 0.0,
+}
+
+_NAN = float("nan")
+
+
+def number_or_nan(value) :
+    """ A float from a parsed field, or NaN if it's missing or not a number."""
+    if value is None :
+        return(_NAN)
+    try :
+        if isinstance(value, str) :
+            value = value.replace(",", "")
+        return(float(value))
+    except (TypeError, ValueError) :
+        return(_NAN)
+
+
+class PriceScorer :
+
+    def __init__(self, lookup_rows=(), version=None) :
+        self.version = version
+        self.checked = time.monotonic()
+        self._build(lookup_rows)
+
+    def _build(self, lookup_rows) :
+        index = {}
+        coefficients = []
+
+        for make, model, intercept, miles_coeff, condition_coeff, year_coeff, *_ in lookup_rows :
+            index[(make, model)] = len(coefficients)
+            coefficients.append([number_or_nan(intercept), number_or_nan(miles_coeff),
+                                 number_or_nan(condition_coeff), number_or_nan(year_coeff)])
+
+        # The last row is all NaN, for make/models without a fit
+        coefficients.append([_NAN] * 4)
+
+        self.index = index
+        self.coefficients = np.array(coefficients, dtype="float64")
+
+    def __len__(self) :
+        return(len(self.index))
+
+    @classmethod
+    def load(cls, warehouse) :
+        version = warehouse.lm_lookup_version()
+        return(cls(warehouse.lm_lookup(), version))
+
+    def refresh(self, warehouse, every=RELOAD_SECONDS) :
+        """
+        Reload if lm_lookup_table has changed, checking at most once every
+        `every` seconds. Keeps the current coefficients if the check fails.
+        """
+        if time.monotonic() - self.checked < every :
+            return(False)
+
+        self.checked = time.monotonic()
+
+        try :
+            version = warehouse.lm_lookup_version()
+            if version == self.version :
+                return(False)
+            self._build(warehouse.lm_lookup())
+        except Exception as e :
+            print(f"Error reloading lm_lookup_table, keeping the loaded models: {e}")
+            return(False)
+
+        self.version = version
+        print(f"Reloaded lm_lookup_table: {len(self)} make/models.")
+
+        return(True)
+
+    def score(self, rows) :
+        """ (predicted_price, deal_ratio) arrays for parsed rows; NaN where there's no score."""
+        count = len(rows)
+        no_fit = len(self.coefficients) - 1
+
+        idx = np.fromiter((self.index.get((row.get("make"), row.get("model")), no_fit) for row in rows),
+                          dtype=np.intp, count=count)
+        odometer = np.fromiter((number_or_nan(row.get("odometer")) for row in rows), dtype="float64", count=count)
+        condition = np.fromiter((CONDITION_MAPPING.get(row.get("condition"), _NAN) for row in rows),
+                                dtype="float64", count=count)
+        year = np.fromiter((number_or_nan(row.get("year")) for row in rows), dtype="float64", count=count)
+        price = np.fromiter((number_or_nan(row.get("price")) for row in rows), dtype="float64", count=count)
+
+        coefficients = self.coefficients[idx]
+
+        with np.errstate(invalid="ignore", divide="ignore") :
+            predicted = (coefficients[:, 0]
+                         + coefficients[:, 1] * np.log(odometer + 0.1)
+                         + coefficients[:, 2] * condition
+                         + coefficients[:, 3] * year)
+            ratio = np.where(predicted > 0, price / predicted, _NAN)
+
+        return(predicted, ratio)
+
+    def score_rows(self, rows) :
+        """ Add `predicted_price` and `deal_ratio` to each parsed row, in place."""
+        if not rows :
+            return(rows)
+
+        predicted, ratio = self.score(rows)
+
+        for row, row_predicted, row_ratio in zip(rows, predicted.tolist(), ratio.tolist()) :
+            row["predicted_price"] = None if math.isnan(row_predicted) else row_predicted
+            row["deal_ratio"] = None if math.isnan(row_ratio) else row_ratio
+
+        return(rows)
+
+
+def load_scorer(warehouse) :
+    """ A PriceScorer, or None if SCORE_LISTINGS is off or the lookup table can't be read."""
+    if not SCORE_LISTINGS :
+        return(None)
+
+    try :
+        scorer = PriceScorer.load(warehouse)
+    except Exception as e :
+        print(f"Error loading lm_lookup_table, not scoring listings: {e}")
+        return(None)
+
+    print(f"Scoring listings against {len(scorer)} make/model price models.")
+
+    return(scorer)
@@ -1,93 +1,66 @@
 # This file processes the raw listing pages. 
 
 from datetime import datetime
-import re 
-from collections import defaultdict
+import re
+from collections import defaultdict, deque
+from functools import cached_property
 from bs4 import BeautifulSoup
-import random
 from dateutil import parser # pip install python-dateutil 
 import json
+import time
+from itertools import islice
+from multiprocessing import Pool
 
 
 import os
+import random
 
-from google.cloud import bigquery
-from google.oauth2 import service_account
-
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-
-def get_processed_needs_basic(client) : 
+from batch_sizing import BatchSizer
+from checkpoints import advance_checkpoint, consumed_before_failure, load_checkpoint, needs_reconcile, save_checkpoint
+from fuzzy_matcher import FuzzyIndex
+from instrumentation import RunMetrics
+from listing_scanner import ScanError, scan_listing
+from make_model_matcher import MakeModelMatcher
+from price_bounds import load_price_sketches
+from price_scoring import load_scorer
+from raw_page_codec import decode_page
+from warehouse import connect_warehouse
+
+# Set PARSE_FAST_PATH=0 to build the soup for every page. PARSE_VERIFY_RATE
+# is the fraction of fast-path pages to also parse with the soup and diff.
+FAST_PATH = os.getenv("PARSE_FAST_PATH", "1") == "1"
+VERIFY_RATE = float(os.getenv("PARSE_VERIFY_RATE", "0"))
+
+def get_processed_needs_basic(warehouse) : 
   """
-  Query the processed_listing_pages and gather all URLs that have `needs_basic_parsing` set to true.
+  Query the processed_listing_pages and gather all URLs that have `needs_basic_parsing` set to true,
+  least recently processed first.
   """
 
-  query = """
-          SELECT
-            DISTINCT url
-          FROM
-          `car-buying-272019.car_buying.processed_listing_pages`
-          WHERE 
-            needs_basic_parsing IS TRUE;
-        """
-        
-  query_job = client.query(query,
-                          location = "US")
-
-  rows = query_job.result()  # Wait for the job to complete.
-
-  results = []
-
-  for row in rows : 
-    results.append(row[0])
+  return(warehouse.processed_needs_basic())
 
-  return(results)
-
-def get_raw_needs_parsing(client) : 
+def get_raw_needs_parsing(warehouse, checkpoint=None) : 
   """
-    Query the raw_listing_pages and gather all URLs that aren't in processed.
+    Query the raw_listing_pages and gather the URLs that still need parsing,
+    as (url, datetime_pulled) pairs, oldest first. 
+
+    With no checkpoint this is the full reconcile: every URL that isn't in
+    processed. With a checkpoint we only look at pages pulled at or after
+    its watermark, skipping the ones we already took at that timestamp. 
   """
 
-  query = """
-          SELECT
-            DISTINCT url
-          FROM
-          `car-buying-272019.car_buying.raw_listing_pages`
-          WHERE 
-            url NOT IN (
-              SELECT DISTINCT url 
-              FROM
-              `car-buying-272019.car_buying.processed_listing_pages`
-              )
-        """
-          
-  query_job = client.query(query,
-                              location = "US")
-
-  rows = query_job.result()  # Wait for the job to complete.
-
-  results = []
-  for row in rows : 
-      results.append(row[0])
+  if checkpoint is None : 
+    return(warehouse.raw_needs_parsing())
 
-  return(results)
+  return(warehouse.raw_needs_parsing(watermark=checkpoint['watermark'],
+                                     in_flight=checkpoint.get('in_flight', [])))
 
-def get_make_models(client) : 
+def get_make_models(warehouse) : 
   """"
     This function returns a dictionary with three keys: makes, models, and pairs
   """
 
-  query = """
-          SELECT
-            make, model, short_model
-          FROM
-          `car-buying-272019.car_buying.make_model_year`
-        """
-        
-  query_job = client.query(query,
-                            location = "US")
-
-  rows = query_job.result()  # Wait for the job to complete.
+  rows = warehouse.make_models()
 
   results = defaultdict(set)
 
@@ -102,35 +75,185 @@ def get_make_models(client) :
 
   return(results)
 
-def find_best_match(input_str, targets, score_cutoff=90, top_n=3):
+# Small cache of indexes for callers that hand find_best_match a bare
+# list of targets, keyed on the targets themselves. Hashing the tuple is
+# cheap next to building an index; callers matching against the same
+# targets over and over should pass their own `index`.
+_fuzzy_indexes = {}
+
+def find_best_match(input_str, targets, score_cutoff=90, top_n=3, index=None, scope=None):
+    """
+      Fuzzy match `input_str` against `targets`, best match first. Only a
+      short list of targets sharing character n-grams with the input is
+      scored. Pass a prebuilt FuzzyIndex and `scope` (e.g. the make) to
+      skip building one from `targets`.
+    """
     # Check for exact match first
     if input_str in targets:
         return [input_str]
-    
-    # Use fuzzy matching if no exact match is found
-    # Try multiple scorers and return the top n matches
-    scorers = [fuzz.ratio, fuzz.partial_ratio, fuzz.token_sort_ratio, fuzz.token_set_ratio]
-    best_matches = []
-    
-    for scorer in scorers:
-        matches = process.extract(input_str, targets, scorer=scorer, limit=top_n)
-        matches = [match for match in matches if match[1] >= score_cutoff]
-        best_matches.extend(matches)
-
-    # Flatten the list of best matches and remove duplicates
-    best_matches = list(set([match[0] for match in best_matches]))
-
-    return best_matches
+
+    if index is None:
+        key = tuple(targets)
+        index = _fuzzy_indexes.get(key)
+        if index is None:
+            if len(_fuzzy_indexes) >= 64:
+                _fuzzy_indexes.clear()
+            index = FuzzyIndex({None: key})
+            _fuzzy_indexes[key] = index
+        scope = None
+
+    return index.match(input_str, scope, score_cutoff=score_cutoff, top_n=top_n)
         
-def get_post_id(url) : 
+def get_post_id(url) :
   """ Pull the post ID out of a listing URL"""
   # Extracts the ID as the last segment of the URL, remove .html
-  post_id = url.split('/')[-1].split('.')[0]  
+  post_id = url.split('/')[-1].split('.')[0]
   return(post_id)
 
-def get_time_posted(soup) : 
+class ListingDocument :
+  """
+    Wraps the soup for one listing page. The tree is walked a single time
+    in the constructor and the handful of elements the extractors care
+    about are kept. The JSON-LD and the attrgroup are decoded on first
+    use and cached, so calling several `get_*` functions on the same page
+    doesn't search the tree or `json.loads` the same script again.
+  """
 
-  time_tag = soup.find('time', class_='date timeago')
+  def __init__(self, soup) :
+    self.soup = soup
+
+    self.ld_script = None
+    self.attr_divs = []
+    self.title_span = None
+    self.body_section = None
+    self.time_tag = None
+    self.make_model_tag = None
+    self.year_tag = None
+    self.slider_span = None
+
+    if soup is None :
+      return
+
+    # One walk over every tag. We keep the first match for each element
+    # to mirror what `soup.find` used to return.
+    for tag in soup.find_all(True) :
+      name = tag.name
+      tag_id = tag.get('id')
+      classes = tag.get('class') or []
+
+      if name == 'script' :
+        if tag_id == 'ld_posting_data' and self.ld_script is None :
+          self.ld_script = tag
+
+      elif name == 'div' :
+        if 'attr' in classes :
+          self.attr_divs.append(tag)
+
+      elif name == 'span' :
+        if tag_id == 'titletextonly' and self.title_span is None :
+          self.title_span = tag
+        elif self.year_tag is None and " ".join(classes) == 'valu year' :
+          self.year_tag = tag
+        elif self.slider_span is None and 'slider-info' in classes :
+          self.slider_span = tag
+
+      elif name == 'section' :
+        if tag_id == 'postingbody' and self.body_section is None :
+          self.body_section = tag
+
+      elif name == 'time' :
+        if self.time_tag is None and " ".join(classes) == 'date timeago' :
+          self.time_tag = tag
+
+      elif name == 'a' :
+        if self.make_model_tag is None and " ".join(classes) == 'valu makemodel' :
+          self.make_model_tag = tag
+
+  @classmethod
+  def scanned(cls, html) :
+    """
+      The same document found by listing_scanner without building a soup,
+      or None if the scanner can't be sure of the page. Reading a fragment's
+      text can still raise ScanError, in which case use the soup instead.
+    """
+    try :
+      found = scan_listing(html)
+    except ScanError :
+      return(None)
+
+    if found is None :
+      return(None)
+
+    document = cls(None)
+    document.__dict__.update(found)
+    return(document)
+
+  @cached_property
+  def ld_json(self) :
+    """ The decoded `ld_posting_data` JSON-LD, or None if the page has none."""
+    if self.ld_script is None :
+      return(None)
+    return(json.loads(self.ld_script.string))
+
+  @cached_property
+  def offers(self) :
+    if self.ld_json is None :
+      return(None)
+    return(self.ld_json.get('offers'))
+
+  @cached_property
+  def attributes(self) :
+    attributes = {}
+
+    try:
+        for attr in self.attr_divs:
+            # Find the label and value spans within each attribute div
+            label_span = attr.find('span', class_='labl')
+            value_span = attr.find('span', class_='valu')
+            if label_span and value_span:
+                # Extract text from spans and use as key-value pair in attributes dictionary
+                key = label_span.text.strip().rstrip(':')
+                value = value_span.text.strip()
+                attributes[key] = value
+
+    except ScanError:
+        # The scanner couldn't read this page; the caller falls back to the soup
+        raise
+    except Exception as e:
+        print(f"Error parsing attribute group: {e}")
+
+    # Check for 'odometer' attribute to adjust its value if necessary
+    if 'odometer' in attributes:
+       try:
+           if float(attributes['odometer']) < 1000:
+              attributes['odometer'] = float(attributes['odometer']) * 1000
+       except ValueError:
+           # Handle case where odometer value is not a float
+           print(f"Error converting odometer value to float: {attributes['odometer']}")
+
+    return(attributes)
+
+  @cached_property
+  def title_text(self) :
+    if self.title_span is None :
+      return(None)
+    return(self.title_span.text)
+
+  @cached_property
+  def posting_body(self) :
+    if self.body_section is None :
+      return(None)
+    return(self.body_section.text)
+
+def _as_document(soup) :
+  """ Let the `get_*` functions take either a soup or a ListingDocument."""
+  if isinstance(soup, ListingDocument) :
+    return(soup)
+  return(ListingDocument(soup))
+
+def get_time_posted(soup) :
+
+  time_tag = _as_document(soup).time_tag
   posted_time = None
   
   # TODO: do we need to use parser here? I'd think this is a 
@@ -144,14 +267,14 @@ def get_time_posted(soup) :
 
 def get_listing_name(soup): 
     # Extract make and model
-    make_model_tag = soup.find('a', class_='valu makemodel')
+    make_model_tag = _as_document(soup).make_model_tag
     if make_model_tag:
         make_model = make_model_tag.text.strip()
         return make_model
     return None
 
 def get_year(soup): 
-    year_tag = soup.find('span', class_='valu year')
+    year_tag = _as_document(soup).year_tag
     if year_tag:
         year = year_tag.text.strip()
         return int(year)
@@ -215,14 +338,12 @@ def correct_model(text) :
 
   return(text)
 
-def get_make(soup, name, makes) : 
+def get_make(soup, name, matcher) : 
   """
-    Extract the car model from the HTML page. Passing in anything we might
-    use so that I can make this more sophisticated later. Current plan: 
-    remove the year from the name, split on tokens. Look for n-grams 
-    that are in our list of car models. 
-
-    TODO: Don't need to remove the years here....
+    Extract the car make from the HTML page. The listing name is checked
+    first and the title text second. `matcher` is a MakeModelMatcher
+    built once per run, which finds every candidate make in one pass and
+    prefers the longest match.
   """
 
   make = None
@@ -231,9 +352,9 @@ def get_make(soup, name, makes) :
     name = correct_make(name)
     name = name.strip().lower()
 
-    for this_make in makes : 
-      if this_make in name or this_make.replace("-"," ") in name : 
-        return(this_make)
+    make = matcher.best_make(name)
+    if make : 
+      return(make)
 
   title = get_title_text(soup)
 
@@ -242,16 +363,11 @@ def get_make(soup, name, makes) :
     title = correct_make(title)
     title = title.strip().lower()
 
-    for this_make in makes : 
-      if this_make in title or this_make.replace("-"," ") in title : 
-        return(this_make)
-  
-#  if not make :       
-#    print(title)
+    make = matcher.best_make(title)
 
   return(make)
 
-def get_model(make, soup, name, models) : 
+def get_model(make, soup, name, matcher) : 
   """
     Similar to the above, this attempts to extract the model from 
     the listing. For now I'll require a match, but another
@@ -265,9 +381,9 @@ def get_model(make, soup, name, models) :
     name = correct_model(name)
     name = name.strip().lower()
 
-    for this_model in models : 
-      if this_model in name or this_model.replace("-"," ") in name : 
-        return(this_model)
+    model = matcher.best_model(name, make)
+    if model : 
+      return(model)
 
   title = get_title_text(soup)
 
@@ -276,61 +392,52 @@ def get_model(make, soup, name, models) :
     title = correct_model(title)
     title = title.strip().lower()
 
-    for this_model in models : 
-      if this_model in title or this_model.replace("-"," ") in title : 
-        return(this_model)
+    model = matcher.best_model(title, make)
 
+  return(model)
 
+def get_fuzzy_model(make, soup, name, matcher) : 
+  """
+    Fallback for when `get_model` finds no exact match, usually because
+    the model is misspelled. We drop the make and any year from the name
+    (or the title, if there's no name) and fuzzy match what's left
+    against the models of that make.
+  """
 
-  return(model)
+  text = name or get_title_text(soup)
+
+  if not text : 
+    return(None)
+
+  text = correct_model(correct_make(text))
+  text = text.replace(make," ").replace(make.replace("-"," ")," ")
+  text = re.sub(r"\b(19|20)\d{2}\b"," ",text)
+
+  matches = find_best_match(text,
+                            matcher.fuzzy.targets.get(make, []),
+                            index=matcher.fuzzy,
+                            scope=make)
+
+  if matches : 
+    return(matches[0])
+
+  return(None)
 
 
 def parse_attrgroup(soup):
-  
-  attributes = {}
-
-  try:
-      # Extract attributes
-      attrgroup = soup.find_all('div', class_='attr')
-      for attr in attrgroup:
-          # Find the label and value spans within each attribute div
-          label_span = attr.find('span', class_='labl')
-          value_span = attr.find('span', class_='valu')
-          if label_span and value_span:
-              # Extract text from spans and use as key-value pair in attributes dictionary
-              key = label_span.text.strip().rstrip(':')
-              value = value_span.text.strip()
-              attributes[key] = value
-
-  except Exception as e:
-      print(f"Error parsing attribute group: {e}")
-
-  # Check for 'odometer' attribute to adjust its value if necessary
-  if 'odometer' in attributes:
-     try:
-         if float(attributes['odometer']) < 1000:
-            attributes['odometer'] = float(attributes['odometer']) * 1000
-     except ValueError:
-         # Handle case where odometer value is not a float
-         print(f"Error converting odometer value to float: {attributes['odometer']}")
-
-  return(attributes)
+  return(_as_document(soup).attributes)
 
 def get_lat_long(soup) : 
    
   latitude = None
   longitude = None
 
-  script_tag = soup.find('script', {'id': 'ld_posting_data'})
-
-  if script_tag is not None:
-      json_data = json.loads(script_tag.string)
-      offers = json_data.get('offers')
-      if offers:
-          availableAtOrFrom = offers.get('availableAtOrFrom')
-          if availableAtOrFrom and 'geo' in availableAtOrFrom:
-              latitude = availableAtOrFrom['geo'].get('latitude')
-              longitude = availableAtOrFrom['geo'].get('longitude')
+  offers = _as_document(soup).offers
+  if offers:
+      availableAtOrFrom = offers.get('availableAtOrFrom')
+      if availableAtOrFrom and 'geo' in availableAtOrFrom:
+          latitude = availableAtOrFrom['geo'].get('latitude')
+          longitude = availableAtOrFrom['geo'].get('longitude')
 
   return((latitude,longitude))
 
@@ -338,50 +445,36 @@ def get_lat_long(soup) :
 def get_description(soup) : 
   description = None
 
-  script_tag = soup.find('script', {'id': 'ld_posting_data'})
+  json_data = _as_document(soup).ld_json
   
-  if script_tag is not None:
-    json_data = json.loads(script_tag.string)
+  if json_data is not None:
     description = json_data.get('name') + '>>>' + json_data.get('description')
 
   return(description)
 
 def get_title_text(soup) : 
-  title_text = None
-  span_element = soup.find('span', id='titletextonly')
-
-  # Check if the element is found
-  if span_element:
-    title_text = span_element.text
-
-  return(title_text)
+  return(_as_document(soup).title_text)
 
 def get_posting_body(soup) : 
   posting_body = None
   if soup : 
-    section_element = soup.find('section', id='postingbody')
-
-    if section_element : 
-      posting_body = section_element.text
+    posting_body = _as_document(soup).posting_body
 
   return(posting_body)
 
 def get_price(soup) : 
   price = None
 
-  script_tag = soup.find('script', {'id': 'ld_posting_data'})
-  if script_tag is not None:
-    json_data = json.loads(script_tag.string)
-    offers = json_data.get('offers')
-    if offers:
-      price = offers.get('price')
+  offers = _as_document(soup).offers
+  if offers:
+    price = offers.get('price')
 
   return(price)   
 
 def get_num_images(soup) : 
   num_images = None
   
-  span_element = soup.find('span', class_='slider-info')
+  span_element = _as_document(soup).slider_span
   if span_element:
     image_info = span_element.text
     # Extracting the number from the text (assuming the format is "image X of Y")
@@ -389,171 +482,403 @@ def get_num_images(soup) :
 
   return(num_images)
 
-def upload_to_gbq(client,data,dataset_id,table_name) :
 
-    if not data : 
-        return(0)
+def parse_listing_page(url, raw_html, location, matcher) :
+  """
+    Turn one raw listing page into a row for processed_listing_pages.
+    `matcher` is the MakeModelMatcher built from `get_make_models`.
+  """
 
-    table_ref = client.dataset(dataset_id).table(table_name)
-    table = client.get_table(table_ref)
-    errors = client.insert_rows_json(table, data)
+  # Stored pages may be trimmed to fragments and/or compressed; decode_page
+  # hands back plain HTML either way.
+  row, _ = _parse_html(url, decode_page(raw_html), location, matcher)
 
-    if errors == []:
-        print(f"{len(data)} row inserted successfully to {table_name}.")
-    else:
-        print("Errors occurred while inserting rows:", errors)
+  return(row)
 
-    return(len(data))
+def _soup_document(html) :
+  # Walk the tree once; every extractor reads from this
+  return(ListingDocument(BeautifulSoup(html,'html.parser')))
 
-def main() : 
+def _parse_html(url, html, location, matcher) :
+  """
+    (row, path) for a decoded page. Most pages have every fragment we read,
+    so listing_scanner picks them out without a soup ("fast"). The rest
+    are parsed from the soup ("soup").
+  """
 
-  start = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+  if FAST_PATH :
+    document = ListingDocument.scanned(html)
+    if document is not None :
+      try :
+        return(_extract_row(url, document, location, matcher), "fast")
+      except ScanError :
+        pass
 
-  # dotenv stuff
-  service_path = os.getenv("SERVICE_PATH")
-  service_file = os.getenv("SERVICE_FILE")     
-  gbq_proj_id = os.getenv("GBQ_PROJECT_ID") 
-  dataset_id = os.getenv("GBQ_DATASET_ID")
+  return(_extract_row(url, _soup_document(html), location, matcher), "soup")
 
+def diff_rows(fast_row, soup_row) :
+  """ {field: (fast value, soup value)} for the fields where two parses of a page differ."""
+  return({field : (fast_row.get(field), soup_row.get(field))
+          for field in set(fast_row) | set(soup_row)
+          if field != 'basic_processed_time' and fast_row.get(field) != soup_row.get(field)})
 
+def verify_fast_path(url, raw_html, location, matcher) :
+  """
+    Parse a page both ways and diff the rows. Returns the differences
+    (empty if none), or None if the page doesn't take the fast path.
+  """
 
-  credentials = service_account.Credentials.from_service_account_file(service_path + service_file)
+  html = decode_page(raw_html)
+  fast_row, path = _parse_html(url, html, location, matcher)
 
-  bq_client = bigquery.Client(credentials = credentials, project=gbq_proj_id)   
+  if path != "fast" :
+    return(None)
 
-  # Grab our makes and models
-  make_2_models = get_make_models(bq_client) 
+  return(diff_rows(fast_row, _extract_row(url, _soup_document(html), location, matcher)))
 
-  # Grab the URLs we're going to parse. 
-  urls = get_processed_needs_basic(bq_client)
-  urls.extend(get_raw_needs_parsing(bq_client))
-  urls = list(set(urls))
+def _extract_row(url, soup, location, matcher) :
 
-  print(f"We have {len(urls)} that need processing.")
+  # We'll extract all of our row elements in stand-alone functions to allow
+  # for some fine tuning. The exception will be the attribute group, since
+  # from those we'll just pull whatever the poster has filled out. 
+  parsed_attributes = parse_attrgroup(soup)
 
-  url_limit = 2500
-  rows = {}
+  # Append the extracted data to the DataFrame
+  extracted_data = {
+      'url': url,
+      'location':location, 
+      'odometer': parsed_attributes.get('odometer'),
+      'title': parsed_attributes.get('title status'),
+      'paint': parsed_attributes.get('paint color'),
+      'drive': parsed_attributes.get('drive'),
+      'cylinders': parsed_attributes.get('cylinders'),
+      'condition': parsed_attributes.get("condition"),
+      'fuel': parsed_attributes.get('fuel'),
+      'type': parsed_attributes.get('type'),
+      'transmission': parsed_attributes.get('transmission'),
+      'vin':parsed_attributes.get('VIN')
+  }
 
-  if len(urls) > url_limit : 
-    # Select a set to parse
-    random.seed(20230806)
-    urls_to_process = random.sample(urls,k=url_limit)
+  car_name = get_listing_name(soup)
+  #print(f"Car name is '{car_name}'")
+  extracted_data['name'] = car_name
 
-  elif len(urls) == 0 :
-    return(0)
+  extracted_data['post_id'] = get_post_id(url) 
+  extracted_data['time_posted'] = get_time_posted(soup)
+
+  extracted_data['year'] = get_year(soup)
+
+  # Price
+  extracted_data['price'] = get_price(soup)
+
+  # Posting body text
+  extracted_data['posting_body_text'] = get_posting_body(soup)
+
+  # title text
+  extracted_data['title_text'] = get_title_text(soup)
+
+  # num images
+  extracted_data['num_images'] = get_num_images(soup)
+
+  # lat/long
+  holder = get_lat_long(soup) 
+  extracted_data['latitude'] = holder[0]
+  extracted_data['longitude'] = holder[1]
+
+  # make and model
+  make = get_make(soup,car_name,matcher)
+
+  extracted_data['make'] = make
+
+  model = None
+  fuzzy_model = False
+  if make and make in matcher.makes: 
+    model = get_model(make,
+                      soup,
+                      car_name,
+                      matcher)
+
+    # A fuzzy match could be wrong, so the row still goes to the AI
+    # parser to confirm it.
+    if not model : 
+      model = get_fuzzy_model(make, soup, car_name, matcher)
+      fuzzy_model = model is not None
+
+
+  extracted_data['model'] = model
+
+  # our flags
+  extracted_data['needs_basic_parsing'] = False # TODO: Worth adding a check here? 
+  extracted_data['basic_processed_time'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+  if model and make and extracted_data['price'] and not fuzzy_model : 
+    extracted_data['needs_ai_parsing'] = False
   else : 
-     urls_to_process = urls
+     extracted_data['needs_ai_parsing'] = True
 
-  query = f"""
-      SELECT url, raw_html, location
-      FROM `car-buying-272019.car_buying.raw_listing_pages`
-      WHERE url IN UNNEST(@urls_to_process)
-  """
+  extracted_data['ai_processed_time'] = None
+ 
 
-  # Set up the query parameters
-  query_params = [bigquery.ArrayQueryParameter("urls_to_process", "STRING", urls_to_process)]
+  return(extracted_data)
 
-  # Run the query and get the results
-  query_job = bq_client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=query_params))
-  results = query_job.result()
+# Each pool worker holds its own copy of the make/model matcher. It's handed
+# over once through the pool initializer rather than pickled with every chunk.
+_worker_matcher = None
 
-  rows_to_upload = []
+def _init_parse_worker(matcher) :
+  global _worker_matcher
+  _worker_matcher = matcher
 
-  # Process and print the results
-  for row in results:
-    url, raw_html, location = row
+def _timed_parse(url, raw_html, location, matcher) :
+  """
+    (row, seconds, path) for one page. With PARSE_VERIFY_RATE a sample of
+    fast-path pages is parsed again from the soup, outside the timing, and
+    any differences are printed; their path is "fast_verified" or
+    "fast_mismatch".
+  """
+  started = time.perf_counter()
+  html = decode_page(raw_html)
+  row, path = _parse_html(url, html, location, matcher)
+  seconds = time.perf_counter() - started
+
+  if path == "fast" and VERIFY_RATE and random.random() < VERIFY_RATE :
+    differences = diff_rows(row, _extract_row(url, _soup_document(html), location, matcher))
+    path = "fast_mismatch" if differences else "fast_verified"
+    if differences :
+      print(f"Fast path differs from the soup for {url}: {differences}")
+
+  return(row, seconds, path)
+
+def _record_parse(metrics, seconds, path) :
+  metrics.observe("parse_page", seconds)
+  metrics.count(f"parse_path_{path}")
+
+def _parse_chunk(chunk) :
+  # Each row comes back with how long it took and which path it took, for
+  # the parent's metrics
+  return([_timed_parse(url, raw_html, location, _worker_matcher)
+          for url, raw_html, location in chunk])
+
+def _batched(items, batch_size) :
+  """ Yield lists of up to `batch_size` items, pulling lazily from `items`."""
+  items = iter(items)
+  while True :
+    batch = list(islice(items, batch_size))
+    if not batch :
+      return
+    yield batch
+
+def parse_pool(matcher, workers) :
+  """ A process pool whose workers each hold a copy of `matcher`."""
+  return(Pool(processes=workers,
+              initializer=_init_parse_worker,
+              initargs=(matcher,)))
+
+def parse_rows(rows, matcher, workers=1, chunk_size=25, pool=None, metrics=None) :
+  """
+    Parse (url, raw_html, location) rows, yielding the processed rows in
+    the same order they came in. With `workers` > 1 the chunks are spread
+    over a process pool; the output is the same as the serial path. Pass
+    a `parse_pool` as `pool` to reuse one across calls, and a RunMetrics
+    as `metrics` to record each page's parse time and path.
+  """
 
-    soup = BeautifulSoup(raw_html,'html.parser')
+  if pool is not None :
+    yield from _parse_in_pool(rows, pool, workers, chunk_size, metrics)
+    return
+
+  if workers <= 1 :
+    for url, raw_html, location in rows :
+      if metrics is None :
+        yield parse_listing_page(url, raw_html, location, matcher)
+      else :
+        row, seconds, path = _timed_parse(url, raw_html, location, matcher)
+        _record_parse(metrics, seconds, path)
+        yield row
+    return
+
+  # We don't use pool.imap here because its feeder thread drains the input
+  # as fast as it can, which would pull every raw_html into memory. Instead
+  # keep a small window of chunks in flight and collect them in order.
+  with parse_pool(matcher, workers) as pool :
+    yield from _parse_in_pool(rows, pool, workers, chunk_size, metrics)
+
+def _parse_in_pool(rows, pool, workers, chunk_size, metrics=None) :
+  max_in_flight = max(workers, 1) * 2
+  in_flight = deque()
+
+  def collect(result) :
+    for row, seconds, path in result.get() :
+      if metrics is not None :
+        _record_parse(metrics, seconds, path)
+      yield row
+
+  for chunk in _batched(rows, chunk_size) :
+    chunk = [tuple(row) for row in chunk]
+    in_flight.append(pool.apply_async(_parse_chunk, (chunk,)))
+
+    if len(in_flight) >= max_in_flight :
+      yield from collect(in_flight.popleft())
+
+  while in_flight :
+    yield from collect(in_flight.popleft())
+
+def record_parsed(metrics, rows) :
+  """ Count make/model matcher hits and misses for a batch of parsed rows."""
+  for row in rows :
+    metrics.count("matcher_make_hit" if row.get('make') else "matcher_make_miss")
+    if row.get('make') :
+      metrics.count("matcher_model_hit" if row.get('model') else "matcher_model_miss")
+
+def _counted_pages(metrics, results) :
+  # raw_html as stored, before decode_page
+  for url, raw_html, location in results :
+    metrics.count("bytes_read", len(raw_html or ""))
+    yield url, raw_html, location
 
-    # We'll extract all of our row elements in stand-alone functions to allow
-    # for some fine tuning. The exception will be the attribute group, since
-    # from those we'll just pull whatever the poster has filled out. 
-    parsed_attributes = parse_attrgroup(soup)
+def main() : 
 
-    # Append the extracted data to the DataFrame
-    extracted_data = {
-        'url': url,
-        'location':location, 
-        'odometer': parsed_attributes.get('odometer'),
-        'title': parsed_attributes.get('title status'),
-        'paint': parsed_attributes.get('paint color'),
-        'drive': parsed_attributes.get('drive'),
-        'cylinders': parsed_attributes.get('cylinders'),
-        'condition': parsed_attributes.get("condition"),
-        'fuel': parsed_attributes.get('fuel'),
-        'type': parsed_attributes.get('type'),
-        'transmission': parsed_attributes.get('transmission'),
-        'vin':parsed_attributes.get('VIN')
-    }
+  # Stage timings, per-page parse times, bytes and matcher hit rates for the log row
+  metrics = RunMetrics("basic_html_parsing")
+
+  # BigQuery by default; set WAREHOUSE=sqlite to run against a local copy.
+  with metrics.stage("connect") :
+    warehouse = connect_warehouse()
+
+  # Grab our makes and models and index them once for the whole run
+  with metrics.stage("load_make_models") :
+    make_2_models = get_make_models(warehouse) 
+  with metrics.stage("build_matcher") :
+    matcher = MakeModelMatcher(make_2_models)
+
+  # Grab the URLs we're going to parse. New raw pages come from past the
+  # last watermark, with a full anti-join every so often as a safety net.
+  checkpoint = load_checkpoint("basic_html_parsing")
+  reconcile = needs_reconcile(checkpoint)
+
+  with metrics.stage("read_candidates") :
+    raw_candidates = get_raw_needs_parsing(warehouse, None if reconcile else checkpoint)
+    needs_basic = get_processed_needs_basic(warehouse)
+
+  print(f"We have {len(raw_candidates) + len(needs_basic)} that need processing"
+        f"{' (full reconcile)' if reconcile else ''}.")
+
+  # Size the batch to finish in PARSE_TARGET_SECONDS at the rate recent
+  # runs managed. Pages are streamed, so PARSE_MEMORY_MB bounds how much
+  # raw HTML one run reads rather than what it holds at once.
+  sizer = BatchSizer("basic_html_parsing",
+                     target_seconds=float(os.getenv("PARSE_TARGET_SECONDS", "300")),
+                     memory_bytes=float(os.getenv("PARSE_MEMORY_MB", "2048")) * 2**20,
+                     initial=2500,
+                     minimum=int(os.getenv("PARSE_BATCH_MIN", "100")),
+                     maximum=int(os.getenv("PARSE_BATCH_MAX", "50000")))
+  url_limit = sizer.size(backlog=len(raw_candidates) + len(needs_basic))
+
+  # The watermark only holds if we take raw pages oldest first, so the
+  # reprocessing requests fill whatever room is left.
+  raw_to_process = raw_candidates[:url_limit]
+  urls_to_process = [url for url, _ in raw_to_process]
+
+  # Only first parses go in the price sketches; a re-parse was counted
+  # when its url was first processed.
+  new_urls = set(urls_to_process)
+
+  seen = set(urls_to_process)
+  for url in needs_basic : 
+    if len(urls_to_process) >= url_limit : 
+      break
+    if url not in seen : 
+      urls_to_process.append(url)
+      seen.add(url)
+
+  if len(urls_to_process) == 0 :
+    warehouse.close()
+    return(0)
 
-    car_name = get_listing_name(soup)
-    #print(f"Car name is '{car_name}'")
-    extracted_data['name'] = car_name
+  # Set PARSE_WORKERS to spread the soup parsing over several cores.
+  workers = int(os.getenv("PARSE_WORKERS", "1"))
 
-    extracted_data['post_id'] = get_post_id(url) 
-    extracted_data['time_posted'] = get_time_posted(soup)
+  # We stream the raw pages back a result page at a time and flush parsed
+  # rows every `flush_size`, so memory stays flat however big the batch is
+  # and a failed insert only loses that one batch.
+  read_page_size = int(os.getenv("PARSE_READ_PAGE_SIZE", "100"))
+  flush_size = int(os.getenv("PARSE_FLUSH_SIZE", "250"))
 
-    extracted_data['year'] = get_year(soup)
+  # Reading is lazy, so its time is charged to "read_raw_pages" as each
+  # page is pulled, and the rest of the wait on parse_rows to "parse".
+  results = metrics.iterate("read_raw_pages",
+                            _counted_pages(metrics, warehouse.raw_pages(urls_to_process,
+                                                                        page_size=read_page_size)))
 
-    # Price
-    extracted_data['price'] = get_price(soup)
+  rows_parsed = 0
+  rows_uploaded = 0
+  failed_urls = set()
 
-    # Posting body text
-    extracted_data['posting_body_text'] = get_posting_body(soup)
+  parse_start = time.perf_counter()
 
-    # title text
-    extracted_data['title_text'] = get_title_text(soup)
+  # Expected prices from lm_lookup_table, attached as each batch lands
+  # rather than waiting for the dashboard's daily query.
+  with metrics.stage("load_scorer") :
+    scorer = load_scorer(warehouse)
 
-    # num images
-    extracted_data['num_images'] = get_num_images(soup)
+  # Per make/model/year price sketches for the fit's outlier bounds
+  with metrics.stage("load_sketches") :
+    sketches = load_price_sketches()
 
-    # lat/long
-    holder = get_lat_long(soup) 
-    extracted_data['latitude'] = holder[0]
-    extracted_data['longitude'] = holder[1]
+  parsed = parse_rows(results, matcher, workers=workers, metrics=metrics)
 
-    # make and model
-    make = get_make(soup,car_name,make_2_models.keys())
+  for batch in metrics.iterate("parse", _batched(parsed, flush_size)) :
+    rows_parsed += len(batch)
+    record_parsed(metrics, batch)
 
-    extracted_data['make'] = make
+    if scorer is not None :
+      with metrics.stage("score") :
+        scorer.refresh(warehouse)
+        scorer.score_rows(batch)
 
-    model = None
-    if make and make in make_2_models: 
-      model = get_model(make,
-                        soup,
-                        car_name,
-                        make_2_models[make])
+    metrics.count("bytes_stored", len(json.dumps(batch, default=str).encode("utf-8")))
 
+    with metrics.stage("insert"), metrics.timed("insert_batch") :
+      failures = warehouse.append_rows('processed_listing_pages',batch)
+    failed_urls.update(failure['row']['url'] for failure in failures)
+    rows_uploaded += len(batch) - len(failures)
 
+    if sketches is not None :
+      with metrics.stage("sketch") :
+        sketches.update_rows([row for row in batch
+                              if row['url'] in new_urls and row['url'] not in failed_urls])
 
-    extracted_data['model'] = model
+    if failures :
+      print(f"Errors occurred while inserting {len(failures)} of {len(batch)} processed rows:",
+            [failure['errors'] for failure in failures])
 
-    # our flags
-    extracted_data['needs_basic_parsing'] = False # TODO: Worth adding a check here? 
-    extracted_data['basic_processed_time'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+  parse_seconds = time.perf_counter() - parse_start
+  if parse_seconds > 0 :
+    print(f"Parsed {rows_parsed} pages in {parse_seconds:.1f}s "
+          f"({rows_parsed/parse_seconds:.1f} pages/s, {workers} workers).")
 
-    if model and make and extracted_data['price'] : 
-      extracted_data['needs_ai_parsing'] = False
-    else : 
-       extracted_data['needs_ai_parsing'] = True
+  metrics.count("pages_parsed", rows_parsed)
+  metrics.count("rows_stored", rows_uploaded)
+  metrics.count("rows_failed", rows_parsed - rows_uploaded)
 
-    extracted_data['ai_processed_time'] = None
-   
+  if sketches is not None :
+    with metrics.stage("publish_bounds") :
+      sketches.flush(warehouse, force=True)
 
-    rows_to_upload.append(extracted_data)
+  # Everything outside the parse loop counts as this run's overhead
+  sizer.record(rows_parsed, parse_seconds, time.perf_counter() - metrics.started,
+               metrics.counters["bytes_read"])
 
-  # Insert the batch
-  upload_to_gbq(bq_client,rows_to_upload,dataset_id,'processed_listing_pages')
+  # Move the watermark past the raw pages we took, stopping short of the
+  # first one we couldn't store so it gets parsed again next run.
+  save_checkpoint("basic_html_parsing",
+                  advance_checkpoint(checkpoint,
+                                     consumed_before_failure(raw_to_process, failed_urls),
+                                     reconciled=reconcile))
 
   # Now log it.
-  log_row = [{
-     'task' : "basic_html_parsing",
-     'time_started' : start,
-     'time_finished' : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-     'notes' : f"Processed {len(rows_to_upload)} HTML pages on {hostname}."
-     }]
-
-  upload_to_gbq(bq_client,log_row,dataset_id,'log')
+  metrics.finish(warehouse, f"Processed {rows_uploaded} HTML pages on {metrics.hostname}.")
+  warehouse.close()
 
   return(0)
 
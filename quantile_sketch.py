@@ -0,0 +1,130 @@
+"""
+A mergeable streaming quantile sketch (KLL).
+
+Karnin, Lang and Liberty's sketch keeps a stack of compactors. Level h
+holds items that each stand for 2**h of the values seen. When a level fills
+up it's sorted and every other item (starting at a random offset) moves up
+a level, so the sketch stays at roughly k / (1 - C) items however many
+values go in. Until level 0 first fills up the sketch is exact. Rank error
+is around 1.7 / k of the count, i.e. under 1% with the default k.
+
+Two sketches merge by stacking their levels and compacting, so sketches
+built separately (by week, by host) combine into one for the union. Values
+are stored as float32 when serialized, which is exact for prices.
+"""
+
+import math
+import struct
+
+import numpy as np
+
+DEFAULT_K = 200
+
+# Each level down holds C times the items of the level above it
+C = 2 / 3
+
+_HEADER = struct.Struct("<HBI")
+_EMPTY = np.empty(0, dtype="float64")
+
+_rng = np.random.default_rng()
+
+
+class KLLSketch :
+
+    def __init__(self, k=DEFAULT_K, levels=None, n=0) :
+        self.k = k
+        self.levels = levels if levels is not None else [_EMPTY]
+        self.n = n
+
+    def __len__(self) :
+        """ How many values have gone into the sketch."""
+        return(self.n)
+
+    def _capacity(self, level) :
+        depth = len(self.levels) - level - 1
+        return(max(int(math.ceil(self.k * C ** depth)), 2))
+
+    def _compress(self) :
+        while sum(map(len, self.levels)) > sum(map(self._capacity, range(len(self.levels)))) :
+            for level, items in enumerate(self.levels) :
+                if len(items) < self._capacity(level) :
+                    continue
+
+                if level + 1 == len(self.levels) :
+                    self.levels.append(_EMPTY)
+
+                # An odd one out stays behind at this level
+                items = np.sort(items)
+                odd = len(items) % 2
+                promoted = items[odd + _rng.integers(2)::2]
+
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                break
+
+    def update(self, values) :
+        """ Add an array of values; NaNs are ignored."""
+        values = np.asarray(values, dtype="float64").ravel()
+        values = values[~np.isnan(values)]
+
+        if len(values) :
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self.n += len(values)
+            self._compress()
+
+        return(self)
+
+    def merge(self, other) :
+        """ Fold `other` into this sketch."""
+        while len(self.levels) < len(other.levels) :
+            self.levels.append(_EMPTY)
+
+        for level, items in enumerate(other.levels) :
+            self.levels[level] = np.concatenate([self.levels[level], items])
+
+        self.n += other.n
+        self._compress()
+
+        return(self)
+
+    def weighted(self) :
+        """ (values, weights) of every retained item; the weights sum to len(self)."""
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** level, dtype="int64")
+                                  for level, items in enumerate(self.levels)])
+        return(values, weights)
+
+    def quantiles(self, qs) :
+        """ Approximate quantiles for each q in `qs` (0 is the min, 1 the max); NaN if empty."""
+        qs = np.asarray(qs, dtype="float64")
+
+        if self.n == 0 :
+            return(np.full(qs.shape, np.nan))
+
+        values, weights = self.weighted()
+        order = np.argsort(values, kind="stable")
+        cumulative = np.cumsum(weights[order])
+
+        # The item covering 0-based rank q * (n - 1), as APPROX_QUANTILES picks
+        index = np.searchsorted(cumulative, qs * (self.n - 1), side="right")
+
+        return(values[order][np.minimum(index, len(values) - 1)])
+
+    def to_bytes(self) :
+        lengths = [len(items) for items in self.levels]
+        return(_HEADER.pack(self.k, len(lengths), self.n)
+               + struct.pack(f"<{len(lengths)}I", *lengths)
+               + np.concatenate(self.levels).astype("<f4").tobytes())
+
+    @classmethod
+    def from_bytes(cls, data) :
+        k, n_levels, n = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+        lengths = struct.unpack_from(f"<{n_levels}I", data, offset)
+        offset += 4 * n_levels
+
+        values = np.frombuffer(data, dtype="<f4", count=sum(lengths), offset=offset).astype("float64")
+        bounds = np.cumsum([0] + list(lengths))
+        levels = [values[bounds[i]:bounds[i + 1]] for i in range(n_levels)]
+
+        return(cls(k, levels, n))
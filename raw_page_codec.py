@@ -0,0 +1,133 @@
+"""
+Compact storage for `raw_listing_pages.raw_html`.
+
+The parser only looks at a few parts of a listing page: the
+`ld_posting_data` JSON-LD, the `attr` divs, `titletextonly`, `postingbody`,
+`slider-info`, `time.timeago` and the makemodel/year spans. Storing the
+whole page makes every insert and every query that selects `raw_html` pay
+for the rest. `encode_page` can keep just those fragments, compress the
+result, or both, and `decode_page` turns any stored value back into HTML
+the parser understands. Pages stored before this existed are plain HTML
+and pass through `decode_page` untouched.
+
+Formats are set by RAW_PAGE_FORMAT:
+    full             - the page as fetched (the default)
+    fragments        - only the elements the parser reads, as a small HTML doc
+    zstd             - the full page, compressed
+    fragments+zstd   - both
+
+Compressed values are base64 text behind a versioned prefix, since
+`raw_html` is a STRING column. zstd needs the `zstandard` package; without
+it we fall back to zlib and say so in the prefix.
+"""
+
+import base64
+import os
+import zlib
+
+from bs4 import BeautifulSoup
+
+try :
+    import zstandard
+except ImportError :
+    zstandard = None
+
+RAW_PAGE_FORMAT = os.getenv("RAW_PAGE_FORMAT", "full")
+
+FRAGMENTS_MARKER = "<!-- carbitrage:fragments:v1 -->"
+ZSTD_PREFIX = "carbitrage:zstd:v1:"
+ZLIB_PREFIX = "carbitrage:zlib:v1:"
+
+
+def _is_fragment(tag) :
+    """ The same elements ListingDocument picks out of a page."""
+    name = tag.name
+    tag_id = tag.get('id')
+    classes = tag.get('class') or []
+    joined = " ".join(classes)
+
+    if name == 'script' :
+        return(tag_id == 'ld_posting_data')
+    if name == 'div' :
+        return('attr' in classes)
+    if name == 'span' :
+        return(tag_id == 'titletextonly' or joined == 'valu year' or 'slider-info' in classes)
+    if name == 'section' :
+        return(tag_id == 'postingbody')
+    if name == 'time' :
+        return(joined == 'date timeago')
+    if name == 'a' :
+        return(joined == 'valu makemodel')
+
+    return(False)
+
+
+def extract_fragments(html) :
+    """
+    Keep only the elements the parser reads, in page order, as a small
+    HTML document. Elements nested inside one we already kept (e.g. the
+    year span inside an attr div) come along with their parent.
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+
+    kept = []
+    kept_ids = set()
+
+    for tag in soup.find_all(True) :
+        if not _is_fragment(tag) :
+            continue
+        if any(id(parent) in kept_ids for parent in tag.parents) :
+            continue
+        kept.append(tag)
+        kept_ids.add(id(tag))
+
+    body = "\n".join(str(tag) for tag in kept)
+
+    return(f"{FRAGMENTS_MARKER}<html><body>\n{body}\n</body></html>")
+
+
+def compress(text) :
+    data = text.encode("utf-8")
+
+    if zstandard is not None :
+        packed = zstandard.ZstdCompressor(level=10).compress(data)
+        return(ZSTD_PREFIX + base64.b64encode(packed).decode("ascii"))
+
+    packed = zlib.compress(data, 9)
+    return(ZLIB_PREFIX + base64.b64encode(packed).decode("ascii"))
+
+
+def decompress(stored) :
+    if stored.startswith(ZSTD_PREFIX) :
+        if zstandard is None :
+            raise RuntimeError("raw page is zstd compressed but the zstandard package isn't installed")
+        packed = base64.b64decode(stored[len(ZSTD_PREFIX):])
+        return(zstandard.ZstdDecompressor().decompress(packed).decode("utf-8"))
+
+    if stored.startswith(ZLIB_PREFIX) :
+        packed = base64.b64decode(stored[len(ZLIB_PREFIX):])
+        return(zlib.decompress(packed).decode("utf-8"))
+
+    return(stored)
+
+
+def encode_page(html, page_format=RAW_PAGE_FORMAT) :
+    """ Turn a fetched page into what we store in `raw_html`."""
+    if html is None or page_format == "full" :
+        return(html)
+
+    if "fragments" in page_format :
+        html = extract_fragments(html)
+
+    if "zstd" in page_format :
+        html = compress(html)
+
+    return(html)
+
+
+def decode_page(stored) :
+    """ Turn a stored `raw_html` value back into HTML, whatever format it's in."""
+    if stored is None :
+        return(None)
+
+    return(decompress(stored))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keeps the `hot_deals` table the dashboard reads up to date.
+
+hot_deals_dashboard_vw rebuilt all 45 days of listings every day, joins and
+sort included, however few listings had come in. This job merges in only
+the listings parsed since its last run, drops the ones that have aged past
+45 days, and re-scores the rows already there only when lm_lookup_table has
+changed. `hot_deals` is partitioned by day of `time_posted` and clustered by
+state and make, so both the refresh and the dashboard's filters read just
+the partitions they need.
+
+Each run steps back HOT_DEALS_OVERLAP_MINUTES from the last watermark, since
+rows land in processed_listing_pages a little after they're parsed; the
+merge is on url, so seeing a row twice is harmless. With no checkpoint, or
+every HOT_DEALS_REBUILD_DAYS, the table is rebuilt in full as a safety net.
+With WAREHOUSE=sqlite the local table is rebuilt in full on every run.
+"""
+
+import os
+import socket
+from datetime import datetime, timedelta
+
+from checkpoints import load_checkpoint, parse_time, save_checkpoint
+from warehouse import connect_warehouse
+
+OVERLAP_MINUTES = float(os.getenv("HOT_DEALS_OVERLAP_MINUTES", "30"))
+REBUILD_DAYS = float(os.getenv("HOT_DEALS_REBUILD_DAYS", "7"))
+WINDOW_DAYS = 45
+
+
+def needs_rebuild(checkpoint, days=REBUILD_DAYS) :
+    """ True if there's no watermark yet or the last full rebuild is too old."""
+    if not checkpoint or not checkpoint.get("watermark") :
+        return(True)
+
+    last_rebuild = parse_time(checkpoint.get("last_rebuild"))
+    if last_rebuild is None :
+        return(True)
+
+    return(datetime.utcnow() - last_rebuild > timedelta(days=days))
+
+
+def main() :
+
+    start = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+    warehouse = connect_warehouse()
+
+    checkpoint = load_checkpoint("hot_deals")
+    rebuild = needs_rebuild(checkpoint)
+
+    # Read the version first; a fit landing mid-run gets picked up next time
+    lm_version = warehouse.lm_lookup_version()
+
+    if rebuild :
+        counts = warehouse.refresh_hot_deals(days=WINDOW_DAYS)
+    else :
+        since = parse_time(checkpoint["watermark"]) - timedelta(minutes=OVERLAP_MINUTES)
+        rescore = checkpoint.get("lm_version") != lm_version
+        counts = warehouse.refresh_hot_deals(since=since, rescore=rescore, days=WINDOW_DAYS)
+
+    print(f"hot_deals refreshed: {counts}")
+
+    save_checkpoint("hot_deals", {
+        "watermark" : start,
+        "lm_version" : lm_version,
+        "last_rebuild" : start if rebuild else checkpoint.get("last_rebuild"),
+    })
+
+    log_row = [{
+        'task' : "refresh_hot_deals",
+        'time_started' : start,
+        'time_finished' : datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        'notes' : f"{'rebuilt' if rebuild else 'refreshed'} hot_deals "
+                  f"({', '.join(f'{k} {v}' for k, v in counts.items())}) on {socket.gethostname()}."
+    }]
+
+    warehouse.upload('log',log_row)
+
+    warehouse.close()
+
+    return(0)
+
+
+if __name__ == '__main__':
+    main()
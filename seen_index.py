@@ -0,0 +1,220 @@
+"""
+A persistent index of the listings get_links has already seen.
+
+get_links used to pull 30 days of URLs from raw_listing_pages plus every URL
+in links_need_harvesting into a Python set of ~200K strings on every run.
+Here listings are keyed on their integer post ID (the last segment of the
+URL) and kept in two sorted `array` columns, post IDs and the day each was
+first seen, so the whole index is a few MB on disk and in memory. A Bloom
+filter sits in front and answers most lookups for new listings without
+touching the arrays. Entries expire after `max_age_days`, and the index is
+updated in place from each run instead of being rebuilt from scratch.
+"""
+
+import bisect
+import json
+import os
+import struct
+from array import array
+from datetime import datetime
+
+from checkpoints import TIME_FORMAT
+
+SEEN_INDEX_PATH = os.getenv("SEEN_INDEX_PATH", os.path.join("checkpoints", "seen_index.bin"))
+
+_MAGIC = b"SEEN2"
+_EPOCH = datetime(1970, 1, 1)
+
+_MASK64 = (1 << 64) - 1
+
+
+def post_id_from_url(url) :
+    """ The integer post ID, same as `get_post_id` in process_listing_pages; None if it isn't numeric."""
+    post_id = url.split('/')[-1].split('.')[0]
+    return(int(post_id) if post_id.isdigit() else None)
+
+
+def day_number(ts) :
+    """ Days since the epoch for a datetime or "%Y-%m-%d %H:%M:%S" string."""
+    if ts is None :
+        ts = datetime.utcnow()
+    elif isinstance(ts, str) :
+        ts = datetime.strptime(ts, TIME_FORMAT)
+    return((ts - _EPOCH).days)
+
+
+def _mix(value, seed) :
+    # splitmix64 finalizer; good enough spreading for a Bloom filter
+    value = (value + seed * 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return(value ^ (value >> 31))
+
+
+class BloomFilter :
+
+    def __init__(self, capacity, bits_per_item=10, hashes=7) :
+        self.size = max(64, capacity * bits_per_item)
+        self.hashes = hashes
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value) :
+        h1 = _mix(value, 1)
+        h2 = _mix(value, 2) | 1
+        return(((h1 + i * h2) % self.size) for i in range(self.hashes))
+
+    def add(self, value) :
+        for pos in self._positions(value) :
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value) :
+        return(all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value)))
+
+
+class SeenIndex :
+    """
+    Supports `url in index`, so it drops straight into `dedupe_links`.
+    URLs without a numeric post ID (rare) are kept in a small dict instead.
+    """
+
+    def __init__(self, max_age_days=30, use_bloom=True) :
+        self.max_age_days = max_age_days
+        self.use_bloom = use_bloom
+
+        self.ids = array('q')    # sorted post IDs
+        self.days = array('i')   # day each was first seen, parallel to ids
+        self.pending = {}        # post ID -> day, added since the last compaction
+        self.extra = {}          # url -> day, for URLs without a post ID
+        self.bloom = None
+
+        self._rebuild_bloom()
+
+    def __len__(self) :
+        return(len(self.ids) + len(self.pending) + len(self.extra))
+
+    def _rebuild_bloom(self) :
+        if not self.use_bloom :
+            self.bloom = None
+            return
+
+        # Leave room for a run's worth of new IDs before it fills up
+        self.bloom = BloomFilter(capacity=2 * len(self.ids) + 50000)
+        for post_id in self.ids :
+            self.bloom.add(post_id)
+        for post_id in self.pending :
+            self.bloom.add(post_id)
+
+    def _find(self, post_id) :
+        pos = bisect.bisect_left(self.ids, post_id)
+        if pos < len(self.ids) and self.ids[pos] == post_id :
+            return(pos)
+        return(None)
+
+    def __contains__(self, url) :
+        post_id = post_id_from_url(url)
+
+        if post_id is None :
+            return(url in self.extra)
+
+        if self.bloom is not None and post_id not in self.bloom :
+            return(False)
+
+        return(post_id in self.pending or self._find(post_id) is not None)
+
+    def add(self, url, seen=None) :
+        """ Record `url` as seen at `seen` (default now). Keeps the earliest day."""
+        day = day_number(seen)
+        post_id = post_id_from_url(url)
+
+        if post_id is None :
+            self.extra[url] = min(day, self.extra.get(url, day))
+            return
+
+        pos = self._find(post_id)
+        if pos is not None :
+            self.days[pos] = min(day, self.days[pos])
+            return
+
+        self.pending[post_id] = min(day, self.pending.get(post_id, day))
+        if self.bloom is not None :
+            self.bloom.add(post_id)
+
+    def update(self, pulls) :
+        """ Add a url -> first seen mapping, e.g. from `Warehouse.recent_pulls`."""
+        for url, seen in pulls.items() :
+            self.add(url, seen)
+
+    def compact(self, now=None) :
+        """ Merge pending IDs into the sorted arrays and drop expired entries."""
+        cutoff = day_number(now) - self.max_age_days
+
+        merged = {post_id: day for post_id, day in zip(self.ids, self.days) if day >= cutoff}
+        for post_id, day in self.pending.items() :
+            if day >= cutoff :
+                merged[post_id] = min(day, merged.get(post_id, day))
+
+        ordered = sorted(merged)
+        self.ids = array('q', ordered)
+        self.days = array('i', (merged[post_id] for post_id in ordered))
+        self.pending = {}
+        self.extra = {url: day for url, day in self.extra.items() if day >= cutoff}
+
+        self._rebuild_bloom()
+
+    def save(self, path=SEEN_INDEX_PATH) :
+        self.compact()
+
+        directory = os.path.dirname(path)
+        if directory :
+            os.makedirs(directory, exist_ok=True)
+
+        extra = json.dumps(self.extra).encode("utf-8")
+        bloom_bits = self.bloom.bits if self.bloom is not None else b""
+        tmp_path = path + ".tmp"
+
+        # The Bloom filter is saved too so loading doesn't rehash every ID
+        with open(tmp_path, "wb") as f :
+            f.write(_MAGIC)
+            f.write(struct.pack("<QQQ", len(self.ids), len(extra), len(bloom_bits)))
+            self.ids.tofile(f)
+            self.days.tofile(f)
+            f.write(extra)
+            if self.bloom is not None :
+                f.write(struct.pack("<QQ", self.bloom.size, self.bloom.hashes))
+                f.write(bloom_bits)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=SEEN_INDEX_PATH, max_age_days=30, use_bloom=True) :
+        """ Read a saved index; returns an empty one if there's nothing usable on disk."""
+        index = cls(max_age_days=max_age_days, use_bloom=use_bloom)
+
+        if not os.path.exists(path) :
+            return(index)
+
+        try :
+            with open(path, "rb") as f :
+                if f.read(len(_MAGIC)) != _MAGIC :
+                    raise ValueError("not a seen index file")
+                count, extra_len, bloom_len = struct.unpack("<QQQ", f.read(24))
+                index.ids.fromfile(f, count)
+                index.days.fromfile(f, count)
+                index.extra = json.loads(f.read(extra_len).decode("utf-8"))
+
+                bloom = None
+                if bloom_len :
+                    size, hashes = struct.unpack("<QQ", f.read(16))
+                    bloom = BloomFilter(capacity=0, hashes=hashes)
+                    bloom.size = size
+                    bloom.bits = bytearray(f.read(bloom_len))
+        except (OSError, EOFError, ValueError, struct.error) as e :
+            print(f"Error reading seen index, starting empty: {e}")
+            return(cls(max_age_days=max_age_days, use_bloom=use_bloom))
+
+        if use_bloom and bloom is not None :
+            index.bloom = bloom
+        else :
+            index._rebuild_bloom()
+
+        return(index)
@@ -0,0 +1,73 @@
+"""
+The parse job's price sketches only count a listing the first time its url
+is parsed, not when a `needs_basic_parsing` request parses it again.
+"""
+
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import checkpoints
+import process_listing_pages
+from price_bounds import PriceSketches
+from warehouse import SQLiteWarehouse
+
+CORPUS = os.path.join(ROOT, "benchmarks", "corpus")
+
+
+class CountingSketches(PriceSketches) :
+
+    def __init__(self, *args, **kwargs) :
+        super().__init__(*args, **kwargs)
+        self.added = 0
+
+    def update_rows(self, rows) :
+        added = super().update_rows(rows)
+        self.added += added
+        return(added)
+
+
+def test_reparse_does_not_add_to_price_sketches(tmp_path, monkeypatch) :
+    db_path = str(tmp_path / "warehouse.db")
+    monkeypatch.setenv("WAREHOUSE", "sqlite")
+    monkeypatch.setenv("WAREHOUSE_PATH", db_path)
+    monkeypatch.setattr(checkpoints, "CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+
+    sketches = CountingSketches(path=str(tmp_path / "price_sketches.bin"))
+    monkeypatch.setattr(process_listing_pages, "load_price_sketches", lambda : sketches)
+
+    with open(os.path.join(CORPUS, "manifest.json")) as f :
+        manifest = json.load(f)
+    listing = manifest["listings"][0]
+    with open(os.path.join(CORPUS, listing["file"])) as f :
+        html = f.read()
+
+    warehouse = SQLiteWarehouse(db_path)
+    warehouse.conn.executemany("INSERT INTO make_model_year VALUES (?,?,?)", manifest["make_models"])
+    warehouse.append_rows("raw_listing_pages", [{
+        "url" : listing["url"],
+        "datetime_pulled" : "2023-10-11 08:00:00",
+        "raw_html" : html,
+        "location" : listing["location"],
+    }])
+    warehouse.close()
+
+    # First parse: the listing's price goes in
+    process_listing_pages.main()
+    assert sketches.added == 1
+
+    # Ask for it to be parsed again
+    warehouse = SQLiteWarehouse(db_path)
+    warehouse.conn.execute("UPDATE processed_listing_pages SET needs_basic_parsing = 1")
+    warehouse.conn.commit()
+    warehouse.close()
+
+    process_listing_pages.main()
+
+    warehouse = SQLiteWarehouse(db_path)
+    assert warehouse._query("SELECT COUNT(*) FROM processed_listing_pages")[0][0] == 2
+    warehouse.close()
+    assert sketches.added == 1
@@ -0,0 +1,762 @@
+"""
+The storage the cron jobs read from and write to.
+
+Every job used to build its own `bigquery.Client` and hardcode the
+`car-buying-272019.car_buying.*` SQL, so nothing could run without the
+cloud. The jobs now talk to a `Warehouse`, which only covers the handful
+of operations we actually use. `BigQueryWarehouse` is what runs in
+production. `SQLiteWarehouse` keeps the same tables in a local file so a
+stage can be run, profiled or benchmarked on a laptop.
+
+Pick the backend with the WAREHOUSE env var ("bigquery" or "sqlite"); the
+SQLite file goes to WAREHOUSE_PATH.
+"""
+
+import json
+import math
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+
+from checkpoints import format_time, parse_time
+
+TABLE_PREFIX = "car-buying-272019.car_buying"
+
+
+class Warehouse(ABC) :
+    """
+    The operations the jobs need. Timestamps go in and come out as
+    "%Y-%m-%d %H:%M:%S" strings or datetimes; both are accepted.
+    """
+
+    @abstractmethod
+    def make_models(self) :
+        """ (make, model, short_model) rows from make_model_year."""
+
+    @abstractmethod
+    def processed_needs_basic(self) :
+        """ URLs in processed_listing_pages flagged `needs_basic_parsing`, least recently processed first."""
+
+    @abstractmethod
+    def raw_needs_parsing(self, watermark=None, in_flight=()) :
+        """
+        (url, datetime_pulled) for raw pages that still need parsing, oldest
+        first. With no watermark this is the full anti-join against
+        processed_listing_pages.
+        """
+
+    @abstractmethod
+    def links_to_harvest(self, limit, watermark=None, in_flight=(), exclude=()) :
+        """ (url, location, row_created) for the oldest links not yet harvested, less the urls in `exclude`."""
+
+    @abstractmethod
+    def recent_pulls(self, since=None) :
+        """ url -> first seen, for the last 30 days of raw pages plus queued links."""
+
+    @abstractmethod
+    def raw_pages(self, urls, page_size=100) :
+        """ Yield (url, raw_html, location) for `urls`, reading `page_size` at a time."""
+
+    @abstractmethod
+    def lm_lookup(self) :
+        """
+        (make, model, intercept, miles_coeff, condition_coeff, year_coeff,
+        r_squared, sample_size) rows from lm_lookup_table.
+        """
+
+    @abstractmethod
+    def lm_lookup_version(self) :
+        """ Something that changes whenever lm_lookup_table is rewritten."""
+
+    @abstractmethod
+    def price_history(self, days) :
+        """
+        Yield (make, model, year, odometer, price, condition, time_posted)
+        for the processed listings posted in the last `days` that lm_fit_vw
+        would keep.
+        """
+
+    @abstractmethod
+    def refresh_hot_deals(self, since=None, rescore=False, days=45) :
+        """
+        Bring the materialized hot_deals table up to date. With no `since`
+        it's rebuilt from the last `days` of listings; otherwise listings
+        parsed at or after `since` are merged in, rows older than `days`
+        are dropped, and with `rescore` every row's predicted price is
+        recomputed from lm_lookup_table. Returns affected row counts.
+        Backends without a cheap merge may rebuild every time.
+        """
+
+    @abstractmethod
+    def append_rows(self, table_name, rows) :
+        """
+        Insert `rows` (a list of dicts). Returns the rows that failed as
+        {'index', 'row', 'errors'} dicts, like `gbq_writer.write_rows`.
+        """
+
+    @abstractmethod
+    def delete_harvested_links(self, urls) :
+        """ Remove `urls` from links_need_harvesting."""
+
+    @abstractmethod
+    def load_dataframe(self, df, table_name, truncate=True) :
+        """ Load a pandas dataframe into `table_name`, replacing it by default."""
+
+    def close(self) :
+        pass
+
+    def upload(self, table_name, rows) :
+        """ `append_rows` with the same printout `upload_to_gbq` gave. Returns rows inserted."""
+
+        if not rows :
+            return(0)
+
+        failures = self.append_rows(table_name, rows)
+
+        if not failures :
+            print(f"{len(rows)} row inserted successfully to {table_name}.")
+        else :
+            print(f"Errors occurred while inserting {len(failures)} of {len(rows)} rows to {table_name}:",
+                  [failure["errors"] for failure in failures])
+
+        return(len(rows) - len(failures))
+
+
+# The dashboard's expected price, as in hot_deals_dashboard_vw
+HOT_DEALS_PREDICTED_PRICE = """
+  lms.intercept + lms.miles_coeff * (LOG(listings.odometer + 0.1)) +
+  lms.condition_coeff *
+  CASE
+    WHEN listings.condition IN ('new', 'like new', 'excellent') THEN 1
+    WHEN listings.condition IN ('good','fair', 'salvage') THEN 0
+  ELSE
+  NULL
+END
+  + lms.year_coeff * (listings.year)"""
+
+HOT_DEALS_COLUMNS = [
+    "url", "state", "location", "time_posted", "name", "make", "model", "year", "odometer",
+    "title", "paint", "drive", "cylinders", "fuel", "type", "transmission", "condition", "price",
+    "title_text", "latitude", "longitude", "predicted_price", "r_squared", "sample_size",
+]
+
+
+class BigQueryWarehouse(Warehouse) :
+
+    def __init__(self, client, dataset_id, table_prefix=TABLE_PREFIX) :
+        from google.cloud import bigquery
+
+        self.bigquery = bigquery
+        self.client = client
+        self.dataset_id = dataset_id
+        self.prefix = table_prefix
+
+    def _query(self, query, params=None) :
+        job_config = None
+        if params :
+            job_config = self.bigquery.QueryJobConfig(query_parameters=params)
+
+        query_job = self.client.query(query,
+                                      job_config = job_config,
+                                      location = "US")
+
+        return(query_job.result())  # Wait for the job to complete.
+
+    def _watermark_params(self, watermark, in_flight) :
+        return([
+            self.bigquery.ScalarQueryParameter("watermark", "DATETIME", parse_time(format_time(watermark))),
+            self.bigquery.ArrayQueryParameter("in_flight", "STRING", list(in_flight))
+        ])
+
+    def make_models(self) :
+        query = f"""
+                SELECT
+                  make, model, short_model
+                FROM
+                `{self.prefix}.make_model_year`
+              """
+
+        return([tuple(row) for row in self._query(query)])
+
+    def processed_needs_basic(self) :
+        query = f"""
+                SELECT
+                  url
+                FROM
+                `{self.prefix}.processed_listing_pages`
+                WHERE
+                  needs_basic_parsing IS TRUE
+                GROUP BY url
+                ORDER BY MIN(basic_processed_time)
+              """
+
+        return([row[0] for row in self._query(query)])
+
+    def raw_needs_parsing(self, watermark=None, in_flight=()) :
+
+        # Pages pulled in the last few minutes are left for the next run,
+        # since harvest_pages inserts its rows at the end of its run. A
+        # reconcile sets the watermark too, so it needs the same guard.
+        if watermark is None :
+            query = f"""
+                    SELECT
+                      url, MIN(datetime_pulled) AS datetime_pulled
+                    FROM
+                    `{self.prefix}.raw_listing_pages`
+                    WHERE
+                      url NOT IN (
+                        SELECT DISTINCT url
+                        FROM
+                        `{self.prefix}.processed_listing_pages`
+                        )
+                      AND datetime_pulled <= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 15 MINUTE)
+                    GROUP BY url
+                    ORDER BY datetime_pulled
+                  """
+            params = None
+
+        else :
+            query = f"""
+                    SELECT
+                      url, MIN(datetime_pulled) AS datetime_pulled
+                    FROM
+                    `{self.prefix}.raw_listing_pages`
+                    WHERE
+                      datetime_pulled >= @watermark
+                      AND datetime_pulled <= DATETIME_SUB(CURRENT_DATETIME(), INTERVAL 15 MINUTE)
+                      AND url NOT IN UNNEST(@in_flight)
+                    GROUP BY url
+                    ORDER BY datetime_pulled
+                  """
+            params = self._watermark_params(watermark, in_flight)
+
+        return([(row[0], row[1]) for row in self._query(query, params)])
+
+    def links_to_harvest(self, limit, watermark=None, in_flight=(), exclude=()) :
+
+        exclude_param = self.bigquery.ArrayQueryParameter("exclude", "STRING", list(exclude))
+
+        if watermark is None :
+            query = f"""
+                SELECT url, location, row_created
+                FROM `{self.prefix}.links_need_harvesting`
+                WHERE url NOT IN (
+                    SELECT DISTINCT url
+                    FROM `{self.prefix}.raw_listing_pages`)
+                  AND url NOT IN UNNEST(@exclude)
+                ORDER BY row_created ASC
+                LIMIT {int(limit)}
+                """
+            params = [exclude_param]
+
+        else :
+            query = f"""
+                SELECT url, location, row_created
+                FROM `{self.prefix}.links_need_harvesting`
+                WHERE row_created >= @watermark
+                  AND url NOT IN UNNEST(@in_flight)
+                  AND url NOT IN (
+                    SELECT DISTINCT url
+                    FROM `{self.prefix}.raw_listing_pages`)
+                  AND url NOT IN UNNEST(@exclude)
+                ORDER BY row_created ASC
+                LIMIT {int(limit)}
+                """
+            params = self._watermark_params(watermark, in_flight) + [exclude_param]
+
+        return([tuple(row) for row in self._query(query, params)])
+
+    def recent_pulls(self, since=None) :
+
+        params = [self.bigquery.ScalarQueryParameter("since", "DATETIME", parse_time(format_time(since)))]
+
+        query = f"""
+            SELECT url, MIN(datetime_pulled)
+            FROM `{self.prefix}.raw_listing_pages`
+            WHERE datetime_pulled > DATE_SUB(CURRENT_DATE(), INTERVAL 30 DAY)
+              AND (@since IS NULL OR datetime_pulled >= @since)
+            GROUP BY url
+        """
+
+        pulls = dict()
+
+        for url, datetime_pulled in self._query(query, params) :
+            pulls[url] = format_time(datetime_pulled)
+
+        query = f"""
+            SELECT url, MIN(row_created)
+            FROM `{self.prefix}.links_need_harvesting`
+            WHERE @since IS NULL OR row_created >= @since
+            GROUP BY url
+        """
+
+        for url, row_created in self._query(query, params) :
+            pulls.setdefault(url, format_time(row_created))
+
+        return(pulls)
+
+    def raw_pages(self, urls, page_size=100) :
+        query = f"""
+            SELECT url, raw_html, location
+            FROM `{self.prefix}.raw_listing_pages`
+            WHERE url IN UNNEST(@urls_to_process)
+        """
+
+        params = [self.bigquery.ArrayQueryParameter("urls_to_process", "STRING", list(urls))]
+        query_job = self.client.query(query, job_config=self.bigquery.QueryJobConfig(query_parameters=params))
+
+        for row in query_job.result(page_size=page_size) :
+            yield tuple(row)
+
+    def lm_lookup(self) :
+        query = f"""
+            SELECT make, model, intercept, miles_coeff, condition_coeff, year_coeff, r_squared, sample_size
+            FROM `{self.prefix}.lm_lookup_table`
+        """
+
+        return([tuple(row) for row in self._query(query)])
+
+    def lm_lookup_version(self) :
+        # The cloud function overwrites the whole table, which bumps its
+        # modified time.
+        return(format_time(self.client.get_table(f"{self.prefix}.lm_lookup_table").modified))
+
+    def price_history(self, days) :
+        query = f"""
+            SELECT make, model, year, odometer, price, condition, time_posted
+            FROM `{self.prefix}.processed_listing_pages`
+            WHERE make IS NOT NULL
+              AND model IS NOT NULL
+              AND year IS NOT NULL
+              AND odometer IS NOT NULL
+              AND price IS NOT NULL
+              AND condition IS NOT NULL
+              AND time_posted >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {int(days)} DAY)
+        """
+
+        for row in self._query(query) :
+            yield tuple(row)
+
+    def _hot_deals_select(self, since_filter) :
+        # hot_deals_dashboard_vw, less the ORDER BY, keeping only the latest
+        # parse of each url so rows can be merged on it.
+        return(f"""
+            WITH Latest AS (
+                SELECT *
+                FROM `{self.prefix}.processed_listing_pages`
+                WHERE time_posted >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @days DAY)
+                  {since_filter}
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY url ORDER BY basic_processed_time DESC) = 1
+            )
+            SELECT
+              listings.url, state_lookup.state, listings.location, listings.time_posted,
+              listings.name, listings.make, listings.model, listings.year, listings.odometer,
+              listings.title, listings.paint, listings.drive, listings.cylinders, listings.fuel,
+              listings.type, listings.transmission, listings.condition, listings.price,
+              listings.title_text, listings.latitude, listings.longitude,
+              {HOT_DEALS_PREDICTED_PRICE} AS predicted_price,
+              lms.r_squared,
+              lms.sample_size
+            FROM Latest AS listings
+            JOIN `{self.prefix}.state_lookup_table` AS state_lookup
+            ON state_lookup.region = listings.location
+            LEFT JOIN `{self.prefix}.lm_lookup_table` AS lms
+            ON listings.make = lms.make AND listings.model = lms.model
+            WHERE listings.price < 75000
+              AND listings.price > 250
+              AND listings.odometer < 300000
+              AND listings.odometer > 0
+              AND listings.year >= EXTRACT(YEAR FROM CURRENT_DATE()) - 50
+              AND listings.year <= EXTRACT(YEAR FROM CURRENT_DATE()) + 1
+        """)
+
+    def _dml(self, query, params) :
+        job_config = self.bigquery.QueryJobConfig(query_parameters=params)
+        job = self.client.query(query, job_config=job_config, location="US")
+        job.result()
+        return(job.num_dml_affected_rows or 0)
+
+    def refresh_hot_deals(self, since=None, rescore=False, days=45) :
+        table = f"{self.prefix}.hot_deals"
+        params = [self.bigquery.ScalarQueryParameter("days", "INT64", days)]
+
+        if since is None :
+            # Partitioned by day so the age-out and the dashboard's date
+            # filters only touch the partitions they need.
+            self._query(f"""
+                CREATE OR REPLACE TABLE `{table}`
+                PARTITION BY DATE(time_posted)
+                CLUSTER BY state, make
+                OPTIONS (partition_expiration_days = {days + 1})
+                AS {self._hot_deals_select("")}
+            """, params)
+            return({"rebuilt": self.client.get_table(table).num_rows})
+
+        counts = {}
+
+        params.append(self.bigquery.ScalarQueryParameter("since", "DATETIME", parse_time(format_time(since))))
+        columns = HOT_DEALS_COLUMNS
+        since_filter = "AND CAST(basic_processed_time AS DATETIME) >= @since"
+
+        # A listing re-parsed since the last run that no longer passes the
+        # filters has to come out; the merge only sees the ones that do.
+        counts["dropped"] = self._dml(f"""
+            DELETE FROM `{table}`
+            WHERE url IN (
+                SELECT url
+                FROM `{self.prefix}.processed_listing_pages`
+                WHERE CAST(basic_processed_time AS DATETIME) >= @since)
+              AND url NOT IN (
+                SELECT url FROM ({self._hot_deals_select(since_filter)}))
+        """, params)
+
+        counts["merged"] = self._dml(f"""
+            MERGE `{table}` AS T
+            USING ({self._hot_deals_select(since_filter)}) AS S
+            ON T.url = S.url
+            WHEN MATCHED THEN
+              UPDATE SET {", ".join(f"{column} = S.{column}" for column in columns)}
+            WHEN NOT MATCHED THEN
+              INSERT ({", ".join(columns)}) VALUES ({", ".join(f"S.{column}" for column in columns)})
+        """, params)
+
+        counts["expired"] = self._dml(f"""
+            DELETE FROM `{table}`
+            WHERE time_posted < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @days DAY)
+        """, params[:1])
+
+        if rescore :
+            counts["rescored"] = self._dml(f"""
+                MERGE `{table}` AS T
+                USING (
+                  SELECT listings.url, {HOT_DEALS_PREDICTED_PRICE} AS predicted_price,
+                         lms.r_squared, lms.sample_size
+                  FROM `{table}` AS listings
+                  LEFT JOIN `{self.prefix}.lm_lookup_table` AS lms
+                  ON listings.make = lms.make AND listings.model = lms.model
+                ) AS S
+                ON T.url = S.url
+                WHEN MATCHED THEN
+                  UPDATE SET predicted_price = S.predicted_price, r_squared = S.r_squared,
+                             sample_size = S.sample_size
+            """, [])
+
+        return(counts)
+
+    def append_rows(self, table_name, rows) :
+        from gbq_writer import write_rows
+
+        return(write_rows(self.client, rows, self.dataset_id, table_name))
+
+    def delete_harvested_links(self, urls) :
+        # once we've requested the pages, we remove the links
+        # from the "links needing harvesting" table
+
+        query = f"""
+        DELETE FROM `{self.prefix}.links_need_harvesting`
+        WHERE url IN (
+          SELECT url FROM `{self.prefix}.links_need_harvesting`
+          WHERE url IN UNNEST(@pulled_links)
+        )
+        """
+
+        try:
+            self._query(query, [self.bigquery.ArrayQueryParameter("pulled_links", "STRING", list(urls))])
+            print("Deletion completed successfully.")
+        except Exception as e:
+            print("Error occurred during deletion:", str(e))
+
+    def load_dataframe(self, df, table_name, truncate=True) :
+        bigquery = self.bigquery
+
+        if truncate :
+            write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        else :
+            write_disposition = bigquery.WriteDisposition.WRITE_APPEND
+
+        job_config = bigquery.LoadJobConfig(write_disposition=write_disposition)
+        job = self.client.load_table_from_dataframe(df, f"{self.prefix}.{table_name}", job_config=job_config)
+        job.result()
+
+    def close(self) :
+        self.client.close()
+
+
+# Local copies of the tables the jobs touch. SQLite is loosely typed, so
+# these mostly document the columns; timestamps are stored as
+# "%Y-%m-%d %H:%M:%S" text, which sorts and compares correctly.
+SQLITE_SCHEMA = {
+    "links_need_harvesting" : ["url TEXT", "location TEXT", "row_created TEXT"],
+    "harvest_dead_letters" : ["url TEXT", "location TEXT", "row_created TEXT", "outcome TEXT",
+                              "status INTEGER", "attempts INTEGER", "time_dead_lettered TEXT"],
+    "raw_listing_pages" : ["url TEXT", "datetime_pulled TEXT", "raw_html TEXT", "location TEXT"],
+    "processed_listing_pages" : [
+        "url TEXT", "location TEXT", "odometer REAL", "title TEXT", "paint TEXT",
+        "drive TEXT", "cylinders TEXT", "condition TEXT", "fuel TEXT", "type TEXT",
+        "transmission TEXT", "vin TEXT", "name TEXT", "post_id TEXT", "time_posted TEXT",
+        "year INTEGER", "price REAL", "posting_body_text TEXT", "title_text TEXT",
+        "num_images INTEGER", "latitude REAL", "longitude REAL", "make TEXT", "model TEXT",
+        "needs_basic_parsing INTEGER", "basic_processed_time TEXT",
+        "needs_ai_parsing INTEGER", "ai_processed_time TEXT",
+        "predicted_price REAL", "deal_ratio REAL",
+    ],
+    "make_model_year" : ["make TEXT", "model TEXT", "short_model TEXT"],
+    "lm_lookup_table" : [
+        "make TEXT", "model TEXT", "intercept REAL", "miles_coeff REAL",
+        "condition_coeff REAL", "year_coeff REAL", "r_squared REAL", "sample_size INTEGER",
+    ],
+    "state_lookup_table" : ["region TEXT", "state TEXT"],
+    "log" : [
+        "task TEXT", "time_started TEXT", "time_finished TEXT", "notes TEXT",
+        "hostname TEXT", "duration_seconds REAL", "stage_seconds TEXT", "counters TEXT", "latencies TEXT",
+    ],
+}
+
+
+def _sqlite_log(value) :
+    """ BigQuery's LOG is the natural log; SQLite's built-in one is base 10."""
+    if value is None or value <= 0 :
+        return(None)
+    return(math.log(value))
+
+
+def _sqlite_value(value) :
+    """ Timestamps as text, and repeated/record fields (lists, dicts) as JSON."""
+    if hasattr(value, "strftime") :
+        return(format_time(value))
+    if isinstance(value, (list, dict)) :
+        return(json.dumps(value))
+    return(value)
+
+
+class SQLiteWarehouse(Warehouse) :
+
+    def __init__(self, path=":memory:") :
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.create_function("LOG", 1, _sqlite_log, deterministic=True)
+
+        for table_name, columns in SQLITE_SCHEMA.items() :
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({', '.join(columns)})")
+
+            # Files made before a column was added get it here
+            existing = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table_name})")}
+            for column in columns :
+                if column.split()[0] not in existing :
+                    self.conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS raw_url ON raw_listing_pages (url)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS processed_url ON processed_listing_pages (url)")
+        self.conn.commit()
+
+    def _query(self, query, params=()) :
+        return(self.conn.execute(query, params).fetchall())
+
+    def make_models(self) :
+        return(self._query("SELECT make, model, short_model FROM make_model_year"))
+
+    def processed_needs_basic(self) :
+        return([row[0] for row in self._query("""
+            SELECT url
+            FROM processed_listing_pages
+            WHERE needs_basic_parsing
+            GROUP BY url
+            ORDER BY MIN(basic_processed_time)
+        """)])
+
+    def raw_needs_parsing(self, watermark=None, in_flight=()) :
+
+        if watermark is None :
+            return(self._query("""
+                SELECT url, MIN(datetime_pulled) AS datetime_pulled
+                FROM raw_listing_pages
+                WHERE url NOT IN (SELECT url FROM processed_listing_pages)
+                  AND datetime_pulled <= datetime('now', '-15 minutes')
+                GROUP BY url
+                ORDER BY datetime_pulled
+            """))
+
+        return(self._query("""
+            SELECT url, MIN(datetime_pulled) AS datetime_pulled
+            FROM raw_listing_pages
+            WHERE datetime_pulled >= ?
+              AND datetime_pulled <= datetime('now', '-15 minutes')
+              AND url NOT IN (SELECT value FROM json_each(?))
+            GROUP BY url
+            ORDER BY datetime_pulled
+        """, (format_time(watermark), json.dumps(list(in_flight)))))
+
+    def links_to_harvest(self, limit, watermark=None, in_flight=(), exclude=()) :
+
+        if watermark is None :
+            return(self._query("""
+                SELECT url, location, row_created
+                FROM links_need_harvesting
+                WHERE url NOT IN (SELECT url FROM raw_listing_pages)
+                  AND url NOT IN (SELECT value FROM json_each(?))
+                ORDER BY row_created ASC
+                LIMIT ?
+            """, (json.dumps(list(exclude)), int(limit))))
+
+        return(self._query("""
+            SELECT url, location, row_created
+            FROM links_need_harvesting
+            WHERE row_created >= ?
+              AND url NOT IN (SELECT value FROM json_each(?))
+              AND url NOT IN (SELECT url FROM raw_listing_pages)
+              AND url NOT IN (SELECT value FROM json_each(?))
+            ORDER BY row_created ASC
+            LIMIT ?
+        """, (format_time(watermark), json.dumps(list(in_flight)), json.dumps(list(exclude)), int(limit))))
+
+    def recent_pulls(self, since=None) :
+        since = format_time(since)
+
+        pulls = dict(self._query("""
+            SELECT url, MIN(datetime_pulled)
+            FROM raw_listing_pages
+            WHERE datetime_pulled > date('now', '-30 days')
+              AND (? IS NULL OR datetime_pulled >= ?)
+            GROUP BY url
+        """, (since, since)))
+
+        for url, row_created in self._query("""
+            SELECT url, MIN(row_created)
+            FROM links_need_harvesting
+            WHERE ? IS NULL OR row_created >= ?
+            GROUP BY url
+        """, (since, since)) :
+            pulls.setdefault(url, row_created)
+
+        return(pulls)
+
+    def raw_pages(self, urls, page_size=100) :
+        cursor = self.conn.execute("""
+            SELECT url, raw_html, location
+            FROM raw_listing_pages
+            WHERE url IN (SELECT value FROM json_each(?))
+        """, (json.dumps(list(urls)),))
+
+        while True :
+            rows = cursor.fetchmany(page_size)
+            if not rows :
+                return
+            yield from rows
+
+    def lm_lookup(self) :
+        return(self._query("""
+            SELECT make, model, intercept, miles_coeff, condition_coeff, year_coeff, r_squared, sample_size
+            FROM lm_lookup_table
+        """))
+
+    def lm_lookup_version(self) :
+        # No modified time to go on, so fingerprint the contents
+        return(self._query("""
+            SELECT COUNT(*), TOTAL(intercept), TOTAL(miles_coeff), TOTAL(condition_coeff),
+                   TOTAL(year_coeff), TOTAL(sample_size)
+            FROM lm_lookup_table
+        """)[0])
+
+    def price_history(self, days) :
+        yield from self.conn.execute("""
+            SELECT make, model, year, odometer, price, condition, time_posted
+            FROM processed_listing_pages
+            WHERE make IS NOT NULL
+              AND model IS NOT NULL
+              AND year IS NOT NULL
+              AND odometer IS NOT NULL
+              AND price IS NOT NULL
+              AND condition IS NOT NULL
+              AND time_posted >= datetime('now', ?)
+        """, (f"-{int(days)} days",))
+
+    def refresh_hot_deals(self, since=None, rescore=False, days=45) :
+        # A local table is small, so it's rebuilt from the last `days` of
+        # listings every time; `since` and `rescore` don't change anything.
+        columns = ", ".join(f"listings.{column}" if column != "state" else "state_lookup.state"
+                            for column in HOT_DEALS_COLUMNS[:-3])
+
+        self.conn.execute("DROP TABLE IF EXISTS hot_deals")
+        self.conn.execute(f"""
+            CREATE TABLE hot_deals AS
+            WITH Latest AS (
+                SELECT *
+                FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY url ORDER BY basic_processed_time DESC) AS parse_rank
+                    FROM processed_listing_pages
+                    WHERE time_posted >= datetime('now', ?)
+                )
+                WHERE parse_rank = 1
+            )
+            SELECT
+              {columns},
+              {HOT_DEALS_PREDICTED_PRICE} AS predicted_price,
+              lms.r_squared,
+              lms.sample_size
+            FROM Latest AS listings
+            JOIN state_lookup_table AS state_lookup
+            ON state_lookup.region = listings.location
+            LEFT JOIN lm_lookup_table AS lms
+            ON listings.make = lms.make AND listings.model = lms.model
+            WHERE listings.price < 75000
+              AND listings.price > 250
+              AND listings.odometer < 300000
+              AND listings.odometer > 0
+              AND listings.year >= CAST(strftime('%Y', 'now') AS INTEGER) - 50
+              AND listings.year <= CAST(strftime('%Y', 'now') AS INTEGER) + 1
+        """, (f"-{int(days)} days",))
+        self.conn.commit()
+
+        return({"rebuilt": self._query("SELECT COUNT(*) FROM hot_deals")[0][0]})
+
+    def append_rows(self, table_name, rows) :
+        failures = []
+
+        for idx, row in enumerate(rows) :
+            columns = list(row)
+            try :
+                self.conn.execute(
+                    f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' for _ in columns)})",
+                    [_sqlite_value(value) for value in row.values()])
+            except sqlite3.Error as e :
+                failures.append({"index": idx, "row": row, "errors": [{"reason": "invalid", "message": str(e)}]})
+
+        self.conn.commit()
+
+        return(failures)
+
+    def delete_harvested_links(self, urls) :
+        self.conn.execute("DELETE FROM links_need_harvesting WHERE url IN (SELECT value FROM json_each(?))",
+                          (json.dumps(list(urls)),))
+        self.conn.commit()
+        print("Deletion completed successfully.")
+
+    def load_dataframe(self, df, table_name, truncate=True) :
+        df.to_sql(table_name, self.conn, if_exists="replace" if truncate else "append", index=False)
+
+    def close(self) :
+        self.conn.close()
+
+
+def connect_warehouse() :
+    """ Build the warehouse the env asks for. Defaults to BigQuery."""
+
+    backend = os.getenv("WAREHOUSE", "bigquery")
+
+    if backend == "sqlite" :
+        return(SQLiteWarehouse(os.getenv("WAREHOUSE_PATH", "carbitrage.db")))
+
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+
+    # dotenv stuff
+    service_path = os.getenv("SERVICE_PATH")
+    service_file = os.getenv("SERVICE_FILE")
+    gbq_proj_id = os.getenv("GBQ_PROJECT_ID")
+    dataset_id = os.getenv("GBQ_DATASET_ID")
+
+    credentials = service_account.Credentials.from_service_account_file(service_path + service_file)
+
+    client = bigquery.Client(credentials = credentials, project=gbq_proj_id)
+
+    return(BigQueryWarehouse(client, dataset_id))